@@ -0,0 +1,273 @@
+"""Batch anchor-based patch engine (the reusable form of _patch3.py).
+
+A patch spec is JSON data:
+
+    {
+      "files": ["*/index.html", "skAIxuide/index.html"],
+      "patches": [
+        {"name": "gateway-client",
+         "start": "        // --- GATEWAY CLIENT LOGIC ---",
+         "end": "        // --- SEARCH/REPLACE EDIT ENGINE ---",
+         "replace_file": "snippets/gateway.js"},
+        {"name": "model", "start": "gemini-1.5-flash", "replace": "gemini-2.0-flash"}
+      ]
+    }
+
+Each patch replaces the text from its `start` anchor up to (not including) its
+`end` anchor, like the content.find()/slice pairs in _patch3.py. Set
+"through_end": true to swap the end anchor too, or leave `end` out to replace
+just the start anchor. Replacement text comes from "replace", or from
+"replace_file" (read relative to the spec). Patches are "required" by default, so
+a file that matches some of a spec's anchors but not all of them is left untouched.
+Files that match none of the anchors are skipped.
+
+All anchors of a spec are compiled into one lookahead alternation, so every file
+is scanned once no matter how many patches the spec has, and anchors may still
+overlap or contain one another. Each patch takes the first occurrence of `start`
+and the first `end` at or after it, like the content.find(end, begin) pairs in
+_patch3.py. Files are processed in parallel and written atomically (temp file +
+os.replace). An optional backup is made first.
+
+    python _patch_engine.py spec.json --dry-run --diff
+    python _patch_engine.py spec.json --backup --jobs 8
+"""
+import argparse
+import bisect
+import difflib
+import glob
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SKIP_DIRS = {'node_modules', '__pycache__'}
+BACKUP_SUFFIX = '.bak'
+
+class SpecError(Exception):
+    pass
+
+class Patch:
+    __slots__ = ('name', 'start', 'end', 'through_end', 'replace', 'required')
+
+    def __init__(self, name, start, end, through_end, replace, required):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.through_end = through_end
+        self.replace = replace
+        self.required = required
+
+class PatchSpec:
+    """Parsed spec plus the single lookahead regex that finds every anchor."""
+
+    def __init__(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            try:
+                data = json.load(f)
+            except ValueError as e:
+                raise SpecError(f"{path}: {e}") from None
+        base = os.path.dirname(os.path.abspath(path))
+        self.path = path
+        self.files = data.get('files') or []
+        self.patches = []
+        for i, raw in enumerate(data.get('patches') or []):
+            name = raw.get('name') or f'patch#{i + 1}'
+            if not raw.get('start'):
+                raise SpecError(f"{name}: 'start' anchor is required")
+            if 'replace_file' in raw:
+                with open(os.path.join(base, raw['replace_file']), 'r', encoding='utf-8') as f:
+                    replace = f.read()
+            elif 'replace' in raw:
+                replace = raw['replace']
+            else:
+                raise SpecError(f"{name}: needs 'replace' or 'replace_file'")
+            self.patches.append(Patch(name, raw['start'], raw.get('end'), bool(raw.get('through_end')),
+                                      replace, raw.get('required', True)))
+        if not self.patches:
+            raise SpecError(f"{path}: no patches")
+
+        # A zero-width lookahead tries every offset, so matches may overlap. Longest
+        # first: at each offset the group holds the longest anchor found there, and
+        # every anchor that is a prefix of it starts at the same offset.
+        self.anchors = sorted({p.start for p in self.patches} | {p.end for p in self.patches if p.end},
+                              key=len, reverse=True)
+        self.prefixes = {a: [b for b in self.anchors if a.startswith(b)] for a in self.anchors}
+        self.pattern = re.compile('(?=(' + '|'.join(map(re.escape, self.anchors)) + '))')
+
+    def targets(self, root, explicit=()):
+        """Files named on the command line, else the spec's globs under `root`."""
+        if explicit:
+            return sorted(os.path.abspath(p) for p in explicit)
+        found = set()
+        for pattern in self.files:
+            for path in glob.glob(os.path.join(root, pattern), recursive=True):
+                parts = os.path.relpath(path, root).split(os.sep)
+                if os.path.isfile(path) and not any(p in SKIP_DIRS or p.startswith('.') for p in parts):
+                    found.add(os.path.abspath(path))
+        return sorted(found)
+
+class FileResult:
+    __slots__ = ('path', 'matched', 'missing', 'error', 'old', 'new', 'written')
+
+    def __init__(self, path):
+        self.path = path
+        self.matched = []   # (patch name, line number)
+        self.missing = []   # patch names
+        self.error = None
+        self.old = self.new = None
+        self.written = False
+
+    @property
+    def changed(self):
+        return self.new is not None and self.new != self.old
+
+def plan(spec, content, result):
+    """Scan `content` once and return the patched text, or None if nothing applies."""
+    positions = {}  # anchor text -> [offsets], ascending
+    for m in spec.pattern.finditer(content):
+        for anchor in spec.prefixes[m.group(1)]:
+            positions.setdefault(anchor, []).append(m.start())
+
+    blocks = []  # (start, stop, patch)
+    unmet = []   # required patches that found no place to go
+    for patch in spec.patches:
+        starts = positions.get(patch.start)
+        if not starts:
+            result.missing.append(patch.name)
+            if patch.required:
+                unmet.append(patch.name)
+            continue
+        begin = starts[0]
+        if patch.end is None:
+            stop = begin + len(patch.start)
+        else:
+            ends = positions.get(patch.end, ())
+            i = bisect.bisect_left(ends, begin)
+            if i == len(ends):
+                result.missing.append(f"{patch.name} (end anchor)")
+                if patch.required:
+                    unmet.append(patch.name)
+                continue
+            stop = ends[i] + (len(patch.end) if patch.through_end else 0)
+        blocks.append((begin, stop, patch))
+        result.matched.append((patch.name, content.count('\n', 0, begin) + 1))
+
+    if not blocks:
+        return None
+    if unmet:
+        result.error = f"required anchor(s) not found: {', '.join(unmet)}"
+        return None
+    blocks.sort(key=lambda b: b[0])
+    for (_, prev_stop, prev), (begin, _, patch) in zip(blocks, blocks[1:]):
+        if begin < prev_stop:
+            result.error = f"blocks overlap: {prev.name} and {patch.name}"
+            return None
+
+    out, cursor = [], 0
+    for begin, stop, patch in blocks:
+        out.append(content[cursor:begin])
+        out.append(patch.replace)
+        cursor = stop
+    out.append(content[cursor:])
+    return ''.join(out)
+
+def atomic_write(path, content, backup=False):
+    """Replace `path` in one step so a crash never leaves a half-written file."""
+    if backup:
+        shutil.copy2(path, path + BACKUP_SUFFIX)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        shutil.copymode(path, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+def process(spec, path, dry_run=False, backup=False):
+    result = FileResult(path)
+    try:
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            result.old = f.read()
+        result.new = plan(spec, result.old, result)
+        if result.changed and not dry_run:
+            atomic_write(path, result.new, backup)
+            result.written = True
+    except (OSError, UnicodeDecodeError) as e:
+        result.error = f"{type(e).__name__}: {e}"
+    return result
+
+def diff(result, root):
+    rel = os.path.relpath(result.path, root)
+    return ''.join(difflib.unified_diff(result.old.splitlines(True), result.new.splitlines(True),
+                                        f'a/{rel}', f'b/{rel}'))
+
+def report(spec, results, root):
+    print(f"\n{'=' * 60}\nSummary for {spec.path}\n{'=' * 60}")
+    touched = [r for r in results if r.matched or r.error]
+    for r in touched:
+        rel = os.path.relpath(r.path, root)
+        state = 'ERROR' if r.error else ('written' if r.written else ('would change' if r.changed else 'unchanged'))
+        print(f"{rel}: {state}")
+        for name, line in r.matched:
+            print(f"    + {name} @ line {line}")
+        for name in r.missing:
+            print(f"    - {name} not found")
+        if r.error:
+            print(f"    ! {r.error}")
+    print(f"\n{'patch':<32} files matched")
+    for patch in spec.patches:
+        count = sum(1 for r in results if any(name == patch.name for name, _ in r.matched))
+        print(f"{patch.name:<32} {count}/{len(results)}")
+    changed = sum(1 for r in results if r.changed and not r.error)
+    errors = sum(1 for r in results if r.error)
+    print(f"\n{len(results)} scanned, {len(touched)} matched, {changed} changed, {errors} errors")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Apply anchor-based block replacements across the workspace")
+    parser.add_argument('spec', help="JSON patch spec")
+    parser.add_argument('files', nargs='*', help="files to patch (default: the spec's 'files' globs)")
+    parser.add_argument('--root', default=ROOT, help="directory the spec's globs are relative to")
+    parser.add_argument('--dry-run', action='store_true', help="report what would change, write nothing")
+    parser.add_argument('--diff', action='store_true', help="print a unified diff of every change")
+    parser.add_argument('--backup', action='store_true', help=f"keep the original as <file>{BACKUP_SUFFIX}")
+    parser.add_argument('--jobs', type=int, default=min(32, (os.cpu_count() or 1) * 4),
+                        help="files processed in parallel (default: %(default)s)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    try:
+        spec = PatchSpec(args.spec)
+    except (SpecError, OSError) as e:
+        print(f"ERROR: {e}")
+        return 2
+    targets = spec.targets(args.root, args.files)
+    if not targets:
+        print("ERROR: no files to patch")
+        return 2
+    print(f"{len(spec.patches)} patches, {len(spec.anchors)} anchors, {len(targets)} files"
+          f"{' (dry run)' if args.dry_run else ''}")
+
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+        results = list(pool.map(lambda p: process(spec, p, args.dry_run, args.backup), targets))
+
+    if args.diff:
+        for r in results:
+            if r.changed and not r.error:
+                sys.stdout.write(diff(r, args.root))
+    report(spec, results, args.root)
+    return 1 if any(r.error for r in results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,341 @@
+"""Load test + latency benchmark for server.py against a local fake kAIxu gateway.
+
+Starts a stand-in gateway that emits meta/delta/done SSE streams (tunable token
+rate, chunk size and failure injection), launches server.py pointed at it, then
+drives a mixed workload of static fetches, /api/fs/projects, gateway-stream and
+gateway-chat calls and reports throughput, p50/p95/p99 latency, proxy-added TTFB
+and memory per concurrent stream.
+
+    python bench.py                       # defaults: 20 clients for 15s
+    python bench.py --engine classic --duration 30 --json bench.json
+"""
+import argparse
+import http.client
+import http.server
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+STATIC_PATHS = ['/skAIxuide/index.html', '/skAIxuide/manifest.json', '/skAIxuide/sw.js',
+                '/skAIxuide/login.html', '/Images/icon-192.png']
+
+# --- Fake gateway ---
+class FakeGatewayHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Like a real gateway: without this, keep-alive responses stall on delayed ACKs
+    disable_nagle_algorithm = True
+    cfg = None  # argparse namespace, set by start_fake_gateway
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return bytes(body)
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_POST(self):
+        cfg = self.cfg
+        body = self.read_body()
+        time.sleep(cfg.gw_ttfb)
+        if random.random() < cfg.fail_rate:
+            out = b'{"error": "injected failure"}'
+            self.send_response(503)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+            return
+        if 'gateway-stream' in self.path:
+            self.stream()
+        else:
+            out = json.dumps({"text": "ok " * cfg.tokens, "echo_bytes": len(body),
+                              "usage": {"input_tokens": len(body) // 4, "output_tokens": cfg.tokens}}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+    def stream(self):
+        cfg = self.cfg
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        events = [b'event: meta\ndata: {"month": {"spent_cents": 1, "cap_cents": 1000}}\n\n']
+        events += [b'event: delta\ndata: {"text": "tok%d "}\n\n' % i for i in range(cfg.tokens)]
+        events.append(b'event: done\ndata: {"usage": {"input_tokens": 10, "output_tokens": %d}}\n\n' % cfg.tokens)
+        drop_at = random.randrange(len(events)) if random.random() < cfg.drop_rate else None
+        delay = 1.0 / cfg.token_rate if cfg.token_rate > 0 else 0
+        try:
+            for i, event in enumerate(events):
+                if i == drop_at:
+                    self.close_connection = True
+                    return
+                for pos in range(0, len(event), cfg.chunk_size):
+                    piece = event[pos:pos + cfg.chunk_size]
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(piece), piece))
+                self.wfile.flush()
+                if delay and 0 < i < len(events) - 1:
+                    time.sleep(delay)
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+def start_fake_gateway(cfg):
+    FakeGatewayHandler.cfg = cfg
+    gw = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeGatewayHandler)
+    gw.daemon_threads = True
+    threading.Thread(target=gw.serve_forever, daemon=True).start()
+    return gw
+
+# --- Server under test ---
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(cfg, gateway_url):
+    port = free_port()
+    cmd = [sys.executable, os.path.join(HERE, 'server.py'), '--port', str(port),
+           '--gateway', gateway_url, '--engine', cfg.engine,
+           '--max-connections', str(cfg.max_connections), '--proxy-diag', 'off',
+           # every bench client is 127.0.0.1, so lift admission control out of the way
+           '--max-ai-calls', str(cfg.max_connections),
+           '--max-ai-calls-per-client', str(cfg.max_connections)] + cfg.server_arg
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return proc, port
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.1)
+    proc.kill()
+    sys.exit("server.py did not start (try running it by hand with the same flags)")
+
+def rss_kb(pid):
+    """Resident set size from /proc (Linux); None elsewhere."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+# --- Client side ---
+def timed_request(port, method, path, body=None, headers=None, timeout=60):
+    """Return (status, ttfb_s, total_s, nbytes); status 0 on connection errors."""
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        resp = conn.getresponse()
+        first = resp.read1(65536)
+        ttfb = time.perf_counter() - start
+        n = len(first)
+        while True:
+            chunk = resp.read1(65536)
+            if not chunk:
+                break
+            n += len(chunk)
+        return resp.status, ttfb, time.perf_counter() - start, n
+    except (OSError, http.client.HTTPException):
+        return 0, None, time.perf_counter() - start, 0
+    finally:
+        conn.close()
+
+def chat_payload(size):
+    return json.dumps({"provider": "gemini", "model": "gemini-2.0-flash",
+                       "messages": [{"role": "user", "content": "x" * size}]}).encode()
+
+def run_op(kind, port, cfg):
+    if kind == 'static':
+        return timed_request(port, 'GET', random.choice(STATIC_PATHS),
+                             headers={'Accept-Encoding': 'gzip'})
+    if kind == 'projects':
+        return timed_request(port, 'GET', '/api/fs/projects')
+    endpoint = 'gateway-stream' if kind == 'stream' else 'gateway-chat'
+    body = chat_payload(cfg.payload_bytes)
+    return timed_request(port, 'POST', f'/api/.netlify/functions/{endpoint}', body=body,
+                         headers={'Content-Type': 'application/json',
+                                  'Authorization': 'Bearer bench-key'})
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def summarize(samples, elapsed):
+    ok = [s for s in samples if 200 <= s[0] < 400]
+    totals = [s[2] * 1000 for s in ok]
+    ttfbs = [s[1] * 1000 for s in ok if s[1] is not None]
+    return {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "rps": round(len(samples) / elapsed, 1),
+        "p50_ms": percentile(totals, 50),
+        "p95_ms": percentile(totals, 95),
+        "p99_ms": percentile(totals, 99),
+        "ttfb_p50_ms": percentile(ttfbs, 50),
+        "mb": round(sum(s[3] for s in ok) / 2**20, 2),
+    }
+
+def mixed_workload(port, cfg):
+    kinds = []
+    for kind, weight in (('static', cfg.w_static), ('projects', cfg.w_projects),
+                         ('stream', cfg.w_stream), ('chat', cfg.w_chat)):
+        kinds += [kind] * weight
+    samples = {k: [] for k in set(kinds)}
+    lock = threading.Lock()
+    deadline = time.time() + cfg.duration
+
+    def worker():
+        while time.time() < deadline:
+            kind = random.choice(kinds)
+            result = run_op(kind, port, cfg)
+            with lock:
+                samples[kind].append(result)
+
+    started = time.time()
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(cfg.clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - started
+    report = {kind: summarize(s, elapsed) for kind, s in sorted(samples.items())}
+    report['all'] = summarize([x for s in samples.values() for x in s], elapsed)
+    return report
+
+def ttfb_overhead(port, gw_port, cfg, n=30):
+    """Median/p95 TTFB of gateway-stream through the proxy minus hitting the fake directly."""
+    path = '/.netlify/functions/gateway-stream'
+    body = chat_payload(cfg.payload_bytes)
+    headers = {'Content-Type': 'application/json'}
+    direct = [timed_request(gw_port, 'POST', path, body, headers)[1] for _ in range(n)]
+    proxied = [timed_request(port, 'POST', '/api' + path, body, headers)[1] for _ in range(n)]
+    direct = [d * 1000 for d in direct if d is not None]
+    proxied = [p * 1000 for p in proxied if p is not None]
+    if not direct or not proxied:
+        return {}
+    return {
+        "direct_p50_ms": percentile(direct, 50),
+        "proxied_p50_ms": percentile(proxied, 50),
+        "overhead_p50_ms": percentile(proxied, 50) - percentile(direct, 50),
+        "overhead_p95_ms": percentile(proxied, 95) - percentile(direct, 95),
+    }
+
+def memory_per_stream(proc, port, cfg):
+    """RSS growth of the server while `cfg.mem_streams` slow streams are open."""
+    base = rss_kb(proc.pid)
+    if base is None:
+        return {}
+    peak = [base]
+    threads = [threading.Thread(target=run_op, args=('stream', port, cfg), daemon=True)
+               for _ in range(cfg.mem_streams)]
+    for t in threads:
+        t.start()
+    while any(t.is_alive() for t in threads):
+        peak.append(rss_kb(proc.pid) or base)
+        time.sleep(0.05)
+    for t in threads:
+        t.join()
+    grown = max(peak) - base
+    return {"streams": cfg.mem_streams, "baseline_rss_kb": base, "peak_rss_kb": max(peak),
+            "kb_per_stream": round(grown / cfg.mem_streams, 1)}
+
+def fmt(v):
+    return '-' if v is None else f'{v:.1f}' if isinstance(v, float) else str(v)
+
+def print_report(report):
+    cols = ('requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'ttfb_p50_ms', 'mb')
+    print(f"\nengine={report['config']['engine']} clients={report['config']['clients']} "
+          f"duration={report['config']['duration']}s")
+    print(f"{'workload':<10}" + ''.join(f'{c:>13}' for c in cols))
+    for kind, row in report['workload'].items():
+        print(f"{kind:<10}" + ''.join(f'{fmt(row[c]):>13}' for c in cols))
+    if report['ttfb_overhead']:
+        o = report['ttfb_overhead']
+        print(f"\nproxy-added TTFB: p50 {fmt(o['overhead_p50_ms'])} ms, p95 {fmt(o['overhead_p95_ms'])} ms "
+              f"(direct p50 {fmt(o['direct_p50_ms'])} ms, proxied p50 {fmt(o['proxied_p50_ms'])} ms)")
+    if report['memory']:
+        m = report['memory']
+        print(f"memory: {fmt(m['kb_per_stream'])} KB RSS per open stream "
+              f"({m['streams']} streams, {m['baseline_rss_kb']} -> {m['peak_rss_kb']} KB)")
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark server.py against a local fake gateway")
+    p.add_argument('--engine', default='asyncio', help="server.py --engine to test")
+    p.add_argument('--max-connections', type=int, default=256)
+    p.add_argument('--server-arg', action='append', default=[],
+                   help="extra argument passed to server.py (repeatable)")
+    p.add_argument('--clients', type=int, default=20, help="concurrent client threads")
+    p.add_argument('--duration', type=float, default=15.0, help="mixed workload seconds")
+    p.add_argument('--w-static', type=int, default=6, help="weight of static fetches")
+    p.add_argument('--w-projects', type=int, default=2, help="weight of /api/fs/projects")
+    p.add_argument('--w-stream', type=int, default=1, help="weight of gateway-stream proxies")
+    p.add_argument('--w-chat', type=int, default=1, help="weight of gateway-chat proxies")
+    p.add_argument('--payload-bytes', type=int, default=2048, help="prompt size per AI call")
+    p.add_argument('--tokens', type=int, default=40, help="delta events per fake stream")
+    p.add_argument('--token-rate', type=float, default=200.0, help="delta events/s (0 = unthrottled)")
+    p.add_argument('--chunk-size', type=int, default=64, help="bytes per fake gateway write")
+    p.add_argument('--gw-ttfb', type=float, default=0.02, help="fake gateway think time (s)")
+    p.add_argument('--fail-rate', type=float, default=0.0, help="fraction answered with 503")
+    p.add_argument('--drop-rate', type=float, default=0.0, help="fraction of streams cut mid-way")
+    p.add_argument('--mem-streams', type=int, default=50, help="concurrent streams for memory probe")
+    p.add_argument('--json', metavar='PATH', help="also write the report as JSON")
+    return p.parse_args(argv)
+
+def main(argv=None):
+    cfg = parse_args(argv)
+    gw = start_fake_gateway(cfg)
+    gw_port = gw.server_address[1]
+    proc, port = start_server(cfg, f'http://127.0.0.1:{gw_port}')
+    try:
+        for path in STATIC_PATHS + ['/api/fs/projects']:
+            timed_request(port, 'GET', path)  # warm caches
+        report = {
+            "config": vars(cfg),
+            "ttfb_overhead": ttfb_overhead(port, gw_port, cfg),
+            "memory": memory_per_stream(proc, port, cfg),
+            "workload": mixed_workload(port, cfg),
+        }
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        gw.shutdown()
+    print_report(report)
+    if cfg.json:
+        with open(cfg.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,3902 @@
 import http.server
 import socketserver
+import asyncio
+import argparse
+import atexit
 import os
 import urllib.parse
 import hashlib
+import hmac
+import secrets
+import tempfile
 import http.client
 import ssl
 import json
 import sys
 import time
+import select
+import struct
+import errno
+import ctypes
+import ctypes.util
+import queue
+import re
+import math
+import fnmatch
+import posixpath
+import itertools
+import random
+import threading
+import io
+import uuid
+import signal
+import socket
+import traceback
+import gzip
+import email.utils
+import mimetypes
+from collections import OrderedDict, deque
+from http import HTTPStatus
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import brotli  # optional: pip install brotli
+except ImportError:
+    brotli = None
 
 PORT = 8000
+# Resolved, so it agrees with os.getcwd() (which translate_path builds on) in a
+# symlinked checkout
+WORKSPACE_ROOT = os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# Server-generated artifacts (precompressed variants, ...) live in a dot-dir so the
+# project index and directory listings skip them.
+CACHE_DIR = os.path.join(WORKSPACE_ROOT, '.cache', 'skaixuide')
+# Serving engines: 'classic' is the original one-connection-at-a-time TCPServer,
+# 'threaded' spawns a thread per connection, 'asyncio' accepts on an event loop
+# and runs handlers on a bounded pool so long SSE proxies never block static traffic.
+ENGINES = ('classic', 'threaded', 'asyncio')
+DEFAULT_ENGINE = 'asyncio'
+MAX_CONNECTIONS = 256   # concurrent connections handled by the asyncio engine
+LISTEN_BACKLOG = 128    # kernel accept queue; extra clients wait here, not in RAM
+KEEPALIVE_TIMEOUT = 15.0       # idle seconds before a persistent client connection is closed
+KEEPALIVE_MAX_REQUESTS = 1000  # responses per connection before the client is asked to reconnect
+# Pre-fork mode: N worker processes share the port (SO_REUSEPORT where available,
+# otherwise one inherited socket) under a supervisor that restarts crashed workers.
+WORKERS = 1
+WORKER_DRAIN_TIMEOUT = 30.0    # seconds a stopping worker waits for in-flight streams
+WORKER_RESTART_DELAY = 1.0     # back-off before restarting a worker that died right away
+WORKERS_MIN_PYTHON = (3, 10)   # --workers relies on os.fork() behaviour and int.bit_count()
+METRICS_SPOOL_INTERVAL = 2.0   # how often each worker publishes metrics for /api/metrics
+WORKER_INDEX = None            # set in each pre-forked worker (0..N-1)
+# Only worker 0 watches the workspace and holds its indexes (projects, precache,
+# search, file events); the other workers relay those routes to it over loopback.
+INDEX_ADDRESS = None           # (host, port) of worker 0's index listener, in the others
+INDEX_FORWARD_TIMEOUT = 60.0   # seconds a relayed index request waits on worker 0
+DRAINING = threading.Event()   # set on SIGTERM; responses then carry Connection: close
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'DemonLordAtreyuxh')
 # Simple session management (In a real app, use secure signed cookies)
 SESSION_TOKEN = hashlib.sha256(ADMIN_PASSWORD.encode()).hexdigest()
+# Per-browser session cookie that tells callers behind one address apart for fair
+# queueing. Signed with a key made at startup (before any fork, so workers agree).
+CLIENT_COOKIE = 'sk_client'
+CLIENT_COOKIE_KEY = secrets.token_bytes(32)
+# Files do_GET only serves to an admin session, however the URL spells them (realpaths)
+GATED_FILES = (os.path.realpath(os.path.join(WORKSPACE_ROOT, 'skAIxuide', 'admin_panel.html')),)
+# ...plus the diagnostics board, which sits behind its own password prompt. The
+# workspace APIs never expose them: not searched, not precached (a service worker
+# would store the login redirect under a gated page's URL).
+PRIVATE_FILES = GATED_FILES + (os.path.realpath(os.path.join(WORKSPACE_ROOT, 'skAIxuide', 'diagnostics.html')),)
 GATEWAY_HOST = "https://kaixugateway13.netlify.app"
+UPSTREAM_TIMEOUT = 120          # socket timeout for gateway calls (seconds)
+UPSTREAM_MAX_IDLE_PER_HOST = 8  # keep-alive connections parked per gateway host
+UPSTREAM_IDLE_TIMEOUT = 60.0    # drop parked connections idle longer than this
+# Upstream resilience: TTFB timeouts learned per endpoint (p99 x factor, clamped to
+# [MIN, UPSTREAM_TIMEOUT]), connect retries paid from a token bucket, opt-in hedging
+# and a per-host circuit breaker that fails fast while the gateway is down.
+UPSTREAM_TIMEOUT_MIN = 15.0
+UPSTREAM_TIMEOUT_FACTOR = 4.0
+UPSTREAM_LATENCY_WINDOW = 200       # recent TTFB samples kept per endpoint
+UPSTREAM_LATENCY_MIN_SAMPLES = 20   # fewer than this and the fixed timeout applies
+UPSTREAM_CONNECT_RETRIES = 2
+UPSTREAM_RETRY_RATIO = 0.1          # retry/hedge tokens earned per request
+UPSTREAM_RETRY_BURST = 10.0         # most tokens the budget can bank
+UPSTREAM_HEDGE = False
+UPSTREAM_HEDGE_ENDPOINTS = ('gateway-chat',)  # buffered and safe to send twice
+UPSTREAM_FAILURE_STATUSES = (502, 503, 504)   # gateway answers that count against the breaker
+BREAKER_THRESHOLD = 5               # consecutive failures that open the circuit
+BREAKER_COOLDOWN = 10.0             # seconds open before one probe is let through
+MAX_BODY_BYTES = 32 * 1024 * 1024  # largest proxied request body (prompts + attachments)
+BODY_CHUNK = 64 * 1024             # request bodies are forwarded upstream in pieces this big
+BODY_SPOOL_MEMORY = 1024 * 1024    # bodies read before admission spill to a temp file past this
+CHAT_CACHE_TTL = 0.0             # seconds; 0 disables the gateway-chat response cache
+CHAT_CACHE_MAX_ENTRIES = 256
+CHAT_CACHE_MAX_RESPONSE = 1024 * 1024
+CHAT_CACHE_MAX_BODY = 1024 * 1024  # bigger prompts bypass the cache and are streamed
+CHAT_CACHE_ENDPOINTS = ('gateway-chat',)  # non-stream endpoints that are safe to reuse
+STATIC_CACHE_MAX_BYTES = 64 * 1024 * 1024  # memory ceiling for cached static files
+STATIC_CACHE_MAX_FILE = 2 * 1024 * 1024    # larger files are always read from disk
+MAX_RANGES = 16                            # more ranges than this get the full body
+COMPRESS_MIN_BYTES = 1024                  # not worth a Content-Encoding below this
+COMPRESS_MAX_FILE = 16 * 1024 * 1024       # bigger files are always sent as they are
+COMPRESS_BACKLOG = 64                      # bodies waiting for a max-level background build
+PRECOMPRESSED_MAX_BYTES = 512 * 1024 * 1024  # sidecars on disk; least recently used go first
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json',
+                      'application/manifest+json', 'application/xml', 'image/svg+xml')
+# Optional build/serve stage (--optimize): minified HTML/CSS/JS whose local asset
+# references point at content-hash fingerprinted URLs served as immutable
+OPTIMIZE = False
+OPTIMIZE_VERSION = 2                         # bump when the minifiers change; invalidates disk outputs
+OPTIMIZE_CACHE_MAX_BYTES = 32 * 1024 * 1024  # optimized bodies kept in memory
+FINGERPRINT_LEN = 10                         # hex digits of content hash in `name.<hash>.ext`
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+WORKSPACE_POLL_INTERVAL = 5.0  # seconds between mtime polls of the workspace tree
+WORKSPACE_WATCH = 'auto'       # 'auto' uses inotify where available; 'poll' always polls
+WATCH_DEBOUNCE = 0.1           # quiet seconds that end a burst of inotify events
+WATCH_MAX_DELAY = 1.0          # a burst that never goes quiet is still delivered this often
+# File-change push notifications (/api/fs/events)
+EVENTS_BACKLOG = 1000                   # recent changes kept for Last-Event-ID catch-up
+EVENTS_HASH_MAX_FILE = 8 * 1024 * 1024  # bigger files are reported without a content hash
+EVENTS_MAX_CLIENTS = 64                 # open event streams; each holds a connection slot
+EVENTS_PING = 15.0                      # idle seconds before a `: ping` comment is sent
+# Service-worker precache manifests (/api/fs/precache): which files count as assets
+PRECACHE_EXTENSIONS = ('.html', '.htm', '.js', '.mjs', '.css', '.json', '.webmanifest', '.svg',
+                       '.png', '.jpg', '.jpeg', '.gif', '.webp', '.avif', '.ico',
+                       '.woff', '.woff2', '.ttf', '.otf', '.wasm', '.txt', '.xml')
+PRECACHE_SKIP_NAMES = ('sw.js', 'service-worker.js', 'package.json', 'package-lock.json')
+PRECACHE_MAX_FILE = 8 * 1024 * 1024  # bigger files are left to runtime caching
+PRECACHE_MAX_ASSETS = 1000           # per project
+# Workspace full-text search (/api/fs/search): trigram index over text files
+SEARCH_EXTENSIONS = ('.html', '.htm', '.js', '.mjs', '.jsx', '.ts', '.tsx', '.css', '.json',
+                     '.webmanifest', '.md', '.txt', '.py', '.toml', '.yml', '.yaml', '.xml',
+                     '.svg', '.csv', '.sh')
+SEARCH_MAX_FILE = 2 * 1024 * 1024      # bigger files are not indexed
+SEARCH_MAX_BYTES = 256 * 1024 * 1024   # text held in memory for verification and snippets
+SEARCH_MAX_RESULTS = 200               # largest `limit` a query may ask for
+SEARCH_MAX_LINES = 5                   # snippet lines returned per file
+SEARCH_SNIPPET_CHARS = 200             # longer lines are cut around the first match
+# Per-chunk SSE diagnostics: 'off', 'sample' (first chunk + every Nth) or 'full'
+PROXY_DIAG = 'sample'
+PROXY_DIAG_SAMPLE_EVERY = 50
+USAGE_MAX_IDENTITIES = 1000  # callers tracked by the usage ledger (LRU beyond that)
+KNOWN_PROXY_ENDPOINTS = ('gateway-chat', 'gateway-stream')  # others share one metrics label
+# Admission control for proxied gateway calls: at most MAX_ACTIVE at once (streams
+# leave CHAT_RESERVE of those to quick chat calls) and MAX_PER_CLIENT per caller;
+# the rest wait in a bounded queue served chat-first, round-robin across callers.
+ADMISSION_MAX_ACTIVE = 64
+ADMISSION_MAX_PER_CLIENT = 4
+ADMISSION_CHAT_RESERVE = 4
+ADMISSION_MAX_QUEUE = 128
+ADMISSION_MAX_QUEUED_PER_CLIENT = 16
+ADMISSION_QUEUE_TIMEOUT = 30.0
+# Resumable SSE: gateway streams are read into a replay buffer by their own thread, so
+# generation survives a dropped client and a POST with Last-Event-ID picks up from there.
+REPLAY_MAX_BYTES = 64 * 1024 * 1024        # all buffered stream events; 0 disables replay
+REPLAY_STREAM_MAX_BYTES = 8 * 1024 * 1024  # per stream; older events are trimmed past this
+REPLAY_TTL = 300.0                         # seconds a finished stream stays resumable
+REPLAY_PING = 15.0                         # idle seconds before a `: ping` comment is sent
+# Structured logging: handlers only enqueue; a background thread writes stdout and
+# (optionally) a size-rotated JSON-lines file. The last LOG_RING_SIZE records are
+# kept in memory for /api/logs.
+LOG_RING_SIZE = 2000
+LOG_QUEUE_SIZE = 10000
+LOG_PRESSURE = 0.75              # queue fill above which debug/info records are dropped
+LOG_FILE = None                  # JSON-lines log file; None logs to stdout only
+LOG_MAX_BYTES = 10 * 1024 * 1024 # rotate the log file past this size
+LOG_BACKUPS = 5                  # rotated files kept (<file>.1 .. <file>.N)
+
+# --- Structured log pipeline (non-blocking queue -> background writer + ring buffer) ---
+class LogPipeline:
+    """JSON log records written off the request path.
+
+    log() never blocks: it stamps the record, appends it to the in-memory ring that
+    /api/logs serves and hands it to a writer thread through a bounded queue. Once
+    the queue is LOG_PRESSURE full, debug/info records are dropped instead of
+    queued, and a full queue drops everything; drops are counted, never waited on.
+    The writer prints the familiar `[Component] message` lines to stdout and, with
+    a file configured, appends one JSON object per line, rotating by size.
+    """
+    LEVELS = {'debug': 10, 'info': 20, 'warn': 30, 'error': 40}
+    BATCH = 512  # records written per wake-up of the writer
+
+    def __init__(self, ring_size=LOG_RING_SIZE, queue_size=LOG_QUEUE_SIZE):
+        self.ring = deque(maxlen=ring_size)
+        self.queue_size = queue_size
+        self.path = LOG_FILE
+        self.max_bytes = LOG_MAX_BYTES
+        self.backups = LOG_BACKUPS
+        self.counters = dict(records=0, written=0, dropped=0, rotations=0, write_errors=0)
+        self._seq = 0
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # A forked worker inherits neither the writer thread nor a usable lock
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(self.queue_size)
+        self._thread = None
+        self._file = None
+
+    def configure(self, path=None, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def log(self, level, component, message, **fields):
+        record = {'ts': time.time(), 'level': level, 'component': component, 'msg': message}
+        if fields:
+            record.update(fields)
+        with self._lock:
+            self._seq += 1
+            record['seq'] = self._seq
+            self.ring.append(record)
+            self.counters['records'] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+                self._thread.start()
+        if (self.LEVELS.get(level, 20) < self.LEVELS['warn']
+                and self._queue.qsize() >= self.queue_size * LOG_PRESSURE):
+            self._drop()
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self._drop()
+
+    def debug(self, component, message, **fields):
+        self.log('debug', component, message, **fields)
+
+    def info(self, component, message, **fields):
+        self.log('info', component, message, **fields)
+
+    def warn(self, component, message, **fields):
+        self.log('warn', component, message, **fields)
+
+    def error(self, component, message, **fields):
+        self.log('error', component, message, **fields)
+
+    def _drop(self):
+        with self._lock:
+            self.counters['dropped'] += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self.BATCH:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                self._write(batch)
+            except Exception as e:
+                with self._lock:
+                    self.counters['write_errors'] += 1
+                sys.stderr.write(f"[Log] write failed: {e}\n")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    @staticmethod
+    def format(record):
+        tag = f"[{record['component']}]" if record['component'] else ''
+        if record['level'] == 'debug':
+            tag += '[DIAG]'
+        return f"{tag} {record['msg']}" if tag else record['msg']
+
+    def _write(self, batch):
+        sys.stdout.write(''.join(self.format(r) + '\n' for r in batch))
+        sys.stdout.flush()
+        if self.path:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(''.join(json.dumps(r, default=str) + '\n' for r in batch))
+            self._file.flush()
+            if self._file.tell() >= self.max_bytes:
+                self._rotate()
+        with self._lock:
+            self.counters['written'] += len(batch)
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups > 0:
+            os.replace(self.path, f'{self.path}.1')
+        else:
+            os.remove(self.path)
+        with self._lock:
+            self.counters['rotations'] += 1
+
+    def flush(self, timeout=2.0):
+        """Wait (bounded) for queued records to be written, e.g. before exiting."""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return not self._queue.unfinished_tasks
+
+    def recent(self, limit=200, level=None, component=None, search=None, since=0):
+        """Newest-last records from the ring, optionally filtered; `since` is a seq."""
+        floor = self.LEVELS.get(level, 0)
+        needle = search.lower() if search else None
+        with self._lock:
+            records = list(self.ring)
+        out = [r for r in records
+               if r['seq'] > since and self.LEVELS.get(r['level'], 20) >= floor
+               and (component is None or r['component'] == component)
+               and (needle is None or needle in r['msg'].lower())]
+        return out[-limit:] if limit > 0 else []
+
+    @staticmethod
+    def entry(record):
+        """Record in the {ts, type, source, message} shape diagnostics.html renders."""
+        out = {k: v for k, v in record.items() if k not in ('level', 'component', 'msg')}
+        ts = record['ts']
+        out['ts'] = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(ts)) + f'.{int(ts % 1 * 1000):03d}Z'
+        out.update(type=record['level'], source=record['component'] or 'server', message=record['msg'])
+        return out
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters, queued=self._queue.qsize(), ring=len(self.ring), file=self.path)
+
+LOG = LogPipeline()
+
+# --- Load .env file (key never hardcoded in app code) ---
+def load_dotenv(path=None):
+    """Read .env from workspace root (one directory above this script)."""
+    if path is None:
+        # server.py is in skAIxuide/, .env is in workspace root
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.env')
+    path = os.path.abspath(path)
+    if os.path.isfile(path):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#') or '=' not in line:
+                    continue
+                k, v = line.split('=', 1)
+                os.environ.setdefault(k.strip(), v.strip())
+        LOG.info('env', f"Loaded .env from {path}")
+    else:
+        LOG.info('env', f"No .env found at {path}")
+
+load_dotenv()
+
+KAIXU_VIRTUAL_KEY = os.environ.get('KAIXU_VIRTUAL_KEY', '')
+
+socketserver.TCPServer.allow_reuse_address = True
+
+# --- Metrics (Prometheus text exposition at /api/metrics) ---
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}  # label values tuple -> value
+
+    def _labels(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+    def dump(self):
+        """JSON-safe copy of the current values, as [[label values], value] pairs."""
+        with self._lock:
+            return [[list(k), self._copy(v)] for k, v in self._values.items()]
+
+    def merged(self, dumps):
+        """Current values plus every peer `dump()` in `dumps`, summed per label set."""
+        with self._lock:
+            values = {k: self._copy(v) for k, v in self._values.items()}
+        for dump in dumps:
+            for labels, value in dump:
+                labels = tuple(labels)
+                values[labels] = self._add(values[labels], value) if labels in values else value
+        return values
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    def _add(a, b):
+        return a + b
+
+    def samples(self, values=None):
+        if values is None:
+            values = self.merged(())
+        return [(self.name + self._labels(k), v) for k, v in sorted(values.items())]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    @staticmethod
+    def _copy(value):
+        return [list(value[0]), value[1], value[2]]
+
+    @staticmethod
+    def _add(a, b):
+        return [[x + y for x, y in zip(a[0], b[0])], a[1] + b[1], a[2] + b[2]]
+
+    def samples(self, values=None):
+        if values is None:
+            values = self.merged(())
+        out = []
+        for labels, (counts, total, count) in sorted(values.items()):
+            running = 0
+            for bound, n in zip(self.buckets, counts):
+                running += n
+                out.append((self.name + '_bucket' + self._labels(labels, [('le', f'{bound:g}')]), running))
+            out.append((self.name + '_bucket' + self._labels(labels, [('le', '+Inf')]), count))
+            out.append((self.name + '_sum' + self._labels(labels), total))
+            out.append((self.name + '_count' + self._labels(labels), count))
+        return out
+
+class MetricsRegistry:
+    """Holds metric objects plus collectors that turn subsystem snapshots into gauges."""
+
+    def __init__(self, prefix='skaixuide'):
+        self.prefix = prefix
+        self._metrics = []
+        self._collectors = []  # (subsystem, snapshot callable)
+
+    def add(self, metric):
+        metric.name = f'{self.prefix}_{metric.name}'
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.add(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.add(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, buckets, labelnames=()):
+        return self.add(Histogram(name, help_text, buckets, labelnames))
+
+    def collect(self, subsystem, snapshot):
+        """Export the numeric top-level fields of `snapshot()` as gauges."""
+        self._collectors.append((subsystem, snapshot))
+
+    def collected(self):
+        """Numeric collector fields as {metric name: value}."""
+        out = {}
+        for subsystem, snapshot in self._collectors:
+            for field, value in snapshot().items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                out[f'{self.prefix}_{subsystem}_{field}'] = value
+        return out
+
+    def snapshot(self):
+        """JSON-safe state of this process, mergeable into another process's render()."""
+        return {'metrics': {m.name: m.dump() for m in self._metrics}, 'collected': self.collected()}
+
+    def render(self, peers=()):
+        """Exposition text for this process, summed with any peer `snapshot()`s."""
+        lines = []
+        for m in self._metrics:
+            lines.append(f'# HELP {m.name} {m.help}')
+            lines.append(f'# TYPE {m.name} {m.kind}')
+            values = m.merged([p['metrics'].get(m.name, ()) for p in peers])
+            lines.extend(f'{name} {value:g}' if isinstance(value, float) else f'{name} {value}'
+                         for name, value in m.samples(values))
+        collected = self.collected()
+        for peer in peers:
+            for name, value in peer.get('collected', {}).items():
+                collected[name] = collected.get(name, 0) + value
+        for name in collected:
+            if name.endswith('_ratio'):  # ratios average across processes rather than add up
+                collected[name] /= 1 + len(peers)
+        for name, value in collected.items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value:g}' if isinstance(value, float) else f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+class MetricsSpool:
+    """Per-worker metrics snapshots on disk, so any worker can answer /api/metrics for all.
+
+    Every worker rewrites `<directory>/<pid>.json` each `interval` seconds; render()
+    sums this process's live registry with the latest snapshot of every other worker.
+    Disabled (plain single-process render) until start() is called.
+    """
+
+    def __init__(self, registry, directory, interval=METRICS_SPOOL_INTERVAL):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self.enabled = False
+
+    def path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.enabled = True
+        self.publish()
+        threading.Thread(target=self._run, name='metrics-spool', daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.publish()
+
+    def publish(self):
+        path = self.path(os.getpid())
+        try:
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self.registry.snapshot(), f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            LOG.warn('Metrics', f"spool write failed: {e}")
+
+    def peers(self):
+        own = os.path.basename(self.path(os.getpid()))
+        out = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return out
+        for name in names:
+            if not name.endswith('.json') or name == own:
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    out.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return out
+
+    def remove(self, pid):
+        try:
+            os.remove(self.path(pid))
+        except OSError:
+            pass
+
+    def clear(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name.endswith('.json'):
+                self.remove(name[:-len('.json')])
+
+    def render(self):
+        return self.registry.render(self.peers() if self.enabled else ())
+
+def endpoint_label(target_path):
+    """Metrics label for a proxied gateway path (bounded cardinality)."""
+    endpoint = target_path.rsplit('/', 1)[-1]
+    return endpoint if endpoint in KNOWN_PROXY_ENDPOINTS else 'other'
+
+METRICS = MetricsRegistry()
+HTTP_REQUESTS = METRICS.counter('http_requests_total', 'Requests by route, method and status',
+                                ('route', 'method', 'status'))
+METRICS_SPOOL = MetricsSpool(METRICS, os.path.join(CACHE_DIR, 'workers'))
+ACTIVE_CONNECTIONS = METRICS.gauge('active_connections', 'Open client connections')
+ACTIVE_STREAMS = METRICS.gauge('active_streams', 'SSE proxy streams in progress')
+IDLE_RECLAIMED = METRICS.counter('idle_connections_reclaimed_total',
+                                 'Idle keep-alive connections closed to free a connection slot')
+UPSTREAM_TTFB = METRICS.histogram('upstream_ttfb_seconds', 'Gateway time to response headers',
+                                  (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60), ('endpoint',))
+STREAM_DURATION = METRICS.histogram('stream_duration_seconds', 'Proxied response body duration',
+                                    (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300), ('endpoint',))
+STREAM_CHUNK_GAP = METRICS.histogram('stream_chunk_gap_seconds', 'Gap between upstream SSE chunks',
+                                     (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+STATIC_SENDFILE_BYTES = METRICS.counter('static_sendfile_bytes_total',
+                                        'Static body bytes sent with socket.sendfile')
+STATIC_RANGE_REQUESTS = METRICS.counter('static_range_requests_total',
+                                        'Range requests by outcome', ('outcome',))
+ADMISSION_ACTIVE = METRICS.gauge('admission_active', 'Admitted gateway calls in progress', ('class',))
+ADMISSION_QUEUED = METRICS.gauge('admission_queue_depth', 'Gateway calls waiting for a slot', ('class',))
+ADMISSION_WAIT = METRICS.histogram('admission_wait_seconds', 'Time queued before admission',
+                                   (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30), ('class',))
+ADMISSION_REJECTED = METRICS.counter('admission_rejected_total', 'Gateway calls turned away',
+                                     ('class', 'reason'))
+STREAM_BYTES = METRICS.histogram('stream_bytes', 'Bytes relayed per proxied response',
+                                 (1024, 4096, 16384, 65536, 262144, 1048576, 4194304), ('endpoint',))
+
+# --- Upstream connection pool (keep-alive + TLS session reuse to the gateway) ---
+class PooledHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPSConnection that offers a cached TLS session so reconnects skip the full handshake."""
+
+    def __init__(self, *args, tls_session=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tls_session = tls_session
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host,
+                                              session=self.tls_session)
+
+# --- Upstream resilience (adaptive timeouts, retry budget, circuit breaker) ---
+class UpstreamUnavailable(Exception):
+    """The circuit for a gateway host is open; retry after `retry_after` seconds."""
+
+    def __init__(self, host, retry_after):
+        super().__init__(f"{host} is unavailable (circuit open)")
+        self.retry_after = retry_after
+
+class LatencyTracker:
+    """Sliding window of recent TTFB samples per endpoint."""
+
+    def __init__(self, window=UPSTREAM_LATENCY_WINDOW, min_samples=UPSTREAM_LATENCY_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._samples = {}  # endpoint -> deque of seconds
+
+    def observe(self, endpoint, seconds):
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def quantile(self, endpoint, q):
+        """The q-quantile of recent samples, or None until `min_samples` have been seen."""
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def timeout(self, endpoint, default):
+        p99 = self.quantile(endpoint, 0.99)
+        if p99 is None:
+            return default
+        return min(max(p99 * UPSTREAM_TIMEOUT_FACTOR, UPSTREAM_TIMEOUT_MIN), default)
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = list(self._samples)
+        out = {}
+        for endpoint in endpoints:
+            p50, p95 = self.quantile(endpoint, 0.5), self.quantile(endpoint, 0.95)
+            if p50 is not None:
+                out[endpoint] = {"p50_ms": round(p50 * 1000, 1), "p95_ms": round(p95 * 1000, 1)}
+        return out
+
+class RetryBudget:
+    """Token bucket that caps retries and hedges to a fraction of real traffic.
+
+    Every request deposits `ratio` tokens (up to `burst`); each extra attempt spends
+    one, so a failing gateway sees at most ~`ratio` more load, never a retry storm.
+    """
+
+    def __init__(self, ratio=UPSTREAM_RETRY_RATIO, burst=UPSTREAM_RETRY_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.tokens = burst
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.tokens + self.ratio, self.burst)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class CircuitBreaker:
+    """closed -> open after `threshold` consecutive failures -> half-open after `cooldown`.
+
+    While open every call fails fast; half-open lets exactly one probe through, whose
+    outcome closes the circuit again or re-opens it for another cooldown.
+    """
+
+    def __init__(self, host, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if time.monotonic() - self.opened_at >= self.cooldown else 'open'
+
+    def check(self):
+        """Raise UpstreamUnavailable unless a call may go through now."""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.cooldown - (time.monotonic() - self.opened_at)
+            if remaining <= 0 and not self.probing:
+                self.probing = True
+                return
+            raise UpstreamUnavailable(self.host, max(remaining, 1.0))
+
+    def success(self):
+        with self._lock:
+            if self.opened_at is not None:
+                LOG.info('Upstream', f"Circuit for {self.host} closed", host=self.host)
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+                if self.opened_at is None:
+                    self.trips += 1
+                LOG.error('Upstream', f"Circuit for {self.host} open for {self.cooldown:g}s "
+                          f"after {self.failures} failure(s)", host=self.host)
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def abandon(self):
+        """A call that never reached the gateway: no verdict, but free the probe slot."""
+        with self._lock:
+            self.probing = False
+
+class UpstreamPool:
+    """Per-host pool of idle keep-alive connections to the gateway.
+
+    Connections are health-checked when taken out of the pool (a parked socket that
+    is readable has been closed or poisoned by the server) and evicted once idle for
+    longer than `idle_timeout`. TLS sessions are remembered per host, so even a fresh
+    connection usually resumes instead of doing a full handshake.
+    """
+
+    def __init__(self, max_idle_per_host=UPSTREAM_MAX_IDLE_PER_HOST,
+                 idle_timeout=UPSTREAM_IDLE_TIMEOUT, timeout=UPSTREAM_TIMEOUT):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}       # (scheme, host, port) -> [(conn, parked_at), ...]
+        self._sessions = {}   # (scheme, host, port) -> ssl.SSLSession
+        self._ctx = ssl.create_default_context()
+        self._ttfb = {}       # (endpoint, 'reused'|'fresh') -> [count, total_seconds]
+        self._breakers = {}   # (scheme, host, port) -> CircuitBreaker
+        self.latency = LatencyTracker()
+        self.budget = RetryBudget()
+        self.hedge = UPSTREAM_HEDGE
+        self.counters = dict(hits=0, misses=0, handshakes_avoided=0, tls_resumed=0,
+                             evicted_idle=0, failed_health=0, stale_retries=0, discarded=0,
+                             connect_retries=0, retries_denied=0, timeouts=0,
+                             hedges=0, hedge_wins=0, breaker_rejections=0)
+
+    @staticmethod
+    def _key(parsed):
+        https = parsed.scheme == 'https'
+        return (parsed.scheme, parsed.hostname, parsed.port or (443 if https else 80))
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        if scheme == 'https':
+            with self._lock:
+                session = self._sessions.get(key)
+            conn = PooledHTTPSConnection(host, port, context=self._ctx, timeout=self.timeout,
+                                         tls_session=session)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        conn.pool_key = key
+        return conn
+
+    @staticmethod
+    def _healthy(conn):
+        sock = conn.sock
+        if sock is None:
+            return False
+        try:
+            if isinstance(sock, ssl.SSLSocket) and sock.pending():
+                return False
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def acquire(self, parsed):
+        """Return (conn, reused) for the gateway described by a urlparse() result."""
+        key = self._key(parsed)
+        now = time.monotonic()
+        with self._lock:
+            parked = self._idle.get(key, [])
+            while parked:
+                conn, parked_at = parked.pop()
+                if now - parked_at > self.idle_timeout:
+                    self.counters['evicted_idle'] += 1
+                elif self._healthy(conn):
+                    self.counters['hits'] += 1
+                    self.counters['handshakes_avoided'] += 1
+                    return conn, True
+                else:
+                    self.counters['failed_health'] += 1
+                conn.close()
+            self.counters['misses'] += 1
+        return self._new_connection(key), False
+
+    def release(self, conn, reusable=True):
+        """Park a connection whose response has been fully read, or close it."""
+        key = getattr(conn, 'pool_key', None)
+        sock = conn.sock
+        if isinstance(sock, ssl.SSLSocket) and sock.session is not None:
+            with self._lock:
+                self._sessions[key] = sock.session
+        if not reusable or key is None or sock is None:
+            self.discard(conn)
+            return
+        with self._lock:
+            parked = self._idle.setdefault(key, [])
+            now = time.monotonic()
+            fresh = [(c, t) for c, t in parked if now - t <= self.idle_timeout]
+            self.counters['evicted_idle'] += len(parked) - len(fresh)
+            for c, t in parked:
+                if now - t > self.idle_timeout:
+                    c.close()
+            parked[:] = fresh
+            if len(parked) >= self.max_idle_per_host:
+                self.counters['discarded'] += 1
+                conn.close()
+                return
+            parked.append((conn, now))
+
+    def discard(self, conn):
+        with self._lock:
+            self.counters['discarded'] += 1
+        conn.close()
+
+    def breaker(self, key):
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(key[1])
+            return breaker
+
+    def request(self, parsed, method, path, body=None, headers=None, encode_chunked=False,
+                hedge=False):
+        """Send a request over a pooled connection, guarded by the host's circuit breaker.
+
+        `body` may be bytes or an iterable of chunks such as SpooledBody. The wait
+        for response headers is bounded by a timeout learned from recent TTFB; the
+        body is then read with the fixed `timeout`. With `hedge` (bytes bodies only)
+        a second copy is sent if the first has not answered by the endpoint's p95.
+
+        Returns (conn, resp, reused). The caller must read the response and then
+        `release()` (or `discard()`) the connection. Raises UpstreamUnavailable
+        while the circuit is open.
+        """
+        breaker = self.breaker(self._key(parsed))
+        try:
+            breaker.check()
+        except UpstreamUnavailable:
+            with self._lock:
+                self.counters['breaker_rejections'] += 1
+            raise
+        endpoint = path.rsplit('/', 1)[-1]
+        timeout = self.latency.timeout(endpoint, self.timeout)
+        delay = self.latency.quantile(endpoint, 0.95) if hedge and isinstance(body, bytes) else None
+        self.budget.deposit()
+        try:
+            if delay is not None:
+                conn, resp, reused = self._hedged(parsed, method, path, body, headers, timeout, delay)
+            else:
+                conn, resp, reused = self._attempt(parsed, method, path, body, headers,
+                                                   encode_chunked, timeout)
+        except (OSError, http.client.HTTPException) as e:
+            if isinstance(e, TimeoutError):
+                with self._lock:
+                    self.counters['timeouts'] += 1
+            breaker.failure()
+            raise
+        except BaseException:
+            breaker.abandon()
+            raise
+        if resp.status in UPSTREAM_FAILURE_STATUSES:
+            breaker.failure()
+        else:
+            breaker.success()
+        return conn, resp, reused
+
+    def _attempt(self, parsed, method, path, body, headers, encode_chunked, timeout):
+        """One logical attempt: connect failures are retried while the budget allows,
+        and a stale reused socket is retried once fresh."""
+        conn, reused = self.acquire(parsed)
+        retries = 0
+        while True:
+            started = time.monotonic()
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            else:
+                try:
+                    conn.connect()
+                except OSError:
+                    conn.close()
+                    # Nothing has been sent yet, so trying again is always safe
+                    if retries >= UPSTREAM_CONNECT_RETRIES or not self.budget.withdraw():
+                        if retries < UPSTREAM_CONNECT_RETRIES:
+                            with self._lock:
+                                self.counters['retries_denied'] += 1
+                        raise
+                    retries += 1
+                    with self._lock:
+                        self.counters['connect_retries'] += 1
+                    time.sleep(0.05 * 2 ** retries * random.uniform(0.5, 1.5))
+                    conn = self._new_connection(self._key(parsed))
+                    continue
+            try:
+                conn.request(method, path, body=body, headers=headers or {},
+                             encode_chunked=encode_chunked)
+                resp = conn.getresponse()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # A streamed body that already started flowing cannot be replayed
+                if not reused or getattr(body, 'consumed', False):
+                    raise
+                with self._lock:
+                    self.counters['stale_retries'] += 1
+                conn, reused = self._new_connection(self._key(parsed)), False
+            except BaseException:
+                conn.close()
+                raise
+        # Headers are in; the body (an SSE stream in particular) may take much longer
+        conn.timeout = self.timeout
+        conn.sock.settimeout(self.timeout)
+        if isinstance(conn.sock, ssl.SSLSocket) and not reused and conn.sock.session_reused:
+            with self._lock:
+                self.counters['tls_resumed'] += 1
+        self.record_ttfb(path.rsplit('/', 1)[-1], reused, time.monotonic() - started)
+        return conn, resp, reused
+
+    def _hedged(self, parsed, method, path, body, headers, timeout, delay):
+        """Race a second copy of the request against a slow first one; the loser is closed."""
+        results = queue.Queue()
+
+        def run(attempt):
+            try:
+                results.put((attempt, self._attempt(parsed, method, path, body, headers, False, timeout), None))
+            except Exception as e:
+                results.put((attempt, None, e))
+
+        threading.Thread(target=run, args=(0,), name='upstream-primary', daemon=True).start()
+        launched = 1
+        try:
+            outcome = results.get(timeout=delay)
+        except queue.Empty:
+            if self.budget.withdraw():
+                with self._lock:
+                    self.counters['hedges'] += 1
+                threading.Thread(target=run, args=(1,), name='upstream-hedge', daemon=True).start()
+                launched = 2
+            outcome = results.get()
+        pending = launched - 1
+        if outcome[2] is not None and pending:
+            outcome = results.get()
+            pending -= 1
+        if pending:
+            def reap():
+                _, loser, _ = results.get()
+                if loser is not None:
+                    loser[1].close()
+                    self.discard(loser[0])
+            threading.Thread(target=reap, name='upstream-reap', daemon=True).start()
+        attempt, result, error = outcome
+        if error is not None:
+            raise error
+        if attempt == 1:
+            with self._lock:
+                self.counters['hedge_wins'] += 1
+        return result
+
+    def record_ttfb(self, endpoint, reused, seconds):
+        UPSTREAM_TTFB.observe(seconds, endpoint_label(endpoint))
+        self.latency.observe(endpoint, seconds)
+        with self._lock:
+            slot = self._ttfb.setdefault((endpoint, 'reused' if reused else 'fresh'), [0, 0.0])
+            slot[0] += 1
+            slot[1] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            ttfb = {}
+            for (endpoint, kind), (count, total) in self._ttfb.items():
+                ttfb.setdefault(endpoint, {})[kind] = {
+                    "count": count, "avg_ms": round(total / count * 1000, 1)}
+            breakers = {f"{h}:{p}": {"state": b.state, "failures": b.failures, "trips": b.trips}
+                        for (_, h, p), b in self._breakers.items()}
+            open_circuits = sum(1 for b in self._breakers.values() if b.opened_at is not None)
+            counters = dict(self.counters)
+            idle = {f"{h}:{p}": len(conns) for (_, h, p), conns in self._idle.items()}
+        latency = self.latency.snapshot()
+        return {
+            **counters,
+            "retry_budget_tokens": round(self.budget.tokens, 2),
+            "open_circuits": open_circuits,
+            "idle": idle,
+            "ttfb": ttfb,
+            "latency": latency,
+            "timeouts_s": {endpoint: round(self.latency.timeout(endpoint, self.timeout), 1)
+                           for endpoint in latency},
+            "breakers": breakers,
+        }
+
+UPSTREAM_POOL = UpstreamPool()
+
+# Hop-by-hop / framing headers that are never relayed from the gateway
+PROXY_SKIP_HEADERS = {'transfer-encoding', 'connection', 'content-encoding', 'content-length'}
+
+# --- Streaming request bodies (proxy uploads) ---
+class RequestBodyError(Exception):
+    """The client's upload was malformed, cut short or stalled (never an upstream fault)."""
+
+class RequestBodyTooLarge(RequestBodyError):
+    pass
+
+class RequestBody:
+    """Iterates a client request body in bounded chunks as it arrives.
+
+    Handles Content-Length and `Transfer-Encoding: chunked` uploads and raises
+    RequestBodyTooLarge past `limit` bytes, so forwarding a request never holds
+    more than one chunk of it in memory.
+    """
+
+    def __init__(self, rfile, length=None, limit=MAX_BODY_BYTES, chunk_size=BODY_CHUNK):
+        self.rfile = rfile
+        self.length = length  # None means chunked
+        self.limit = limit
+        self.chunk_size = chunk_size
+        self.received = 0
+        self.consumed = False
+        self.complete = length == 0  # whole body read, so the connection can serve another request
+
+    def __iter__(self):
+        pieces = self._fixed() if self.length is not None else self._chunked()
+        while True:
+            try:
+                piece = next(pieces, None)
+            except OSError as e:  # includes the keep-alive socket timeout
+                raise RequestBodyError(f"client upload failed: {e}") from None
+            if piece is None:
+                break
+            self.received += len(piece)
+            if self.received > self.limit:
+                raise RequestBodyTooLarge(f"request body exceeds {self.limit} bytes")
+            self.consumed = True
+            yield piece
+        self.complete = True
+
+    def read_all(self):
+        return b''.join(self)
+
+    def _fixed(self):
+        remaining = self.length
+        while remaining > 0:
+            piece = self.rfile.read1(min(remaining, self.chunk_size))
+            if not piece:
+                raise RequestBodyError("client closed connection mid-body")
+            remaining -= len(piece)
+            yield piece
+
+    def _chunked(self):
+        while True:
+            line = self.rfile.readline(1024)
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise RequestBodyError(f"bad chunk size line {line[:40]!r}")
+            if size == 0:
+                # Skip optional trailer fields up to the blank line
+                while self.rfile.readline(1024) not in (b'\r\n', b'\n', b''):
+                    pass
+                return
+            if self.received + size > self.limit:
+                raise RequestBodyTooLarge(f"request body exceeds {self.limit} bytes")
+            while size > 0:
+                piece = self.rfile.read1(min(size, self.chunk_size))
+                if not piece:
+                    raise RequestBodyError("client closed connection mid-chunk")
+                size -= len(piece)
+                yield piece
+            self.rfile.readline(1024)  # CRLF after chunk data
+
+class SpooledBody:
+    """A RequestBody read to the end up front, then replayed in the same chunks.
+
+    Kept in memory up to `max_memory` bytes and in a temp file beyond that, so a
+    gateway slot is only taken once the upload is done, without holding big uploads
+    in RAM. Has RequestBody's interface, with the length now always known.
+    """
+
+    def __init__(self, body, max_memory=BODY_SPOOL_MEMORY):
+        self.chunk_size = body.chunk_size
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        try:
+            for piece in body:
+                self._file.write(piece)
+        except BaseException:
+            self._file.close()
+            raise
+        self.length = self.received = body.received
+        self.complete = True
+
+    def __iter__(self):
+        self._file.seek(0)
+        return iter(lambda: self._file.read(self.chunk_size), b'')
+
+    def read_all(self):
+        self._file.seek(0)
+        return self._file.read()
+
+    def close(self):
+        self._file.close()
+
+# --- Gateway response cache + single-flight for non-stream endpoints (opt-in) ---
+class CachedResponse:
+    __slots__ = ('status', 'reason', 'headers', 'body', 'stored_at')
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.stored_at = time.monotonic()
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class GatewayResponseCache:
+    """Content-addressed cache of gateway-chat responses with request coalescing.
+
+    The key hashes the endpoint, the caller's Authorization value and the JSON body
+    normalized (sorted keys, no whitespace), so retries, double-clicks and several
+    tabs sending the same prompt share one upstream call. Only 200 responses are
+    stored; concurrent identical requests always wait on the one in flight.
+    """
+
+    def __init__(self, ttl=CHAT_CACHE_TTL, max_entries=CHAT_CACHE_MAX_ENTRIES,
+                 max_response_bytes=CHAT_CACHE_MAX_RESPONSE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_response_bytes = max_response_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.counters = dict(hits=0, misses=0, coalesced=0, stored=0, expired=0, evictions=0)
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    @staticmethod
+    def key(target_path, auth, body):
+        try:
+            normalized = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':')).encode()
+        except ValueError:
+            normalized = body
+        h = hashlib.sha256(target_path.encode())
+        h.update(b'\0' + hashlib.sha256((auth or '').encode()).digest() + b'\0')
+        h.update(normalized)
+        return h.hexdigest()
+
+    def fetch(self, key, loader):
+        """Return (CachedResponse, 'HIT'|'MISS'|'COALESCED'); `loader` runs at most once per key at a time."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if time.monotonic() - entry.stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.counters['hits'] += 1
+                    return entry, 'HIT'
+                del self._entries[key]
+                self.counters['expired'] += 1
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+                self.counters['misses'] += 1
+            else:
+                self.counters['coalesced'] += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, 'COALESCED'
+        try:
+            flight.result = loader()
+            return flight.result, 'MISS'
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                result = flight.result
+                if (result is not None and result.status == 200
+                        and len(result.body) <= self.max_response_bytes):
+                    self._entries[key] = result
+                    self.counters['stored'] += 1
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+                        self.counters['evictions'] += 1
+            flight.done.set()
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.counters, "enabled": self.enabled, "ttl": self.ttl,
+                    "entries": len(self._entries), "in_flight": len(self._inflight)}
+
+CHAT_CACHE = GatewayResponseCache()
+
+# --- Incremental SSE parsing + per-caller token/budget ledger ---
+class SSEParser:
+    """Incremental text/event-stream parser fed the raw chunks the proxy relays.
+
+    Lines are located in place; only a line split across two chunks is copied.
+    `data:` fields are kept only for event types in `capture` (deltas are just
+    counted), so parsing never duplicates the forwarded payload.
+    """
+
+    def __init__(self, capture=('meta', 'done', 'error'), max_data=65536):
+        self.capture = capture
+        self.max_data = max_data
+        self.counts = {}
+        self.last_id = None
+        self._tail = b''
+        self._event = None
+        self._data = []
+        self._data_len = 0
+
+    def feed(self, chunk):
+        """Consume one chunk; return [(event, data_bytes_or_None), ...] completed in it."""
+        done = []
+        pos = 0
+        n = len(chunk)
+        if self._tail:
+            nl = chunk.find(b'\n')
+            if nl == -1:
+                if len(self._tail) < self.max_data:
+                    self._tail += chunk
+                return done
+            self._line(self._tail + chunk[:nl], 0, done)
+            self._tail = b''
+            pos = nl + 1
+        while pos < n:
+            nl = chunk.find(b'\n', pos)
+            if nl == -1:
+                self._tail = bytes(chunk[pos:])
+                break
+            self._line(chunk, pos, done, nl)
+            pos = nl + 1
+        return done
+
+    def _line(self, buf, start, done, end=None):
+        if end is None:
+            end = len(buf)
+        if end > start and buf[end - 1:end] == b'\r':
+            end -= 1
+        if end == start:
+            if self._event is not None or self._data:
+                event = self._event or 'message'
+                self.counts[event] = self.counts.get(event, 0) + 1
+                keep = event in self.capture
+                done.append((event, b'\n'.join(self._data) if keep else None))
+            self._event = None
+            self._data = []
+            self._data_len = 0
+        elif buf.startswith(b'data:', start):
+            if self._event is None or self._event in self.capture:
+                value = buf[start + 5:end]
+                if value[:1] == b' ':
+                    value = value[1:]
+                if self._data_len + len(value) <= self.max_data:
+                    self._data.append(value)
+                    self._data_len += len(value)
+        elif buf.startswith(b'event:', start):
+            self._event = buf[start + 6:end].strip().decode('utf-8', 'replace')
+            if self._event not in self.capture:
+                self._data = []
+                self._data_len = 0
+        elif buf.startswith(b'id:', start):
+            self.last_id = buf[start + 3:end].strip().decode('utf-8', 'replace')
+
+def _client_cookie_mac(session):
+    return hmac.new(CLIENT_COOKIE_KEY, session.encode(), hashlib.sha256).hexdigest()[:16]
+
+def new_client_session():
+    """(session id, CLIENT_COOKIE value) for a browser that has none yet."""
+    session = secrets.token_urlsafe(12)
+    return session, f'{session}.{_client_cookie_mac(session)}'
+
+def client_session(cookie_header):
+    """Session id of a validly signed CLIENT_COOKIE in a Cookie header, else None."""
+    for part in (cookie_header or '').split(';'):
+        name, _, value = part.strip().partition('=')
+        if name == CLIENT_COOKIE:
+            session, _, mac = value.partition('.')
+            if session and hmac.compare_digest(mac, _client_cookie_mac(session)):
+                return session
+    return None
+
+def caller_identity(auth_val, client_address, session=None):
+    """Stable, non-reversible label for whoever is spending tokens.
+
+    A caller's own key identifies it. The server's key is shared by everyone (the
+    IDE fetches it from /api/kaixu-key, and it is injected when a caller sends
+    none), so calls made with it, like calls with no key, are told apart by the
+    browser's session cookie, or by client address when there is none.
+    """
+    who = ('session:' + hashlib.sha256(session.encode()).hexdigest()[:12] if session
+           else client_address[0])
+    if auth_val:
+        label = 'key:' + hashlib.sha256(auth_val.encode()).hexdigest()[:12]
+        if KAIXU_VIRTUAL_KEY and auth_val.partition(' ')[2].strip() == KAIXU_VIRTUAL_KEY:
+            label += '@' + who
+        return label
+    return who if session else 'ip:' + who
+
+class UsageLedger:
+    """Token usage and last reported budget per caller, from proxied gateway traffic."""
+
+    def __init__(self, max_identities=USAGE_MAX_IDENTITIES):
+        self.max_identities = max_identities
+        self._lock = threading.Lock()
+        self._callers = OrderedDict()
+        self.started = time.time()
+
+    def _row(self, identity):
+        row = self._callers.get(identity)
+        if row is None:
+            row = self._callers[identity] = dict(
+                requests=0, streams=0, cached=0, errors=0,
+                input_tokens=0, output_tokens=0, month=None, last_seen=0.0)
+            while len(self._callers) > self.max_identities:
+                self._callers.popitem(last=False)
+        else:
+            self._callers.move_to_end(identity)
+        row['last_seen'] = time.time()
+        return row
+
+    def record(self, identity, stream=False, usage=None, month=None, error=False, cached=False):
+        with self._lock:
+            row = self._row(identity)
+            row['requests'] += 1
+            row['streams'] += stream
+            row['cached'] += cached
+            row['errors'] += error
+            if usage:
+                row['input_tokens'] += int(usage.get('input_tokens') or 0)
+                row['output_tokens'] += int(usage.get('output_tokens') or 0)
+            if month is not None:
+                row['month'] = month
+
+    def record_events(self, identity, events):
+        """Fold a finished stream's captured (event, data) pairs into the ledger."""
+        usage = month = None
+        error = False
+        for event, data in events:
+            try:
+                payload = json.loads(data) if data else {}
+            except ValueError:
+                payload = {}
+            if event == 'done':
+                usage = payload.get('usage') or usage
+            elif event == 'meta' and 'month' in payload:
+                month = payload['month']
+            elif event == 'error':
+                error = True
+        self.record(identity, stream=True, usage=usage, month=month, error=error)
+
+    def record_json(self, identity, body, cached=False):
+        """Account a non-stream gateway-chat response body."""
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = {}
+        if not isinstance(payload, dict):
+            payload = {}
+        self.record(identity, usage=None if cached else payload.get('usage'),
+                    month=payload.get('month'), error='error' in payload, cached=cached)
+
+    def snapshot(self):
+        with self._lock:
+            callers = [{"identity": k, **v} for k, v in self._callers.items()]
+        callers.sort(key=lambda r: r['output_tokens'] + r['input_tokens'], reverse=True)
+        totals = {f: sum(r[f] for r in callers)
+                  for f in ('requests', 'streams', 'cached', 'errors', 'input_tokens', 'output_tokens')}
+        return {"since": self.started, "totals": totals, "callers": callers}
+
+USAGE = UsageLedger()
+
+# --- Admission control + fair queueing for proxied gateway calls ---
+class AdmissionRejected(Exception):
+    def __init__(self, reason, status, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+class _Waiter:
+    __slots__ = ('identity', 'klass', 'event', 'granted', 'since')
+
+    def __init__(self, identity, klass):
+        self.identity = identity
+        self.klass = klass
+        self.event = threading.Event()
+        self.granted = False
+        self.since = time.monotonic()
+
+class AdmissionController:
+    """Concurrency limits for gateway calls, global and per caller, with a fair queue.
+
+    Calls are 'chat' (short, buffered) or 'stream' (long SSE). Streams may fill all
+    but `chat_reserve` slots, so a wall of long generations can't lock chat out.
+    When a slot frees up, queued chat calls go first; within a class callers take
+    turns round-robin, so one runaway client only ever competes with itself.
+    """
+    CLASSES = ('chat', 'stream')
+
+    def __init__(self, max_active=ADMISSION_MAX_ACTIVE, max_per_client=ADMISSION_MAX_PER_CLIENT,
+                 chat_reserve=ADMISSION_CHAT_RESERVE, max_queue=ADMISSION_MAX_QUEUE,
+                 max_queued_per_client=ADMISSION_MAX_QUEUED_PER_CLIENT,
+                 queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.max_active = max_active
+        self.max_per_client = max_per_client
+        self.chat_reserve = chat_reserve
+        self.max_queue = max_queue
+        self.max_queued_per_client = max_queued_per_client
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._active = {}                    # identity -> calls in progress
+        self._running = dict.fromkeys(self.CLASSES, 0)
+        self._queues = {k: OrderedDict() for k in self.CLASSES}  # class -> identity -> deque of _Waiter
+        self._queued = {}                    # identity -> waiters across classes
+        self.counters = dict(admitted=0, queued=0, rejected=0, timed_out=0)
+
+    def _can_run(self, identity, klass):
+        if sum(self._running.values()) >= self.max_active:
+            return False
+        if klass == 'stream' and self._running['stream'] >= self.max_active - self.chat_reserve:
+            return False
+        return self._active.get(identity, 0) < self.max_per_client
+
+    def _grant(self, identity, klass):
+        self._active[identity] = self._active.get(identity, 0) + 1
+        self._running[klass] += 1
+        self.counters['admitted'] += 1
+        ADMISSION_ACTIVE.inc(klass)
+
+    def _reject(self, klass, reason, status, retry_after):
+        self.counters['rejected'] += 1
+        ADMISSION_REJECTED.inc(klass, reason)
+        return AdmissionRejected(reason, status, retry_after)
+
+    def acquire(self, identity, klass):
+        """Block until `identity` may start a `klass` call; raises AdmissionRejected."""
+        with self._lock:
+            # Anything still queued was unrunnable at the last release, so a newcomer
+            # that fits now isn't jumping ahead of anyone who could have gone
+            if self._can_run(identity, klass):
+                self._grant(identity, klass)
+                ADMISSION_WAIT.observe(0.0, klass)
+                return
+            if self._queued.get(identity, 0) >= self.max_queued_per_client:
+                raise self._reject(klass, 'client_queue_full', 429, 5)
+            if sum(self._queued.values()) >= self.max_queue:
+                raise self._reject(klass, 'queue_full', 503, 5)
+            waiter = _Waiter(identity, klass)
+            self._queues[klass].setdefault(identity, deque()).append(waiter)
+            self._queued[identity] = self._queued.get(identity, 0) + 1
+            self.counters['queued'] += 1
+            ADMISSION_QUEUED.inc(klass)
+        waiter.event.wait(self.queue_timeout)
+        with self._lock:
+            if not waiter.granted:
+                waiters = self._queues[klass].get(identity)
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._queues[klass][identity]
+                self._dequeued(identity, klass)
+                self.counters['timed_out'] += 1
+                ADMISSION_WAIT.observe(time.monotonic() - waiter.since, klass)
+                raise self._reject(klass, 'queue_timeout', 503, max(int(self.queue_timeout / 4), 1))
+        ADMISSION_WAIT.observe(time.monotonic() - waiter.since, klass)
+
+    def _dequeued(self, identity, klass):
+        self._queued[identity] -= 1
+        if not self._queued[identity]:
+            del self._queued[identity]
+        ADMISSION_QUEUED.dec(klass)
+
+    def release(self, identity, klass):
+        with self._lock:
+            self._active[identity] -= 1
+            if not self._active[identity]:
+                del self._active[identity]
+            self._running[klass] -= 1
+            ADMISSION_ACTIVE.dec(klass)
+            self._dispatch()
+
+    def _dispatch(self):
+        for klass in self.CLASSES:
+            queues = self._queues[klass]
+            granted = True
+            while granted and queues:
+                granted = False
+                for identity in queues:  # oldest turn first
+                    if not self._can_run(identity, klass):
+                        continue
+                    waiters = queues[identity]
+                    waiter = waiters.popleft()
+                    if waiters:
+                        queues.move_to_end(identity)  # back of the line for its next call
+                    else:
+                        del queues[identity]
+                    self._dequeued(identity, klass)
+                    self._grant(identity, klass)
+                    waiter.granted = True
+                    waiter.event.set()
+                    granted = True
+                    break
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                **self.counters,
+                "running": sum(self._running.values()),
+                "running_chat": self._running['chat'],
+                "running_stream": self._running['stream'],
+                "waiting": sum(self._queued.values()),
+                "clients_active": len(self._active),
+                "max_active": self.max_active,
+                "max_per_client": self.max_per_client,
+            }
+
+ADMISSION = AdmissionController()
+
+# --- Resumable SSE streams (server-side replay buffer) ---
+_SSE_BOUNDARY = re.compile(rb'\r?\n\r?\n')
+
+class ReplayStream:
+    """One gateway SSE response, kept as numbered events a client can resume from."""
+
+    def __init__(self, sid, identity, endpoint, status, headers, lock):
+        self.id = sid
+        self.identity = identity
+        self.endpoint = endpoint
+        self.status = status
+        self.headers = headers
+        self.events = deque()  # (seq, framed event bytes)
+        self.next_seq = 1
+        self.bytes = 0
+        self.pending = b''     # upstream bytes after the last complete event
+        self.done = False
+        self.error = None
+        self.finished_at = None
+        self.subscribers = 0
+        self.cond = threading.Condition(lock)
+
+class ReplayBuffer:
+    """Registry of in-flight and recently finished gateway streams.
+
+    The proxy feeds upstream chunks in; they are cut at event boundaries and every
+    event gets an `id: <stream>:<seq>` line, so a client that reconnects with that
+    Last-Event-ID is sent only what it missed. All streams share one lock (each has
+    its own condition on it). Memory is bounded twice: per stream (oldest events
+    trimmed) and overall (finished streams evicted oldest first, then the biggest
+    running one trimmed). Finished streams are dropped REPLAY_TTL after they end.
+    """
+
+    def __init__(self, max_bytes=REPLAY_MAX_BYTES, stream_max_bytes=REPLAY_STREAM_MAX_BYTES,
+                 ttl=REPLAY_TTL):
+        self.max_bytes = max_bytes
+        self.stream_max_bytes = stream_max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._streams = {}              # id -> ReplayStream
+        self._finished = OrderedDict()  # id -> finished_at (monotonic), oldest first
+        self._bytes = 0
+        self.counters = dict(streams=0, resumes=0, resume_misses=0, detached=0,
+                             evicted=0, expired=0, trimmed_events=0)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def open(self, identity, endpoint, status, headers):
+        with self._lock:
+            self._expire(time.monotonic())
+            stream = ReplayStream(uuid.uuid4().hex, identity, endpoint, status, headers, self._lock)
+            self._streams[stream.id] = stream
+            self.counters['streams'] += 1
+            return stream
+
+    def lookup(self, last_event_id, identity):
+        """(stream, last seq the client has) for a Last-Event-ID header, or (None, 0)."""
+        sid, _, seq = (last_event_id or '').strip().partition(':')
+        with self._lock:
+            self._expire(time.monotonic())
+            stream = self._streams.get(sid)
+            # Stream ids are unguessable, but only the caller who started one may resume it
+            if stream is None or stream.identity != identity or not seq.isdigit():
+                self.counters['resume_misses'] += 1
+                return None, 0
+            self.counters['resumes'] += 1
+            return stream, int(seq)
+
+    def feed(self, stream, chunk):
+        """Add upstream bytes; complete events become resumable immediately."""
+        with self._lock:
+            data = stream.pending + chunk if stream.pending else chunk
+            pos = 0
+            for m in _SSE_BOUNDARY.finditer(data):
+                if m.start() > pos:
+                    self._append(stream, data[pos:m.start()])
+                pos = m.end()
+            stream.pending = bytes(data[pos:])
+            if len(stream.pending) > self.stream_max_bytes:
+                # No event boundary in sight; don't let one runaway event grow unbounded
+                self._append(stream, stream.pending)
+                stream.pending = b''
+            stream.cond.notify_all()
+
+    def _append(self, stream, event):
+        seq = stream.next_seq
+        stream.next_seq += 1
+        framed = b'%s\nid: %s:%d\n\n' % (event, stream.id.encode(), seq)
+        stream.events.append((seq, framed))
+        stream.bytes += len(framed)
+        self._bytes += len(framed)
+        while stream.bytes > self.stream_max_bytes and len(stream.events) > 1:
+            self._trim(stream)
+        if self._bytes > self.max_bytes:
+            self._evict(keep=stream)
+
+    def _trim(self, stream):
+        _, framed = stream.events.popleft()
+        stream.bytes -= len(framed)
+        self._bytes -= len(framed)
+        self.counters['trimmed_events'] += 1
+
+    def _drop(self, sid):
+        stream = self._streams.pop(sid)
+        self._finished.pop(sid, None)
+        self._bytes -= stream.bytes
+        stream.events.clear()
+        stream.bytes = 0
+
+    def _evict(self, keep):
+        # Finished streams go oldest first, but not while a client is still reading one
+        for sid in [sid for sid in self._finished if not self._streams[sid].subscribers]:
+            if self._bytes <= self.max_bytes:
+                break
+            self._drop(sid)
+            self.counters['evicted'] += 1
+        while self._bytes > self.max_bytes:
+            biggest = max(self._streams.values(), key=lambda s: s.bytes)
+            if len(biggest.events) <= (1 if biggest is keep else 0):
+                break
+            self._trim(biggest)
+
+    def _expire(self, now):
+        while self._finished:
+            sid, finished_at = next(iter(self._finished.items()))
+            if now - finished_at < self.ttl:
+                break
+            self._drop(sid)
+            self.counters['expired'] += 1
+
+    def finish(self, stream, error=None):
+        with self._lock:
+            if stream.pending.strip():
+                self._append(stream, stream.pending.rstrip(b'\r\n'))
+            stream.pending = b''
+            stream.done = True
+            stream.error = error
+            stream.finished_at = time.monotonic()
+            if stream.id in self._streams:
+                self._finished[stream.id] = stream.finished_at
+            stream.cond.notify_all()
+
+    def read(self, stream, after, timeout):
+        """Wait up to `timeout` for events past seq `after`.
+
+        Returns (events, last seq, skipped, done): `skipped` counts events that were
+        evicted before this reader got to them.
+        """
+        with self._lock:
+            if not stream.done and (not stream.events or stream.events[-1][0] <= after):
+                stream.cond.wait(timeout)
+            last = stream.next_seq - 1
+            events, skipped = [], 0
+            if stream.events:
+                first = stream.events[0][0]
+                skipped = max(0, first - after - 1)
+                start = max(0, after + 1 - first)
+                events = [framed for _, framed in itertools.islice(stream.events, start, None)]
+                after = max(after, stream.events[-1][0])
+            elif after < last:
+                # Everything past `after` was trimmed, or the whole stream evicted
+                skipped = last - after
+                after = last
+            return events, after, skipped, stream.done and after >= last
+
+    def attach(self, stream):
+        with self._lock:
+            stream.subscribers += 1
+
+    def detach(self, stream, disconnected=False):
+        with self._lock:
+            stream.subscribers -= 1
+            if disconnected:
+                self.counters['detached'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            running = [s for s in self._streams.values() if not s.done]
+            return {**self.counters, "bytes": self._bytes, "buffered": len(self._streams),
+                    "running": len(running),
+                    "orphaned": sum(1 for s in running if s.subscribers == 0)}
+
+REPLAY = ReplayBuffer()
+
+def pump_stream(conn, resp, identity, endpoint, payload_bytes, write, is_stream=True, label=''):
+    """Relay a gateway response body through `write(chunk)` until upstream ends.
+
+    The one copy of the upstream read loop, whether the client is relayed inline or
+    a pump_to_replay thread fills REPLAY: SSE accounting for the usage ledger,
+    per-chunk diagnostics, stream metrics, and handing `conn` back to the pool (or
+    discarding it when reading or `write` fails; the exception propagates).
+    Returns the number of bytes relayed.
+    """
+    sse = SSEParser() if is_stream else None
+    captured = []  # meta/done/error events, for the usage ledger
+    body_buf = []  # small non-stream JSON bodies, for the usage ledger
+    total_bytes = chunk_num = 0
+    stream_start = last_chunk_time = time.time()
+    name = f"SSE stream {label}" if label else "SSE stream"
+    done = False
+    if is_stream:
+        LOG.debug('Proxy', f"{name} started | payload={payload_bytes} bytes | t=0.0s")
+    try:
+        while True:
+            # read1() returns whatever the socket has now; read(n) would wait for n bytes
+            chunk = resp.read1(65536)
+            if not chunk:
+                break
+            chunk_num += 1
+            now = time.time()
+            gap = now - last_chunk_time
+            last_chunk_time = now
+            if is_stream:
+                STREAM_CHUNK_GAP.observe(gap)
+                completed = sse.feed(chunk)
+                captured.extend(e for e in completed if e[1] is not None)
+                if PROXY_DIAG == 'full' or (PROXY_DIAG == 'sample' and (
+                        chunk_num == 1 or chunk_num % PROXY_DIAG_SAMPLE_EVERY == 0)):
+                    evt_label = ','.join(e for e, _ in completed) if completed else '(partial)'
+                    LOG.debug('Proxy', f"chunk#{chunk_num} | {len(chunk)}B | +{gap:.1f}s gap | "
+                                       f"{now - stream_start:.1f}s total | events=[{evt_label}]")
+            elif total_bytes + len(chunk) <= CHAT_CACHE_MAX_RESPONSE:
+                body_buf.append(chunk)
+            write(chunk)
+            total_bytes += len(chunk)
+        done = True
+    finally:
+        stream_elapsed = time.time() - stream_start
+        STREAM_DURATION.observe(stream_elapsed, endpoint)
+        STREAM_BYTES.observe(total_bytes, endpoint)
+        if is_stream:
+            USAGE.record_events(identity, captured)
+            counts = ' '.join(f"{k}={v}" for k, v in sse.counts.items())
+            LOG.debug('Proxy', f"{name} CLOSED {'by upstream' if done else 'early'} | {total_bytes}B total | "
+                               f"{chunk_num} chunks | {stream_elapsed:.1f}s duration | {counts}")
+        elif done and endpoint == 'gateway-chat':
+            USAGE.record_json(identity, b''.join(body_buf))
+        # Only a fully consumed response leaves the socket at a clean request boundary
+        reusable = done and not resp.will_close and (resp.isclosed() or resp.length == 0)
+        resp.close()
+        if done:
+            UPSTREAM_POOL.release(conn, reusable=reusable)
+        else:
+            UPSTREAM_POOL.discard(conn)
+    return total_bytes
+
+def pump_to_replay(stream, conn, resp, identity, klass, endpoint, payload_bytes):
+    """pump_stream a gateway SSE response into REPLAY, client attached or not.
+
+    Runs on its own thread and owns everything the upstream call holds: the pooled
+    connection, the admission slot and the ACTIVE_STREAMS count.
+    """
+    error = None
+    try:
+        pump_stream(conn, resp, identity, endpoint, payload_bytes,
+                    lambda chunk: REPLAY.feed(stream, chunk), label=stream.id)
+    except Exception as e:
+        error = e
+        LOG.warn('Proxy', f"Stream {stream.id} upstream failed: {type(e).__name__}: {e}", endpoint=endpoint)
+    finally:
+        REPLAY.finish(stream, error)
+        ACTIVE_STREAMS.dec()
+        ADMISSION.release(identity, klass)
+
+# --- Static file cache (bounded LRU, content-hash ETags) ---
+class CachedFile:
+    __slots__ = ('body', 'etag', 'mtime', 'mtime_ns', 'size', 'variants')
+
+    def __init__(self, body, st):
+        self.body = body
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        self.mtime = st.st_mtime
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self.variants = {}  # encoding -> compressed body
+
+class StaticCache:
+    """LRU cache of small static files keyed by filesystem path.
+
+    Every lookup stats the file, so an entry is dropped as soon as its mtime or size
+    changes on disk. Total cached bytes never exceed `max_bytes`; files larger than
+    `max_file_bytes` are not cached at all.
+    """
+
+    def __init__(self, max_bytes=STATIC_CACHE_MAX_BYTES, max_file_bytes=STATIC_CACHE_MAX_FILE):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.counters = dict(hits=0, misses=0, invalidations=0, evictions=0, uncacheable=0)
+
+    def get(self, path):
+        """Return a CachedFile for `path`, or None if it is missing or too big to cache."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size > min(self.max_file_bytes, self.max_bytes) or not os.path.isfile(path):
+            with self._lock:
+                self.counters['uncacheable'] += 1
+            return None
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None:
+                if entry.mtime_ns == st.st_mtime_ns and entry.size == st.st_size:
+                    self._entries.move_to_end(path)
+                    self.counters['hits'] += 1
+                    return entry
+                self._drop(path)
+                self.counters['invalidations'] += 1
+            self.counters['misses'] += 1
+        try:
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                body = f.read()
+        except OSError:
+            return None
+        entry = CachedFile(body, st)
+        with self._lock:
+            if path in self._entries:
+                self._drop(path)
+            self._entries[path] = entry
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+                self.counters['evictions'] += 1
+        return entry
+
+    def attach_variant(self, path, entry, encoding, data, replace=False):
+        """Keep a compressed body next to the entry, counted against the memory ceiling.
+        An existing one is only swapped out with `replace`."""
+        with self._lock:
+            old = entry.variants.get(encoding)
+            if self._entries.get(path) is not entry or (old is not None and not replace):
+                return
+            entry.variants[encoding] = data
+            self._bytes += len(data) - len(old or b'')
+
+    def _drop(self, path):
+        entry = self._entries.pop(path)
+        self._bytes -= len(entry.body) + sum(len(v) for v in entry.variants.values())
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return {
+                **self.counters,
+                "hit_ratio": round(self.counters['hits'] / lookups, 4) if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+STATIC_CACHE = StaticCache()
+
+# --- Response compression (gzip/brotli) with an on-disk precompressed store ---
+def available_encodings():
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+def negotiate_encoding(accept_encoding):
+    """Pick the best supported coding from an Accept-Encoding header, or None for identity."""
+    if not accept_encoding:
+        return None
+    prefs = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        prefs[name.strip().lower()] = q
+    best = None
+    for enc in available_encodings():
+        q = prefs.get(enc, prefs.get('*', 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (enc, q)
+    return best[0] if best else None
+
+def is_compressible(ctype):
+    return ctype.startswith(COMPRESSIBLE_TYPES)
+
+def compress(data, encoding, fast=False):
+    """Maximum compression for stored variants; `fast` for a body needed right now."""
+    if encoding == 'br':
+        return brotli.compress(data, quality=5 if fast else 11)
+    return gzip.compress(data, compresslevel=6 if fast else 9, mtime=0)
+
+class PrecompressedStore:
+    """Compressed variants on disk, named by the source's content hash.
+
+    A variant is built once and reused until the source bytes change (which changes
+    the hash), so it survives restarts and can be pre-warmed for the whole workspace.
+    Only maximum-level variants are stored. A request that finds none gets a fast
+    compression to send at once, and the stored one is built by a background thread
+    (which also upgrades the in-memory copy). Files too big for the static cache are
+    served from their sidecar once the background build has made it. The directory
+    is kept under `max_bytes` by removing the least recently used sidecars.
+    """
+    SUFFIX = {'gzip': '.gz', 'br': '.br'}
+
+    def __init__(self, root=os.path.join(CACHE_DIR, 'precompressed'), max_bytes=PRECOMPRESSED_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._disk_bytes = None  # sidecar bytes on disk; None until counted
+        self._files = {}         # big file path -> (mtime_ns, size, digest)
+        self._queue = queue.Queue(COMPRESS_BACKLOG)
+        self._queued = set()     # job keys in the queue or being built
+        self._thread = None
+        self.counters = dict(memory_hits=0, disk_hits=0, built=0, fast_built=0, bytes_saved=0,
+                             deferred=0, backlog_full=0, evicted=0)
+
+    def _path(self, digest, encoding):
+        return os.path.join(self.root, digest[:2], digest + self.SUFFIX[encoding])
+
+    def _load(self, digest, encoding):
+        """Stored variant, or None. A hit marks the sidecar as recently used."""
+        sidecar = self._path(digest, encoding)
+        try:
+            with open(sidecar, 'rb') as f:
+                out = f.read()
+            os.utime(sidecar)
+        except OSError:
+            return None
+        with self._lock:
+            self.counters['disk_hits'] += 1
+        return out
+
+    def _store(self, digest, encoding, out):
+        sidecar = self._path(digest, encoding)
+        try:
+            os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+            tmp = f"{sidecar}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(out)
+            os.replace(tmp, sidecar)
+        except OSError as e:
+            LOG.warn('Compress', f"could not write {sidecar}: {e}")
+            return
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(out)
+            full = self._disk_bytes is None or self._disk_bytes > self.max_bytes
+        if full:
+            self._evict()
+
+    def _evict(self):
+        """Count what is on disk (other workers write here too) and, past `max_bytes`,
+        remove least recently used sidecars down to 90% of it."""
+        files = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        evicted = 0
+        if total > self.max_bytes:
+            files.sort()
+            for _, size, path in files:
+                if total <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                evicted += 1
+        with self._lock:
+            self._disk_bytes = total
+            self.counters['evicted'] += evicted
+
+    def build(self, digest, data, encoding):
+        """Return `data` compressed with `encoding` at the maximum level, building the
+        sidecar if needed."""
+        out = self._load(digest, encoding)
+        if out is not None:
+            return out
+        out = compress(data, encoding)
+        self._store(digest, encoding, out)
+        with self._lock:
+            self.counters['built'] += 1
+            self.counters['bytes_saved'] += max(len(data) - len(out), 0)
+        return out
+
+    def variant(self, path, entry, encoding, cache=None):
+        """Compressed body for a StaticCache (or `cache`) entry, memory first, then disk,
+        else a fast compression while the stored variant is built in the background."""
+        cache = cache or STATIC_CACHE
+        out = entry.variants.get(encoding)
+        if out is not None:
+            with self._lock:
+                self.counters['memory_hits'] += 1
+            return out
+        digest = entry.etag.strip('"')
+        out = self._load(digest, encoding)
+        if out is None:
+            out = compress(entry.body, encoding, fast=True)
+            with self._lock:
+                self.counters['fast_built'] += 1
+
+            def upgrade():
+                cache.attach_variant(path, entry, encoding, self.build(digest, entry.body, encoding),
+                                     replace=True)
+            self._defer((digest, encoding), upgrade)
+        cache.attach_variant(path, entry, encoding, out)
+        return out
+
+    def open_file(self, path, st, encoding):
+        """Open sidecar of a file too big for the static cache, or None after scheduling
+        its build. `st` is the file's current stat."""
+        with self._lock:
+            known = self._files.get(path)
+        if known is not None and known[:2] == (st.st_mtime_ns, st.st_size):
+            sidecar = self._path(known[2], encoding)
+            try:
+                f = open(sidecar, 'rb')
+            except OSError:
+                pass
+            else:
+                try:
+                    os.utime(sidecar)
+                except OSError:
+                    pass
+                with self._lock:
+                    self.counters['disk_hits'] += 1
+                return f
+        self._defer(path, lambda: self._build_file(path))
+        return None
+
+    def _build_file(self, path):
+        try:
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                data = f.read()
+        except OSError:
+            return
+        digest = hashlib.sha256(data).hexdigest()[:32]
+        for enc in available_encodings():
+            self.build(digest, data, enc)
+        with self._lock:
+            self._files[path] = (st.st_mtime_ns, st.st_size, digest)
+
+    def _defer(self, key, job):
+        """Queue a max-level build for the background thread unless it already is."""
+        with self._lock:
+            if key in self._queued:
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='compress', daemon=True)
+                self._thread.start()
+            try:
+                self._queue.put_nowait((key, job))
+            except queue.Full:
+                self.counters['backlog_full'] += 1  # a later request queues it again
+                return
+            self._queued.add(key)
+            self.counters['deferred'] += 1
+
+    def _run(self):
+        while True:
+            key, job = self._queue.get()
+            try:
+                job()
+            except Exception as e:
+                LOG.error('Compress', f"background build failed: {e}")
+            finally:
+                with self._lock:
+                    self._queued.discard(key)
+
+    def prewarm(self, root=WORKSPACE_ROOT, workers=4):
+        """Build every missing variant for compressible files under `root` (and their
+        optimized bodies, with OPTIMIZER enabled) and delete sidecars whose source no
+        longer exists. Returns (files, built)."""
+        built_before = self.counters['built']
+        live = set()
+
+        def keep(digest):
+            live.update(os.path.basename(self._path(digest, enc)) for enc in self.SUFFIX)
+
+        def build(digest, data):
+            keep(digest)
+            for enc in available_encodings():
+                self.build(digest, data, enc)
+
+        def one(path):
+            try:
+                with open(path, 'rb') as f:
+                    st = os.fstat(f.fileno())
+                    data = f.read()
+            except OSError:
+                return
+            digest = hashlib.sha256(data).hexdigest()[:32]
+            build(digest, data)
+            if st.st_size > STATIC_CACHE_MAX_FILE:
+                with self._lock:
+                    self._files[path] = (st.st_mtime_ns, st.st_size, digest)
+            if OPTIMIZER.enabled and OPTIMIZER.handles(path):
+                entry = OPTIMIZER.get(path)
+                if entry is not None and len(entry.body) >= COMPRESS_MIN_BYTES:
+                    build(entry.etag.strip('"'), entry.body)
+
+        # Optimized bodies stored by earlier --optimize runs are sources too
+        for path, _ in iter_workspace_files(OPTIMIZER.cache_dir):
+            try:
+                with open(path, 'rb') as f:
+                    keep(hashlib.sha256(f.read()).hexdigest()[:32])
+            except OSError:
+                continue
+
+        paths = []
+        for path, st in iter_workspace_files(root):
+            ctype = mimetypes.guess_type(path)[0] or ''
+            if is_compressible(ctype) and COMPRESS_MIN_BYTES <= st.st_size <= COMPRESS_MAX_FILE:
+                paths.append(path)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for _ in pool.map(one, paths):
+                pass
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if name not in live:
+                    try:
+                        os.remove(os.path.join(dirpath, name))
+                    except OSError:
+                        pass
+        self._evict()
+        return len(paths), self.counters['built'] - built_before
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.counters, "encodings": list(available_encodings()),
+                    "disk_bytes": self._disk_bytes, "max_bytes": self.max_bytes,
+                    "backlog": self._queue.qsize()}
+
+def skipped_name(name):
+    """Dot files/dirs, node_modules and __pycache__ are not part of the workspace."""
+    return name.startswith('.') or name in ('node_modules', '__pycache__')
+
+def iter_workspace_files(root=WORKSPACE_ROOT):
+    """Yield (path, stat) for every regular file in the workspace, skipping dot-dirs,
+    node_modules and __pycache__."""
+    stack = [root]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if skipped_name(entry.name):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path, entry.stat()
+            except OSError:
+                continue
+
+def file_digest(path):
+    """Content hash of a file, the same one StaticCache puts in its ETags."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            h.update(block)
+    return h.hexdigest()[:32]
+
+PRECOMPRESSED = PrecompressedStore()
+
+# --- Optional asset optimization (minified HTML/CSS/JS, fingerprinted immutable URLs) ---
+_WS = ' \t\r\n\f\v'
+_JS_REGEX_AFTER = set('(,=:[!&|?{};+-*%<>~^')  # a `/` after these starts a regex literal
+_JS_REGEX_KEYWORDS = {'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void',
+                      'throw', 'case', 'do', 'else', 'yield', 'await'}
+_JS_TYPES = ('', 'text/javascript', 'application/javascript', 'module', 'text/ecmascript')
+
+def minify_js(src):
+    """Strip comments and indentation from a script.
+
+    Deliberately conservative: every line break is kept (so automatic semicolon
+    insertion is unaffected) and only indentation, trailing blanks, empty lines and
+    comments go; spaces inside a line are left alone, so even a regex literal taken
+    for a division survives. String, template and regex literals pass through byte
+    for byte. Returns `src` unchanged when it can't be tokenized with confidence.
+    """
+    out = []
+    n = len(src)
+    i = 0
+    prev = ''     # last significant token, to tell a regex literal from a division
+    depth = 0     # brace depth
+    stack = []    # brace depth at each open `${` of a template literal
+
+    def space(run):
+        if not out or out[-1] == '\n':
+            return  # indentation
+        if out[-1].isspace():
+            if '\n' not in run:
+                return
+            out.pop()  # trailing blanks
+        out.append('\n' if '\n' in run else run)
+
+    while i < n:
+        c = src[i]
+        if c in _WS:
+            j = i
+            while j < n and src[j] in _WS:
+                j += 1
+            space(src[i:j])
+            i = j
+        elif c == '/' and src.startswith('//', i):
+            j = src.find('\n', i)
+            i = n if j == -1 else j
+        elif c == '/' and src.startswith('/*', i):
+            j = src.find('*/', i + 2)
+            if j == -1:
+                return src
+            space('\n' if '\n' in src[i:j] else ' ')
+            i = j + 2
+        elif c in '"\'':
+            j = i + 1
+            while True:
+                if j >= n or src[j] == '\n':
+                    return src
+                if src[j] == '\\':
+                    j += 2
+                    continue
+                j += 1
+                if src[j - 1] == c:
+                    break
+            out.append(src[i:j])
+            prev = '"'
+            i = j
+        elif c == '`' or (c == '}' and stack and depth == stack[-1]):
+            if c == '}':
+                stack.pop()
+            j = i + 1
+            while True:
+                if j >= n:
+                    return src
+                if src[j] == '\\':
+                    j += 2
+                    continue
+                if src[j] == '`':
+                    j += 1
+                    prev = '"'
+                    break
+                if src.startswith('${', j):
+                    j += 2
+                    stack.append(depth)
+                    prev = '('
+                    break
+                j += 1
+            out.append(src[i:j])
+            i = j
+        elif c == '/' and (prev == '' or prev in _JS_REGEX_AFTER or prev in _JS_REGEX_KEYWORDS):
+            j = i + 1
+            in_class = False
+            while True:
+                if j >= n or src[j] == '\n':
+                    return src
+                ch = src[j]
+                if ch == '\\':
+                    j += 2
+                    continue
+                j += 1
+                if ch == '[':
+                    in_class = True
+                elif ch == ']':
+                    in_class = False
+                elif ch == '/' and not in_class:
+                    break
+            while j < n and (src[j].isalnum() or src[j] in '_$'):
+                j += 1  # flags
+            out.append(src[i:j])
+            prev = ')'
+            i = j
+        elif c.isalnum() or c in '_$' or ord(c) > 127:
+            j = i
+            while j < n and (src[j].isalnum() or src[j] in '_$' or ord(src[j]) > 127):
+                j += 1
+            word = src[i:j]
+            out.append(word)
+            prev = word if word in _JS_REGEX_KEYWORDS else 'a'
+            i = j
+        else:
+            if c == '{':
+                depth += 1
+            elif c == '}':
+                depth -= 1
+            out.append(c)
+            prev = c
+            i += 1
+    if stack:
+        return src
+    return ''.join(out).strip()
+
+def minify_css(src):
+    """Drop comments and collapse whitespace in a stylesheet.
+
+    Spaces go only where they can't matter (next to `{ } ; ,`, after `:` and `(`,
+    before `)`); combinators and calc() operators keep theirs. Strings are kept
+    verbatim. Returns `src` unchanged on an unterminated comment or string.
+    """
+    out = []
+    n = len(src)
+    i = 0
+    pending = False  # whitespace seen since the last token
+    while i < n:
+        c = src[i]
+        if c in _WS:
+            pending = True
+            i += 1
+            continue
+        if c == '/' and src.startswith('/*', i):
+            j = src.find('*/', i + 2)
+            if j == -1:
+                return src
+            pending = True
+            i = j + 2
+            continue
+        if c in '"\'':
+            j = i + 1
+            while True:
+                if j >= n or src[j] == '\n':
+                    return src
+                if src[j] == '\\':
+                    j += 2
+                    continue
+                j += 1
+                if src[j - 1] == c:
+                    break
+            token = src[i:j]
+            i = j
+        else:
+            token = c
+            i += 1
+        if pending and out and out[-1][-1] not in '{};,:(' and token[0] not in '{};,)':
+            out.append(' ')
+        pending = False
+        if token == '}' and out and out[-1] == ';':
+            out.pop()
+        out.append(token)
+    return ''.join(out)
+
+_HTML_TOKEN = re.compile(r'''<!--.*?-->|<(script|style|pre|textarea)\b(?:[^>"']|"[^"]*"|'[^']*')*>.*?</\1\s*>'''
+                         r'''|<[a-zA-Z/!?](?:[^>"']|"[^"]*"|'[^']*')*>''', re.S | re.I)
+_HTML_URL_ATTR = re.compile(r'''(\s(?:src|href)\s*=\s*)(?:"([^"]*)"|'([^']*)')''', re.I)
+_HTML_TAG_NAME = re.compile(r'<([a-zA-Z][a-zA-Z0-9-]*)')
+_HTML_ATTR = r'''\s%s\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))'''
+_CSS_URL = re.compile(r'''url\(\s*(?:"([^"]*)"|'([^']*)'|([^'")\s]+))\s*\)''', re.I)
+_LINK_RELS = {'stylesheet', 'icon', 'shortcut', 'apple-touch-icon', 'preload', 'modulepreload',
+              'mask-icon'}
+_SCHEME = re.compile(r'^[a-zA-Z][a-zA-Z0-9+.-]*:')
+_FINGERPRINTED = re.compile(r'^(.+)\.([0-9a-f]{%d})(\.[A-Za-z0-9]+)$' % FINGERPRINT_LEN)
+
+def _html_attr(tag, name):
+    m = re.search(_HTML_ATTR % name, tag, re.I)
+    return next((g for g in m.groups() if g is not None), '') if m else None
+
+def _css_pass(text, rewrite, minify):
+    if minify:
+        text = minify_css(text)
+
+    def url(m):
+        ref = next(g for g in m.groups() if g is not None)
+        new = rewrite(ref)
+        return m.group(0) if new == ref else f'url("{new}")'
+    return _CSS_URL.sub(url, text)
+
+def _between_tags(text):
+    """Minified form of text between two tokens. Only indentation-style whitespace
+    (a run containing a line break, with nothing else) is collapsed: text content is
+    left alone, since CSS white-space: pre/pre-wrap can make any of it significant."""
+    return '\n' if text and not text.strip() and '\n' in text else text
+
+def _html_pass(text, rewrite, minify):
+    """Rewrite asset URLs in an HTML document (and minify it) in one scan."""
+    out = []
+    pos = 0
+    for m in _HTML_TOKEN.finditer(text):
+        between = text[pos:m.start()]
+        pos = m.end()
+        out.append(_between_tags(between) if minify else between)
+        token = m.group(0)
+        if token.startswith('<!--'):
+            # Conditional comments and <!--! ... --> are kept
+            if not minify or token.startswith(('<!--[if', '<!--!', '<!--<!')):
+                out.append(token)
+            continue
+        raw = (m.group(1) or '').lower()
+        if raw in ('pre', 'textarea'):
+            out.append(token)
+            continue
+        split = _open_tag_end(token) if raw else len(token)
+        open_tag, body = token[:split], token[split:]
+        tag = _HTML_TAG_NAME.match(open_tag)
+        name = tag.group(1).lower() if tag else ''
+        if name in ('script', 'img', 'source', 'link', 'audio', 'video', 'track', 'embed'):
+            if name != 'link' or set((_html_attr(open_tag, 'rel') or '').lower().split()) & _LINK_RELS:
+                open_tag = _HTML_URL_ATTR.sub(lambda a: _rewrite_attr(a, rewrite), open_tag)
+        if raw == 'style':
+            close = body.rindex('</')
+            body = _css_pass(body[:close], rewrite, minify) + body[close:]
+        elif raw == 'script' and minify:
+            kind = (_html_attr(open_tag, 'type') or '').strip().lower()
+            if kind in _JS_TYPES and _html_attr(open_tag, 'src') is None:
+                close = body.rindex('</')
+                body = minify_js(body[:close]) + body[close:]
+        out.append(open_tag + body)
+    tail = text[pos:]
+    out.append(_between_tags(tail) if minify else tail)
+    return ''.join(out).strip() + '\n' if minify else ''.join(out)
+
+def _rewrite_attr(m, rewrite):
+    ref = m.group(2) if m.group(2) is not None else m.group(3)
+    new = rewrite(ref)
+    return m.group(0) if new == ref else f'{m.group(1)}"{new}"'
+
+def _open_tag_end(token):
+    """Index just past the `>` closing the opening tag of a raw element (quote-aware)."""
+    quote = None
+    for i, ch in enumerate(token):
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in '"\'':
+            quote = ch
+        elif ch == '>':
+            return i + 1
+    return len(token)
+
+class OptimizedAsset:
+    __slots__ = ('entry', 'mtime_ns', 'size', 'deps')
+
+    def __init__(self, entry, st, deps):
+        self.entry = entry        # CachedFile holding the optimized body
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self.deps = deps          # referenced file -> fingerprint baked into the body
+
+class AssetOptimizer:
+    """Minified HTML/CSS/JS with local asset references rewritten to fingerprinted URLs.
+
+    `style.css` referenced from a page becomes `style.<hash>.css`, where the hash is
+    that of the bytes the server would send for it, so the URL can be cached forever
+    (IMMUTABLE_CACHE_CONTROL) and changes whenever the file does. Outputs are stored
+    on disk under a key of the source hash plus the fingerprints of everything it
+    references, so after a restart or an edit only changed inputs (and the pages
+    pointing at them) are rebuilt. Built outputs are also kept in a bounded LRU.
+    """
+    KINDS = {'.html': 'html', '.htm': 'html', '.css': 'css', '.js': 'js', '.mjs': 'js'}
+
+    def __init__(self, root=WORKSPACE_ROOT, cache_dir=os.path.join(CACHE_DIR, 'optimized'),
+                 max_bytes=OPTIMIZE_CACHE_MAX_BYTES):
+        self.root = os.path.realpath(root)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.enabled = OPTIMIZE
+        self._lock = threading.Lock()
+        self._assets = OrderedDict()  # path -> OptimizedAsset
+        self._bytes = 0
+        self._hashes = {}             # path -> (mtime_ns, size, fingerprint) of plain files
+        self._building = threading.local()
+        self.counters = dict(builds=0, disk_hits=0, memory_hits=0, bytes_in=0, bytes_out=0,
+                             fingerprinted=0, stale_fingerprints=0)
+
+    def handles(self, path):
+        return os.path.splitext(path)[1].lower() in self.KINDS
+
+    def fingerprint(self, path):
+        """Hash of what a request for `path` would return (optimized body if any)."""
+        if self.handles(path):
+            entry = self.get(path)
+            if entry is not None:
+                return entry.etag.strip('"')[:FINGERPRINT_LEN]
+        st = os.stat(path)
+        with self._lock:
+            known = self._hashes.get(path)
+        if known and known[:2] == (st.st_mtime_ns, st.st_size):
+            return known[2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                h.update(block)
+        digest = h.hexdigest()[:FINGERPRINT_LEN]
+        with self._lock:
+            self._hashes[path] = (st.st_mtime_ns, st.st_size, digest)
+        return digest
+
+    def unfingerprint(self, path):
+        """Source file of `name.<hash>.ext`, or None unless `<hash>` is its current fingerprint."""
+        m = _FINGERPRINTED.match(os.path.basename(path))
+        if m is None:
+            return None
+        source = os.path.join(os.path.dirname(path), m.group(1) + m.group(3))
+        if not self.fingerprintable(source):
+            return None
+        try:
+            fresh = self.fingerprint(source) == m.group(2)
+        except OSError:
+            return None
+        with self._lock:
+            self.counters['fingerprinted' if fresh else 'stale_fingerprints'] += 1
+        return source if fresh else None
+
+    def fingerprintable(self, path):
+        """Whether references to `path` get fingerprinted. Pages never do: their URLs are
+        what people bookmark, and they can't be cached as immutable anyway."""
+        name = os.path.basename(path).lower()
+        return (os.path.realpath(path).startswith(self.root + os.sep) and os.path.isfile(path)
+                and not name.endswith(('.html', '.htm', '.webmanifest')) and name != 'manifest.json'
+                and name not in PRECACHE_SKIP_NAMES and bool(os.path.splitext(name)[1]))
+
+    def _resolve(self, ref, base_dir):
+        """Workspace file a local asset reference points at, or None to leave it alone."""
+        ref = ref.strip()
+        if (not ref or ref.startswith(('#', '//')) or _SCHEME.match(ref) or '?' in ref
+                or '{' in ref or '#' in ref):
+            return None
+        rel = urllib.parse.unquote(ref)
+        path = os.path.normpath(os.path.join(self.root, rel.lstrip('/')) if rel.startswith('/')
+                                else os.path.join(base_dir, rel))
+        return path if self.fingerprintable(path) else None
+
+    def get(self, path):
+        """CachedFile with the optimized body of an HTML/CSS/JS file, or None to serve it as is."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size > STATIC_CACHE_MAX_FILE:
+            return None
+        building = self._building.__dict__.setdefault('paths', set())
+        if path in building:
+            return None  # reference cycle (e.g. CSS importing itself): fingerprint it as a plain file
+        with self._lock:
+            asset = self._assets.get(path)
+        if asset is not None and (asset.mtime_ns, asset.size) == (st.st_mtime_ns, st.st_size):
+            building.add(path)
+            try:
+                current = all(self._safe_fingerprint(dep) == fp for dep, fp in asset.deps.items())
+            finally:
+                building.discard(path)
+            if current:
+                with self._lock:
+                    if path in self._assets:
+                        self._assets.move_to_end(path)
+                    self.counters['memory_hits'] += 1
+                return asset.entry
+        building.add(path)
+        try:
+            return self._build(path)
+        except (OSError, ValueError) as e:
+            LOG.warn('Optimize', f"could not optimize {path}: {e}")
+            return None
+        finally:
+            building.discard(path)
+
+    def _safe_fingerprint(self, path):
+        try:
+            return self.fingerprint(path)
+        except OSError:
+            return None
+
+    def _build(self, path):
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            raw = f.read()
+        kind = self.KINDS[os.path.splitext(path)[1].lower()]
+        text = raw.decode('utf-8')
+        base_dir = os.path.dirname(path)
+
+        # Pass 1 finds the references, so the cache key is known before any minifying
+        mapping, deps = {}, {}
+
+        def collect(ref):
+            if ref not in mapping:
+                target = self._resolve(ref, base_dir)
+                fp = self._safe_fingerprint(target) if target else None
+                if fp is None:
+                    mapping[ref] = ref
+                else:
+                    stem, ext = posixpath.splitext(ref.strip())
+                    mapping[ref] = f'{stem}.{fp}{ext}'
+                    deps[target] = fp
+            return ref
+
+        if kind == 'html':
+            _html_pass(text, collect, minify=False)
+        elif kind == 'css':
+            _css_pass(text, collect, minify=False)
+        key = hashlib.sha256(json.dumps([OPTIMIZE_VERSION, hashlib.sha256(raw).hexdigest(),
+                                         sorted(mapping.items())]).encode()).hexdigest()
+        cached = os.path.join(self.cache_dir, key[:2], key + os.path.splitext(path)[1].lower())
+        try:
+            with open(cached, 'rb') as f:
+                body = f.read()
+            with self._lock:
+                self.counters['disk_hits'] += 1
+        except OSError:
+            rewrite = lambda ref: mapping.get(ref, ref)
+            if kind == 'html':
+                out = _html_pass(text, rewrite, minify=True)
+            elif kind == 'css':
+                out = _css_pass(text, rewrite, minify=True)
+            else:
+                out = minify_js(text)
+            body = out.encode('utf-8')
+            if len(body) >= len(raw) and not deps:
+                body = raw  # nothing gained
+            try:
+                os.makedirs(os.path.dirname(cached), exist_ok=True)
+                tmp = f"{cached}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp, 'wb') as f:
+                    f.write(body)
+                os.replace(tmp, cached)
+            except OSError as e:
+                LOG.warn('Optimize', f"could not write {cached}: {e}")
+            with self._lock:
+                self.counters['builds'] += 1
+                self.counters['bytes_in'] += len(raw)
+                self.counters['bytes_out'] += len(body)
+        entry = CachedFile(body, st)
+        with self._lock:
+            old = self._assets.pop(path, None)
+            if old is not None:
+                self._bytes -= len(old.entry.body) + sum(len(v) for v in old.entry.variants.values())
+            self._assets[path] = OptimizedAsset(entry, st, deps)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes and len(self._assets) > 1:
+                _, dropped = self._assets.popitem(last=False)
+                self._bytes -= len(dropped.entry.body) + sum(len(v) for v in dropped.entry.variants.values())
+        return entry
+
+    def attach_variant(self, path, entry, encoding, data, replace=False):
+        """Keep a compressed body with the optimized entry (see PrecompressedStore.variant)."""
+        with self._lock:
+            asset = self._assets.get(path)
+            old = entry.variants.get(encoding)
+            if asset is None or asset.entry is not entry or (old is not None and not replace):
+                return
+            entry.variants[encoding] = data
+            self._bytes += len(data) - len(old or b'')
+
+    def snapshot(self):
+        with self._lock:
+            saved = self.counters['bytes_in'] - self.counters['bytes_out']
+            return {**self.counters, "enabled": self.enabled, "entries": len(self._assets),
+                    "bytes": self._bytes, "saved_ratio": round(saved / self.counters['bytes_in'], 4)
+                    if self.counters['bytes_in'] else 0.0}
+
+OPTIMIZER = AssetOptimizer()
+
+# --- Byte ranges + zero-copy file bodies ---
+class FileSlices:
+    """Response body made of byte ranges of a seekable file, sent with socket.sendfile().
+
+    `parts` is a list of (preamble, offset, count); preambles carry multipart framing.
+    socket.sendfile() uses os.sendfile for real files and falls back to bounded
+    reads for in-memory buffers, so memory stays flat regardless of file size.
+    """
+
+    def __init__(self, f, parts, trailer=b''):
+        self.f = f
+        self.parts = parts
+        self.trailer = trailer
+
+    def close(self):
+        self.f.close()
+
+def parse_range(header, size):
+    """Parse a `bytes=` Range header into merged (start, end) pairs (inclusive).
+
+    Returns None when the header should be ignored (bad syntax, too many ranges) and
+    [] when no range is satisfiable.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+    ranges = []
+    for part in spec.split(','):
+        first, sep, last = part.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first == '':
+                if not last:
+                    return None
+                start, end = max(size - int(last), 0), size - 1
+            else:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+        except ValueError:
+            return None
+        if start < 0 or (last and first and int(last) < start):
+            return None
+        if start <= end and start < size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+# --- Workspace change polling + project catalog for /api/fs/projects ---
+class Inotify:
+    """Recursive inotify watch of the workspace tree through libc (Linux only).
+
+    Every directory the workspace walk would enter gets a watch, and new ones are
+    added as they appear. `read()` turns the kernel's events into the set of paths
+    that need a rescan: files that changed, plus directories that appeared, moved or
+    went away. Raises OSError when inotify is missing or out of watches.
+    """
+    IN_MODIFY, IN_ATTRIB = 0x2, 0x4
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_DELETE_SELF, IN_MOVE_SELF = 0x400, 0x800
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+    IN_ONLYDIR, IN_DONT_FOLLOW = 0x01000000, 0x02000000
+    IN_NONBLOCK, IN_CLOEXEC = 0o4000, 0o2000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+            | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, name length; the name follows
+    READ_SIZE = 256 * 1024
+
+    def __init__(self, root):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify is Linux-only")
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        except (OSError, AttributeError) as e:
+            raise OSError(errno.ENOSYS, f"inotify not available: {e}") from None
+        self._libc = libc
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, f"inotify_init1: {os.strerror(err)}")
+        self._dirs = {}  # wd -> directory
+        self._wds = {}   # directory -> wd
+        try:
+            self.add_tree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, top):
+        """Watch `top` and every workspace directory under it."""
+        stack = [top]
+        while stack:
+            path = stack.pop()
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOSPC, errno.ENOMEM):
+                    raise OSError(err, "inotify watch limit reached (fs.inotify.max_user_watches)", path)
+                continue  # gone already, or unreadable: its parent's events still cover it
+            self._dirs[wd] = path
+            self._wds[path] = wd
+            try:
+                entries = list(os.scandir(path))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if not skipped_name(entry.name) and entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                except OSError:
+                    continue
+
+    def _forget(self, path):
+        """Drop the watches on `path` and below (it moved away or was deleted)."""
+        prefix = path + os.sep
+        for directory in [d for d in self._wds if d == path or d.startswith(prefix)]:
+            wd = self._wds.pop(directory)
+            del self._dirs[wd]
+            self._libc.inotify_rm_watch(self.fd, wd)  # EINVAL if the kernel dropped it already
+
+    def read(self, timeout=None):
+        """Wait up to `timeout` seconds (None: forever) for events: (paths, overflowed)."""
+        paths, overflowed = set(), False
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return paths, overflowed
+        try:
+            buf = os.read(self.fd, self.READ_SIZE)
+        except BlockingIOError:
+            return paths, overflowed
+        offset = 0
+        while offset < len(buf):
+            wd, mask, _, length = self.EVENT.unpack_from(buf, offset)
+            name = buf[offset + self.EVENT.size:offset + self.EVENT.size + length].split(b'\0', 1)[0]
+            offset += self.EVENT.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & self.IN_IGNORED:
+                del self._dirs[wd]
+                if self._wds.get(directory) == wd:
+                    del self._wds[directory]
+                continue
+            if not name:  # the watched directory itself
+                if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                    self._forget(directory)
+                    paths.add(directory)
+                continue
+            name = os.fsdecode(name)
+            if skipped_name(name):
+                continue
+            path = os.path.join(directory, name)
+            if mask & self.IN_ISDIR:
+                if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    self.add_tree(path)
+                elif mask & (self.IN_MOVED_FROM | self.IN_DELETE):
+                    self._forget(path)
+            paths.add(path)
+        return paths, overflowed
+
+    @property
+    def watches(self):
+        return len(self._dirs)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+class WorkspacePoller:
+    """Tracks mtimes/sizes of every workspace file and tells listeners what changed.
+
+    Listeners are called as `fn(changes)` after every poll, with `changes` a list of
+    (path, kind) tuples, kind being 'created', 'modified' or 'deleted'. The first
+    poll reports every file as created.
+
+    On Linux the tree is watched with inotify: a burst of events is collected until
+    it has been quiet for `debounce` seconds (or `max_delay` after it began), then only
+    the paths it touched are rescanned. A save that writes a temp file, renames it
+    and fixes permissions therefore reaches listeners as one 'modified'. Elsewhere,
+    with watch='poll', or if inotify fails, the whole tree is polled every `interval`.
+    """
+
+    def __init__(self, root=WORKSPACE_ROOT, interval=WORKSPACE_POLL_INTERVAL, watch=WORKSPACE_WATCH):
+        self.root = root
+        self.interval = interval
+        self.watch = watch
+        self.debounce = WATCH_DEBOUNCE
+        self.max_delay = WATCH_MAX_DELAY
+        self.backend = None  # 'inotify' or 'poll' once started
+        self.listeners = []
+        self.counters = dict(polls=0, rescans=0, changes=0, overflows=0, fallbacks=0)
+        self._snapshot = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._inotify = None
+
+    def subscribe(self, fn):
+        self.listeners.append(fn)
+
+    def poll(self, paths=None):
+        """Rescan the tree, or just `paths` (files or directories), and notify listeners."""
+        with self._lock:
+            if paths is None:
+                current = {path: (st.st_mtime_ns, st.st_size) for path, st in iter_workspace_files(self.root)}
+                previous, self._snapshot = self._snapshot, current
+                self.counters['polls'] += 1
+            else:
+                previous, current = self._rescan(paths)
+                self.counters['rescans'] += 1
+            changes = [(p, 'created' if p not in previous else 'modified')
+                       for p, sig in current.items() if previous.get(p) != sig]
+            changes += [(p, 'deleted') for p in previous if p not in current]
+            self.counters['changes'] += len(changes)
+        for fn in self.listeners:
+            try:
+                fn(changes)
+            except Exception as e:
+                LOG.error('Watch', f"listener {getattr(fn, '__qualname__', fn)} failed: {e}")
+        return changes
+
+    def _rescan(self, paths):
+        """(previous, current) signatures at or under `paths`; folds current into the snapshot."""
+        snapshot = self._snapshot
+        previous, current = {}, {}
+        for path in paths:
+            is_dir = os.path.isdir(path) and not os.path.islink(path)
+            if path in snapshot:
+                previous[path] = snapshot[path]
+            if is_dir or path not in snapshot:
+                # A directory (now or before): everything known under it is in scope
+                prefix = path + os.sep
+                previous.update((p, sig) for p, sig in snapshot.items() if p.startswith(prefix))
+            if is_dir:
+                current.update((p, (st.st_mtime_ns, st.st_size)) for p, st in iter_workspace_files(path))
+            else:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if os.path.isfile(path):
+                    current[path] = (st.st_mtime_ns, st.st_size)
+        for p in previous:
+            if p not in current:
+                del snapshot[p]
+        snapshot.update(current)
+        return previous, current
+
+    def start(self):
+        if self._thread is None:
+            if self.watch != 'poll':
+                try:
+                    self._inotify = Inotify(self.root)
+                except OSError as e:
+                    LOG.warn('Watch', f"inotify unavailable ({e}); polling every {self.interval}s")
+            self.backend = 'inotify' if self._inotify else 'poll'
+            if self._inotify:
+                LOG.info('Watch', f"Watching {self._inotify.watches} directories with inotify")
+            self._thread = threading.Thread(target=self._run, name='workspace-watcher', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        if self._inotify is not None:
+            try:
+                self._watch()
+            except OSError as e:
+                LOG.warn('Watch', f"inotify failed ({e}); polling every {self.interval}s")
+                self._inotify.close()
+                self._inotify = None
+                self.backend = 'poll'
+                self.counters['fallbacks'] += 1
+                self.poll()
+        while True:
+            time.sleep(self.interval)
+            self.poll()
+
+    def _watch(self):
+        inotify = self._inotify
+        self.poll()  # anything that changed while the watches were being added
+        while True:
+            paths, overflowed = inotify.read()
+            deadline = time.monotonic() + self.max_delay
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                more, more_overflowed = inotify.read(min(self.debounce, remaining))
+                if not more and not more_overflowed:
+                    break
+                paths |= more
+                overflowed |= more_overflowed
+            if overflowed:
+                # The kernel queue filled up and events were lost: only a full pass is exact
+                self.counters['overflows'] += 1
+                self.poll()
+            elif paths:
+                self.poll(paths)
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.counters, "backend": self.backend, "files": len(self._snapshot),
+                    "watches": self._inotify.watches if self._inotify else 0}
+
+class ProjectIndex:
+    """In-memory catalog of top-level workspace projects, kept current by WorkspacePoller.
+
+    The unfiltered listing is serialized once per change, so the sidebar's request
+    is a dictionary lookup; paging/filtering works over the precomputed entries.
+    """
+    MARKERS = {
+        'has_index': ('index.html',),
+        'has_manifest': ('manifest.json', 'manifest.webmanifest'),
+        'has_sw': ('sw.js',),
+        'has_netlify_toml': ('netlify.toml',),
+    }
+    SORT_KEYS = {
+        'name': lambda p: p['name'].lower(),
+        'modified': lambda p: p['last_modified'],
+        'size': lambda p: p['total_bytes'],
+        'files': lambda p: p['file_count'],
+    }
+
+    def __init__(self, poller):
+        self.poller = poller
+        self._lock = threading.Lock()
+        self._files = {}     # project name -> {relpath: (mtime_ns, size)}
+        self._projects = []  # sorted list of project dicts
+        self._payload = None
+        self.variants = {}   # encoding -> compressed payload, reset with the payload
+        self._ready = threading.Event()
+        poller.subscribe(self.apply)
+
+    def apply(self, changes):
+        root = self.poller.root
+        with self._lock:
+            dirty = set()
+            try:
+                names = {e.name for e in os.scandir(root)
+                         if e.is_dir() and not e.name.startswith('.') and e.name != 'node_modules'}
+            except OSError as e:
+                LOG.error('Projects', f"Error listing projects: {e}")
+                names = set(self._files)
+            for gone in set(self._files) - names:
+                del self._files[gone]
+                dirty.add(gone)
+            for name in names - set(self._files):
+                self._files[name] = {}
+                dirty.add(name)
+            for path, kind in changes:
+                rel = os.path.relpath(path, root)
+                name, sep, inner = rel.partition(os.sep)
+                if not sep or name not in self._files:
+                    continue
+                if kind == 'deleted':
+                    self._files[name].pop(inner, None)
+                else:
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        self._files[name].pop(inner, None)
+                    else:
+                        self._files[name][inner] = (st.st_mtime_ns, st.st_size)
+                dirty.add(name)
+            if dirty or self._payload is None:
+                self._projects = sorted((self._describe(n, f) for n, f in self._files.items()),
+                                        key=lambda p: p['name'].lower())
+                self._payload = json.dumps(self._projects).encode()
+                self.variants = {}
+        self._ready.set()
+
+    def _describe(self, name, files):
+        entry = {
+            "name": name,
+            "path": f"/{name}/index.html" if 'index.html' in files else f"/{name}/",
+            "file_count": len(files),
+            "total_bytes": sum(size for _, size in files.values()),
+            "last_modified": max((m for m, _ in files.values()), default=0) / 1e9,
+        }
+        for flag, markers in self.MARKERS.items():
+            entry[flag] = any(m in files for m in markers)
+        return entry
+
+    def ensure_ready(self):
+        if not self._ready.is_set():
+            self.poller.poll()
+
+    def payload(self):
+        """Precomputed JSON for the unfiltered listing: (bytes, compressed variants dict)."""
+        self.ensure_ready()
+        with self._lock:
+            return self._payload, self.variants
+
+    def query(self, params):
+        """Filter/sort/page the catalog. Returns (page, total)."""
+        self.ensure_ready()
+        with self._lock:
+            projects = self._projects
+        q = params.get('q', [''])[0].lower()
+        if q:
+            projects = [p for p in projects if q in p['name'].lower()]
+        for flag in self.MARKERS:
+            if flag in params:
+                want = params[flag][0].lower() in ('1', 'true', 'yes')
+                projects = [p for p in projects if p[flag] == want]
+        sort = params.get('sort', ['name'])[0]
+        desc = params.get('order', ['asc'])[0] == 'desc'
+        if sort != 'name' or desc:  # already name-ordered otherwise
+            projects = sorted(projects, key=self.SORT_KEYS.get(sort, self.SORT_KEYS['name']),
+                              reverse=desc)
+        total = len(projects)
+        try:
+            offset = max(int(params.get('offset', ['0'])[0]), 0)
+            limit = int(params['limit'][0]) if 'limit' in params else None
+        except ValueError:
+            offset, limit = 0, None
+        return projects[offset:offset + limit if limit is not None else None], total
+
+class PrecacheManifest:
+    __slots__ = ('project', 'dir', 'files', 'truncated', 'payload', 'variants', 'etag', 'mtime')
+
+    def __init__(self, project, directory):
+        self.project = project
+        self.dir = directory
+        self.files = {}  # abs path -> (mtime_ns, size, content hash)
+        self.truncated = False
+        self.payload = None
+        self.variants = {}
+        self.etag = None
+        self.mtime = 0.0
+
+class PrecacheIndex:
+    """Per-project {asset URL: content hash} manifests for service-worker precaching.
+
+    A project's manifest is built the first time it is requested, then kept current
+    from WorkspacePoller changes: only files whose mtime/size moved are rehashed. The
+    hash is the one StaticCache uses for ETags, and `version` hashes the whole
+    mapping, so a service worker can skip the diff when nothing changed.
+    """
+
+    def __init__(self, poller, root=WORKSPACE_ROOT):
+        self.root = root
+        self._lock = threading.Lock()
+        self._manifests = {}  # project (workspace-relative, '/'-separated) -> PrecacheManifest
+        self.counters = dict(builds=0, hashed=0, updates=0)
+        poller.subscribe(self.apply)
+
+    def resolve(self, project):
+        """(project, abs dir) for a workspace-relative directory, or None if not servable."""
+        parts = [p for p in project.replace('\\', '/').split('/') if p and p != '.']
+        if not parts or any(p == '..' or p.startswith('.') or p in ('node_modules', '__pycache__')
+                            for p in parts):
+            return None
+        directory = os.path.join(self.root, *parts)
+        return ('/'.join(parts), directory) if os.path.isdir(directory) else None
+
+    @staticmethod
+    def eligible(path, size):
+        name = os.path.basename(path)
+        return (name not in PRECACHE_SKIP_NAMES and name.lower().endswith(PRECACHE_EXTENSIONS)
+                and size <= PRECACHE_MAX_FILE and path not in PRIVATE_FILES)
+
+    def digest(self, path):
+        digest = file_digest(path)
+        with self._lock:
+            self.counters['hashed'] += 1
+        return digest
+
+    def get(self, project):
+        """(payload, variants, etag, mtime) for `project`, building it on first use; None if unknown."""
+        resolved = self.resolve(project)
+        if resolved is None:
+            return None
+        project, directory = resolved
+        with self._lock:
+            manifest = self._manifests.get(project)
+        if manifest is None:
+            manifest = PrecacheManifest(project, directory)
+            for path, st in sorted(iter_workspace_files(directory)):
+                if not self.eligible(path, st.st_size):
+                    continue
+                if len(manifest.files) >= PRECACHE_MAX_ASSETS:
+                    manifest.truncated = True
+                    break
+                try:
+                    manifest.files[path] = (st.st_mtime_ns, st.st_size, self.digest(path))
+                except OSError:
+                    continue
+            with self._lock:
+                # Another request may have built it meanwhile; keep the first one
+                manifest = self._manifests.setdefault(project, manifest)
+                self.counters['builds'] += 1
+        with self._lock:
+            if manifest.payload is None:
+                self._render(manifest)
+            return manifest.payload, manifest.variants, manifest.etag, manifest.mtime
+
+    def _render(self, manifest):
+        assets = {}
+        total = 0
+        for path, (mtime_ns, size, digest) in sorted(manifest.files.items()):
+            rel = os.path.relpath(path, manifest.dir).replace(os.sep, '/')
+            assets['./' + urllib.parse.quote(rel)] = digest
+            total += size
+            manifest.mtime = max(manifest.mtime, mtime_ns / 1e9)
+        if './index.html' in assets:
+            assets['./'] = assets['./index.html']
+        version = hashlib.sha256(json.dumps(assets, sort_keys=True).encode()).hexdigest()[:16]
+        manifest.payload = json.dumps({
+            "project": manifest.project,
+            "version": version,
+            "assets": assets,
+            "bytes": total,
+            "truncated": manifest.truncated,
+        }).encode()
+        manifest.variants = {}
+        manifest.etag = f'"{version}"'
+
+    def apply(self, changes):
+        with self._lock:
+            manifests = list(self._manifests.values())
+        if not manifests or not changes:
+            return
+        for manifest in manifests:
+            prefix = manifest.dir + os.sep
+            updates = {}  # path -> new entry, or None to drop
+            for path, kind in changes:
+                if not path.startswith(prefix):
+                    continue
+                if kind == 'deleted':
+                    updates[path] = None
+                    continue
+                try:
+                    st = os.stat(path)
+                    if not self.eligible(path, st.st_size):
+                        updates[path] = None
+                        continue
+                    old = manifest.files.get(path)
+                    if old is not None and old[:2] == (st.st_mtime_ns, st.st_size):
+                        continue
+                    if old is None and len(manifest.files) >= PRECACHE_MAX_ASSETS:
+                        continue
+                    updates[path] = (st.st_mtime_ns, st.st_size, self.digest(path))
+                except OSError:
+                    updates[path] = None
+            if not updates:
+                continue
+            with self._lock:
+                before = dict(manifest.files)
+                for path, entry in updates.items():
+                    if entry is None:
+                        manifest.files.pop(path, None)
+                    else:
+                        manifest.files[path] = entry
+                if manifest.files != before:
+                    manifest.payload = None
+                    self.counters['updates'] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.counters, "projects": len(self._manifests),
+                    "assets": sum(len(m.files) for m in self._manifests.values())}
+
+# --- Workspace full-text search (/api/fs/search) ---
+def _is_word(ch):
+    return ch.isalnum() or ch == '_'
+
+class SearchDoc:
+    __slots__ = ('path', 'rel', 'text', 'folded', 'mtime_ns', 'size')
+
+    def __init__(self, path, rel, text, mtime_ns, size):
+        self.path = path
+        self.rel = rel
+        self.text = text
+        # Lowercased copy for case-insensitive matching: a plain pattern over it is far
+        # faster than re.IGNORECASE. None when lowercasing would shift offsets.
+        folded = text.lower()
+        self.folded = folded if len(folded) == len(text) else None
+        self.mtime_ns = mtime_ns
+        self.size = size
+
+class SearchIndex:
+    """Trigram index over the workspace's text files, kept current by WorkspacePoller.
+
+    Every indexed file gets a small integer id; each lowercase trigram maps to an
+    int bitmap of the files containing it, so a query term's candidates are the AND
+    of its trigrams' bitmaps. Candidates are confirmed with a regex over the file
+    text held in memory, which also yields the line snippets. Poller changes are
+    queued to an indexer thread: the poll never waits on indexing, and only files
+    whose mtime/size moved are re-read.
+    """
+    BATCH = 64  # files tokenized per merge into the postings
+
+    def __init__(self, poller, root=WORKSPACE_ROOT):
+        self.root = root
+        self._lock = threading.Lock()
+        self._docs = []        # id -> SearchDoc or None
+        self._ids = {}         # path -> id
+        self._free = []        # ids of removed files, reused first
+        self._postings = {}    # trigram -> bitmap of ids
+        self._bytes = 0
+        self._pending = {}     # path -> change kind, waiting for the indexer
+        self._wake = threading.Condition(self._lock)
+        self._thread = None
+        self.counters = dict(indexed=0, removed=0, skipped=0, queries=0)
+        poller.subscribe(self.apply)
+
+    @staticmethod
+    def eligible(path, size):
+        return (path.lower().endswith(SEARCH_EXTENSIONS) and size <= SEARCH_MAX_FILE
+                and path not in PRIVATE_FILES)
 
-# --- Load .env file (key never hardcoded in app code) ---
-def load_dotenv(path=None):
-    """Read .env from workspace root (one directory above this script)."""
-    if path is None:
-        # server.py is in skAIxuide/, .env is in workspace root
-        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.env')
-    path = os.path.abspath(path)
-    if os.path.isfile(path):
-        with open(path) as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('#') or '=' not in line:
+    @staticmethod
+    def trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def apply(self, changes):
+        if not changes:
+            return
+        with self._wake:
+            self._pending.update(changes)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='search-indexer', daemon=True)
+                self._thread.start()
+            self._wake.notify()
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while not self._pending:
+                    self._wake.wait()
+                paths = list(self._pending.items())[:self.BATCH]
+                for path, _ in paths:
+                    del self._pending[path]
+            try:
+                self._index(paths)
+            except Exception as e:
+                LOG.error('Search', f"indexing failed: {e}")
+
+    def _load(self, path):
+        """(SearchDoc, trigrams) for a file worth indexing, else None."""
+        try:
+            st = os.stat(path)
+            if not self.eligible(path, st.st_size):
+                return None
+            with self._lock:
+                doc_id = self._ids.get(path)
+                doc = self._docs[doc_id] if doc_id is not None else None
+            if doc is not None and (doc.mtime_ns, doc.size) == (st.st_mtime_ns, st.st_size):
+                return doc, None  # unchanged
+            with open(path, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            return None
+        if b'\0' in raw[:8192]:
+            return None
+        text = raw.decode('utf-8', errors='replace')
+        rel = os.path.relpath(path, self.root).replace(os.sep, '/')
+        doc = SearchDoc(path, rel, text, st.st_mtime_ns, st.st_size)
+        return doc, self.trigrams(doc.folded if doc.folded is not None else text.lower())
+
+    def _index(self, changes):
+        loaded = {}  # path -> (SearchDoc, trigrams) or None to drop
+        for path, kind in changes:
+            loaded[path] = None if kind == 'deleted' else self._load(path)
+        with self._lock:
+            stale = 0  # bitmap of ids whose old trigrams must be cleared
+            for path, entry in loaded.items():
+                if entry is not None and entry[1] is None:
                     continue
-                k, v = line.split('=', 1)
-                os.environ.setdefault(k.strip(), v.strip())
-        print(f"[env] Loaded .env from {path}", flush=True)
-    else:
-        print(f"[env] No .env found at {path}", flush=True)
+                doc_id = self._ids.get(path)
+                if doc_id is None:
+                    continue
+                stale |= 1 << doc_id
+                if entry is None:
+                    old = self._docs[doc_id]
+                    self._bytes -= len(old.text)
+                    self._docs[doc_id] = None
+                    del self._ids[path]
+                    self._free.append(doc_id)
+                    self.counters['removed'] += 1
+            if stale:
+                keep = ~stale
+                for gram in list(self._postings):
+                    bits = self._postings[gram] & keep
+                    if bits:
+                        self._postings[gram] = bits
+                    else:
+                        del self._postings[gram]
+            for path, entry in loaded.items():
+                if entry is None or entry[1] is None:
+                    continue
+                doc, grams = entry
+                doc_id = self._ids.get(path)
+                if doc_id is not None:
+                    self._bytes -= len(self._docs[doc_id].text)
+                elif self._bytes + len(doc.text) > SEARCH_MAX_BYTES:
+                    self.counters['skipped'] += 1
+                    continue
+                else:
+                    doc_id = self._free.pop() if self._free else len(self._docs)
+                    if doc_id == len(self._docs):
+                        self._docs.append(None)
+                    self._ids[path] = doc_id
+                self._docs[doc_id] = doc
+                self._bytes += len(doc.text)
+                bit = 1 << doc_id
+                postings = self._postings
+                for gram in grams:
+                    postings[gram] = postings.get(gram, 0) | bit
+                self.counters['indexed'] += 1
 
-load_dotenv()
+    @staticmethod
+    def parse_query(q):
+        """Whitespace-separated terms; "double quotes" keep a phrase together."""
+        return [a or b for a, b in re.findall(r'"([^"]+)"|(\S+)', q)]
 
-KAIXU_VIRTUAL_KEY = os.environ.get('KAIXU_VIRTUAL_KEY', '')
+    @staticmethod
+    def path_filter(patterns):
+        """Predicate over workspace-relative paths: globs, or plain file paths and
+        directory prefixes."""
+        if not patterns:
+            return None
+        globs, exact = [], set()
+        for p in patterns:
+            p = p.strip('/')
+            if any(c in p for c in '*?['):
+                globs.append(p)
+            else:
+                exact.add(p)
+                globs.append(p + '/*')
+        return lambda rel: rel in exact or any(fnmatch.fnmatchcase(rel, g) for g in globs)
 
-socketserver.TCPServer.allow_reuse_address = True
+    def search(self, q, paths=(), limit=20, word=False, case=False):
+        """Ranked files containing every term of `q`; see the /api/fs/search handler."""
+        terms = self.parse_query(q)
+        needles = [t if case else t.lower() for t in terms]
+        patterns = [re.compile(re.escape(n)) for n in needles]
+        loose = [re.compile(re.escape(n), re.IGNORECASE) for n in needles]
+        accept = self.path_filter(paths)
+        with self._lock:
+            self.counters['queries'] += 1
+            total_docs = len(self._ids)
+            candidates = -1  # all ones: no trigram constraint yet
+            df = []          # per term: files that have all of its trigrams
+            for term in terms:
+                bits = -1
+                for gram in self.trigrams(term.lower()):
+                    bits &= self._postings.get(gram, 0)
+                    if not bits:
+                        break
+                df.append(total_docs if bits == -1 else bits.bit_count())
+                candidates &= bits
+            if candidates == -1:
+                docs = [d for d in self._docs if d is not None]
+            else:
+                docs = []
+                while candidates:
+                    low = candidates & -candidates
+                    docs.append(self._docs[low.bit_length() - 1])
+                    candidates ^= low
+        if accept is not None:
+            docs = [d for d in docs if accept(d.rel)]
+
+        results = []
+        for doc in docs:
+            text, scan = self._haystack(doc, case, patterns, loose)
+            counts = []
+            for needle, pattern in zip(needles, scan):
+                if word or scan is loose:
+                    count = sum(1 for _ in self._spans(text, pattern, word))
+                else:
+                    count = text.count(needle)
+                if not count:
+                    break
+                counts.append(count)
+            else:
+                results.append((self._score(doc, terms, counts, df, total_docs), doc, counts))
+        results.sort(key=lambda r: (-r[0], r[1].rel))
+
+        page = []
+        for score, doc, counts in results[:limit]:
+            text, scan = self._haystack(doc, case, patterns, loose)
+            # Enough spans per term to find the first few distinct lines
+            positions = [span for pattern in scan
+                         for span in itertools.islice(self._spans(text, pattern, word), SEARCH_MAX_LINES * 10)]
+            page.append(self._result(score, doc, counts, positions))
+        return {
+            "query": q,
+            "terms": terms,
+            "total": len(results),
+            "indexed_files": total_docs,
+            "indexing": self.pending(),
+            "results": page,
+        }
+
+    @staticmethod
+    def _haystack(doc, case, patterns, loose):
+        """(text, patterns) to scan: original text when case matters, else the folded copy."""
+        if case:
+            return doc.text, patterns
+        if doc.folded is not None:
+            return doc.folded, patterns
+        return doc.text, loose
+
+    @staticmethod
+    def _spans(text, pattern, word):
+        """Match spans of a literal pattern; with `word`, only whole-word occurrences.
+
+        Boundaries are checked by hand rather than with \\b in the pattern, which would
+        cost the regex engine its fast literal search.
+        """
+        for m in pattern.finditer(text):
+            start, end = m.span()
+            if word and ((start > 0 and _is_word(text[start - 1]) and _is_word(text[start]))
+                         or (end < len(text) and _is_word(text[end]) and _is_word(text[end - 1]))):
+                continue
+            yield start, end
+
+    @staticmethod
+    def _score(doc, terms, counts, df, total_docs):
+        name = doc.rel.rsplit('/', 1)[-1].lower()
+        score = 0.0
+        for term, count, docs_with in zip(terms, counts, df):
+            weight = math.log(1 + total_docs / max(docs_with, 1)) * (1 + math.log(count))
+            if term.lower() in name:
+                weight *= 2
+            score += weight
+        # Gently favour short files: a hit in a 300-line page beats one in a bundle
+        return score / (1 + math.log1p(len(doc.text) / 65536))
+
+    @staticmethod
+    def _result(score, doc, counts, positions):
+        text = doc.text
+        lines = []
+        line_no, cursor = 1, 0
+        seen = set()
+        for start, end in sorted(positions):
+            line_no += text.count('\n', cursor, start)
+            cursor = start
+            if line_no in seen:
+                continue
+            if len(lines) >= SEARCH_MAX_LINES:
+                break
+            seen.add(line_no)
+            begin = text.rfind('\n', 0, start) + 1
+            stop = text.find('\n', start)
+            stop = len(text) if stop == -1 else stop
+            # Cut long (minified) lines to a window around the match
+            lo = max(begin, min(start - SEARCH_SNIPPET_CHARS // 2, stop - SEARCH_SNIPPET_CHARS))
+            hi = min(stop, lo + SEARCH_SNIPPET_CHARS)
+            snippet = text[lo:hi]
+            lines.append({"line": line_no, "col": start - begin + 1, "text": snippet.strip('\r'),
+                          "match": [start - lo, min(end, hi) - lo]})
+        return {
+            "path": doc.rel,
+            "project": doc.rel.split('/', 1)[0] if '/' in doc.rel else '',
+            "score": round(score, 3),
+            "matches": sum(counts),
+            "lines": lines,
+        }
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.counters, "files": len(self._ids), "trigrams": len(self._postings),
+                    "bytes": self._bytes, "pending": len(self._pending)}
+
+class FileEvents:
+    """Fans WorkspacePoller changes out to /api/fs/events subscribers.
+
+    Each change becomes one SSE `change` event with id `<epoch>:<seq>` and data
+    {path, type, hash, size, mtime}. `hash` is file_digest(), the value in StaticCache
+    ETags, so a client can skip refetching when it already holds those bytes. The
+    last `backlog` events are kept for clients that reconnect with Last-Event-ID.
+    The epoch is per process, so an id from another worker or an earlier run never
+    resumes; the client gets a `reset` event instead, meaning "refetch everything".
+    """
+    # (queued kind, newer kind) -> what the client should hear; None: nothing happened
+    MERGE = {('created', 'modified'): 'created', ('created', 'deleted'): None,
+             ('deleted', 'created'): 'modified'}
+
+    def __init__(self, poller, backlog=EVENTS_BACKLOG):
+        self.poller = poller
+        self.backlog = backlog
+        self.max_clients = EVENTS_MAX_CLIENTS
+        self.counters = dict(events=0, batches=0, hashed=0, resumes=0, resets=0, rejected=0)
+        self._primed = False
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            # Workers number their events independently, so each needs its own epoch
+            os.register_at_fork(after_in_child=self._reset)
+        poller.subscribe(self.apply)
+
+    def _reset(self):
+        self.epoch = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)  # subscribers wait for new events
+        self._wake = threading.Condition(self._lock)  # the hasher waits for changes
+        self._pending = {}  # path -> change kind, waiting to be hashed
+        self._thread = None
+        self._events = deque(maxlen=self.backlog)  # (seq, workspace-relative path, encoded event)
+        self._seq = 0
+        self.clients = 0
+
+    def apply(self, changes):
+        if not self._primed:
+            self._primed = True  # the first poll lists every file as created
+            return
+        if not changes:
+            return
+        # Hashing is left to our own thread so other listeners aren't held up by it
+        with self._wake:
+            for path, kind in changes:
+                queued = self._pending.pop(path, None)
+                kind = self.MERGE.get((queued, kind), kind) if queued else kind
+                if kind is not None:
+                    self._pending[path] = kind
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='file-events', daemon=True)
+                self._thread.start()
+            self._wake.notify()
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while not self._pending:
+                    self._wake.wait()
+                changes, self._pending = list(self._pending.items()), {}
+            try:
+                self._publish(changes)
+            except Exception as e:
+                LOG.error('Watch', f"file events failed: {e}")
+
+    def _publish(self, changes):
+        described = []
+        hashed = 0
+        for path, kind in changes:
+            event = {"path": os.path.relpath(path, self.poller.root).replace(os.sep, '/'),
+                     "type": kind, "hash": None, "size": None, "mtime": None}
+            if kind != 'deleted':
+                try:
+                    st = os.stat(path)
+                    if st.st_size <= EVENTS_HASH_MAX_FILE:
+                        event["hash"] = file_digest(path)
+                        hashed += 1
+                except OSError:
+                    continue  # already gone again: the next poll reports the deletion
+                event["size"], event["mtime"] = st.st_size, st.st_mtime
+            described.append(event)
+        with self._cond:
+            self.counters['hashed'] += hashed
+            if not described:
+                return
+            for event in described:
+                self._seq += 1
+                self._events.append((self._seq, event["path"],
+                                     self.encode('change', event, self._seq)))
+            self.counters['events'] += len(described)
+            self.counters['batches'] += 1
+            self._cond.notify_all()
+
+    def encode(self, kind, data, seq=None):
+        return (f"id: {self.epoch}:{self._seq if seq is None else seq}\n"
+                f"event: {kind}\ndata: {json.dumps(data)}\n\n").encode()
+
+    def resume(self, last_event_id):
+        """Seq to continue after for a client's Last-Event-ID: (seq, resumable).
+
+        Without an id the client starts from now; with one that can't be served
+        (other epoch, or older than the backlog) it starts from now and must resync.
+        """
+        with self._cond:
+            if not last_event_id:
+                return self._seq, True
+            epoch, _, seq = last_event_id.partition(':')
+            oldest = self._events[0][0] if self._events else self._seq + 1
+            if epoch != self.epoch or not seq.isdigit() or not oldest - 1 <= int(seq) <= self._seq:
+                self.counters['resets'] += 1
+                return self._seq, False
+            self.counters['resumes'] += 1
+            return int(seq), True
+
+    def read(self, after, timeout):
+        """Events past seq `after`, waiting up to `timeout` for one: (events, last seq, gap).
+
+        `gap` is true when some of them already fell out of the backlog.
+        """
+        with self._cond:
+            if self._seq <= after:
+                self._cond.wait(timeout)
+            events = [e for e in self._events if e[0] > after]
+            gap = bool(events) and events[0][0] > after + 1
+            if gap:
+                self.counters['resets'] += 1
+            return events, max(self._seq, after), gap
+
+    def attach(self):
+        with self._cond:
+            if self.clients >= self.max_clients:
+                self.counters['rejected'] += 1
+                return False
+            self.clients += 1
+            return True
+
+    def detach(self):
+        with self._cond:
+            self.clients -= 1
+
+    def snapshot(self):
+        with self._cond:
+            return {**self.counters, "epoch": self.epoch, "seq": self._seq, "clients": self.clients,
+                    "backlog": len(self._events), "pending": len(self._pending)}
+
+WORKSPACE_POLLER = WorkspacePoller()
+PROJECT_INDEX = ProjectIndex(WORKSPACE_POLLER)
+PRECACHE = PrecacheIndex(WORKSPACE_POLLER)
+SEARCH = SearchIndex(WORKSPACE_POLLER)
+FILE_EVENTS = FileEvents(WORKSPACE_POLLER)
+
+METRICS.collect('upstream_pool', UPSTREAM_POOL.snapshot)
+METRICS.collect('static_cache', STATIC_CACHE.snapshot)
+METRICS.collect('compression', PRECOMPRESSED.snapshot)
+METRICS.collect('optimizer', OPTIMIZER.snapshot)
+METRICS.collect('chat_cache', CHAT_CACHE.snapshot)
+METRICS.collect('precache', PRECACHE.snapshot)
+METRICS.collect('search', SEARCH.snapshot)
+METRICS.collect('watch', WORKSPACE_POLLER.snapshot)
+METRICS.collect('file_events', FILE_EVENTS.snapshot)
+METRICS.collect('admission', ADMISSION.snapshot)
+METRICS.collect('replay', REPLAY.snapshot)
+METRICS.collect('log', LOG.snapshot)
 
 class AuthHandler(http.server.SimpleHTTPRequestHandler):
+    API_ROUTES = ('/api/fs/projects', '/api/fs/precache', '/api/fs/search', '/api/fs/events',
+                  '/api/kaixu-key', '/api/stats', '/api/metrics', '/api/usage', '/api/logs')
+    INDEX_ROUTES = API_ROUTES[:4]  # answered from the workspace indexes (see INDEX_ADDRESS)
+    INDEX_FORWARD_HEADERS = ('Accept-Encoding', 'If-None-Match', 'If-Modified-Since',
+                             'Last-Event-ID', 'Cookie')
+    # Persistent connections: every response is framed (Content-Length or chunked),
+    # idle clients are dropped after `timeout` and each connection serves at most
+    # KEEPALIVE_MAX_REQUESTS responses. Servers without `keep_alive` close after each.
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body go out as separate writes; don't let Nagle hold the second one
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.responses_sent = 0
+        ACTIVE_CONNECTIONS.inc()
+
+    def finish(self):
+        ACTIVE_CONNECTIONS.dec()
+        if hasattr(self.server, 'connection_busy'):
+            self.server.connection_busy(self.connection)
+        super().finish()
+
+    def handle_one_request(self):
+        # Waiting for a request, a connection only holds its slot; tell a server that is
+        # short of slots (or stopping), so it can close it rather than leave clients queued
+        if hasattr(self.server, 'connection_idle'):
+            if not self.server.connection_idle(self.connection, kept_alive=self.responses_sent > 0):
+                self.close_connection = True
+                return
+        super().handle_one_request()
+
+    def parse_request(self):
+        if hasattr(self.server, 'connection_busy'):
+            if not self.server.connection_busy(self.connection):
+                self.close_connection = True  # reclaimed while the request line arrived
+                return False
+        return super().parse_request()
+
+    def route_label(self):
+        path = getattr(self, 'path', '').split('?')[0]
+        if path in self.API_ROUTES:
+            return path
+        if path.startswith('/api/'):
+            return 'proxy:' + endpoint_label(path) if self.command == 'POST' else 'api:other'
+        return 'static'
+
+    def send_response(self, code, message=None):
+        super().send_response(code, message)
+        self.responses_sent += 1
+        if (not getattr(self.server, 'keep_alive', True) or self.responses_sent >= KEEPALIVE_MAX_REQUESTS
+                or DRAINING.is_set()):
+            self.send_header('Connection', 'close')
+        elif not self.close_connection:
+            self.send_header('Keep-Alive', f'timeout={int(self.timeout)}, '
+                                           f'max={KEEPALIVE_MAX_REQUESTS - self.responses_sent}')
+        headers = getattr(self, 'headers', None)
+        if headers is not None and client_session(headers.get('Cookie')) is None:
+            # Gives caller_identity something to tell browsers behind one address apart by
+            _, value = new_client_session()
+            self.send_header('Set-Cookie', f'{CLIENT_COOKIE}={value}; Path=/; HttpOnly; SameSite=Lax')
+
+    def log_request(self, code='-', size='-'):
+        if isinstance(code, HTTPStatus):
+            code = code.value
+        HTTP_REQUESTS.inc(self.route_label(), getattr(self, 'command', None) or '-', str(code))
+        super().log_request(code, size)
+
+    # Access and error lines go through the log pipeline instead of blocking on stderr
+    def log_message(self, format, *args):
+        LOG.info('HTTP', f"{self.address_string()} {format % args}", client=self.client_address[0])
+
+    def log_error(self, format, *args):
+        LOG.warn('HTTP', f"{self.address_string()} {format % args}", client=self.client_address[0])
+
     def do_GET(self):
         # Normalize path
         path = self.path.split('?')[0]
@@ -49,38 +3905,151 @@ class AuthHandler(http.server.SimpleHTTPRequestHandler):
         if path == '/':
             self.send_response(303)
             self.send_header('Location', '/skAIxuide/index.html')
+            self.send_header('Content-Length', '0')
             self.end_headers()
             return
 
-        # Serve Project Index (JSON) for sidebar
+        if INDEX_ADDRESS is not None and path in self.INDEX_ROUTES:
+            self.forward_to_index_worker(path)
+            return
+
+        # Serve Project Index (JSON) for sidebar, straight from the precomputed catalog.
+        # Optional: ?q=&has_index=&has_manifest=&has_sw=&has_netlify_toml=
+        #           &sort=name|modified|size|files&order=asc|desc&offset=&limit=
         if path == '/api/fs/projects':
-            projects = []
-            try:
-                for entry in os.scandir('.'):
-                    if entry.is_dir() and not entry.name.startswith('.') and not entry.name == 'node_modules':
-                        # Check if it has index.html or similar
-                        has_index = os.path.exists(os.path.join(entry.path, 'index.html'))
-                        projects.append({
-                            "name": entry.name,
-                            "path": f"/{entry.name}/index.html" if has_index else f"/{entry.name}/",
-                            "has_index": has_index
-                        })
-            except Exception as e:
-                print(f"Error listing projects: {e}")
-            
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(projects).encode())
+            params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            if params:
+                page, total = PROJECT_INDEX.query(params)
+                self.send_json(page, headers={'X-Total-Count': str(total)})
+            else:
+                body, variants = PROJECT_INDEX.payload()
+                self.send_json(body, variants=variants)
+            return
+
+        # Content-hash precache manifest for a project's service worker:
+        # ?project=<workspace-relative dir>, e.g. skAIxuide or GodNodes/app
+        if path == '/api/fs/precache':
+            params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            project = params.get('project', [''])[0]
+            if not project:
+                self.send_json({"error": "project parameter required"}, 400)
+                return
+            found = PRECACHE.get(project)
+            if found is None:
+                self.send_json({"error": f"No such project: {project}"}, 404)
+                return
+            body, variants, etag, mtime = found
+            if self.not_modified(etag, mtime):
+                self.send_not_modified(etag, mtime, headers={'Cache-Control': 'no-cache'})
+                return
+            self.send_json(body, headers={'ETag': etag, 'Cache-Control': 'no-cache'}, variants=variants)
+            return
+
+        # Full-text search across workspace text files:
+        # ?q=<terms, "quoted phrase">&path=<glob or dir prefix, repeatable>&limit=&word=1&case=1
+        # Every term must appear in a file; files are ranked by term rarity and frequency.
+        if path == '/api/fs/search':
+            params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            q = params.get('q', [''])[0].strip()
+            if not q:
+                self.send_json({"error": "q parameter required"}, 400)
+                return
+            try:
+                limit = max(0, min(int(params.get('limit', ['20'])[0]), SEARCH_MAX_RESULTS))
+            except ValueError:
+                self.send_json({"error": "limit must be an integer"}, 400)
+                return
+            started = time.perf_counter()
+            result = SEARCH.search(q, params.get('path', []), limit,
+                                   word=params.get('word', ['0'])[0] == '1',
+                                   case=params.get('case', ['0'])[0] == '1')
+            result["took_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            self.send_json(result, headers={'Cache-Control': 'no-cache'})
+            return
+
+        # Push notifications for workspace file changes (SSE). `change` events carry
+        # {path, type: created|modified|deleted, hash, size, mtime}; ?path=<glob or dir
+        # prefix, repeatable> narrows them. A reconnect with Last-Event-ID gets what it
+        # missed, or a `reset` event when it can't, after which it should refetch.
+        if path == '/api/fs/events':
+            params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            if not FILE_EVENTS.attach():
+                self.send_json({"error": "Too many event streams"}, 503, headers={'Retry-After': '5'})
+                return
+            try:
+                self.relay_file_events(SearchIndex.path_filter(params.get('path', [])),
+                                       self.headers.get('Last-Event-ID'))
+            finally:
+                FILE_EVENTS.detach()
+            return
+
+        # Per-caller token usage and budget (admin panel polls this)
+        if path == '/api/usage':
+            if not self.check_auth():
+                self.send_json({"error": "Admin session required"}, 401)
+                return
+            self.send_json(USAGE.snapshot())
+            return
+
+        # Recent server log records from the in-memory ring (admin panel / diagnostics).
+        # Optional: ?limit=&level=debug|info|warn|error&source=&search=&since=<seq>
+        if path == '/api/logs':
+            if not self.check_auth():
+                self.send_json({"error": "Admin session required"}, 401)
+                return
+            params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            arg = lambda name, default=None: params.get(name, [default])[0]
+            try:
+                limit = min(int(arg('limit', 200)), LOG.ring.maxlen)
+                since = int(arg('since', 0))
+            except ValueError:
+                self.send_json({"error": "limit and since must be integers"}, 400)
+                return
+            level = arg('level')
+            if level is not None and level not in LOG.LEVELS:
+                self.send_json({"error": f"level must be one of {', '.join(LOG.LEVELS)}"}, 400)
+                return
+            records = LOG.recent(limit, level, arg('source'), arg('search'), since)
+            # Same shape as the Netlify logs function that diagnostics.html reads
+            self.send_json({
+                "count": len(records),
+                "logs": [LOG.entry(r) for r in records],
+                "next": records[-1]['seq'] if records else since,
+                "dropped": LOG.counters['dropped'],
+            }, headers={'Cache-Control': 'no-store'})
+            return
+
+        # Prometheus scrape endpoint
+        if path == '/api/metrics':
+            self.send_bytes(METRICS_SPOOL.render().encode(), 'text/plain; version=0.0.4; charset=utf-8')
+            return
+
+        # Server-side stats (upstream pool hit rate, TTFB reused vs fresh); per worker
+        if path == '/api/stats':
+            self.send_json({
+                "worker": {"pid": os.getpid(), "index": WORKER_INDEX},
+                "upstream": UPSTREAM_POOL.snapshot(),
+                "static_cache": STATIC_CACHE.snapshot(),
+                "compression": PRECOMPRESSED.snapshot(),
+                "optimizer": OPTIMIZER.snapshot(),
+                "chat_cache": CHAT_CACHE.snapshot(),
+                "admission": ADMISSION.snapshot(),
+                "replay": REPLAY.snapshot(),
+                "log": LOG.snapshot(),
+                **({"indexes": "worker 0"} if INDEX_ADDRESS is not None else {
+                    "precache": PRECACHE.snapshot(),
+                    "search": SEARCH.snapshot(),
+                    "watch": WORKSPACE_POLLER.snapshot(),
+                    "file_events": FILE_EVENTS.snapshot(),
+                    "projects": {"count": PROJECT_INDEX.query({})[1]},
+                }),
+            })
             return
 
         # --- Key injection endpoint (dev only, never exposes in prod) ---
         if path == '/api/kaixu-key':
             key = KAIXU_VIRTUAL_KEY
-            self.send_response(200 if key else 404)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"key": key} if key else {"error": "No key configured"}).encode())
+            self.send_json({"key": key} if key else {"error": "No key configured"}, 200 if key else 404)
             return
         
         # 1. Admin Protection (paths adjusted for workspace root serving)
@@ -90,6 +4059,7 @@ class AuthHandler(http.server.SimpleHTTPRequestHandler):
                 if path == '/admin':
                    self.send_response(303)
                    self.send_header('Location', '/skAIxuide/admin_panel.html')
+                   self.send_header('Content-Length', '0')
                    self.end_headers()
                    return
                 return http.server.SimpleHTTPRequestHandler.do_GET(self)
@@ -97,6 +4067,7 @@ class AuthHandler(http.server.SimpleHTTPRequestHandler):
                 # Redirect to Login
                 self.send_response(303)
                 self.send_header('Location', '/skAIxuide/login.html')
+                self.send_header('Content-Length', '0')
                 self.end_headers()
                 return
 
@@ -104,6 +4075,7 @@ class AuthHandler(http.server.SimpleHTTPRequestHandler):
         if path == '/login' or path == '/skAIxuide/login':
             self.send_response(303)
             self.send_header('Location', '/skAIxuide/login.html')
+            self.send_header('Content-Length', '0')
             self.end_headers()
             return
 
@@ -129,11 +4101,13 @@ class AuthHandler(http.server.SimpleHTTPRequestHandler):
                 self.send_response(303)
                 self.send_header('Set-Cookie', f'sk_admin_session={SESSION_TOKEN}; Path=/; HttpOnly')
                 self.send_header('Location', '/skAIxuide/admin_panel.html')
+                self.send_header('Content-Length', '0')
                 self.end_headers()
             else:
                 # Redirect back to login on failure
                 self.send_response(303)
                 self.send_header('Location', '/skAIxuide/login.html?error=1')
+                self.send_header('Content-Length', '0')
                 self.end_headers()
             return
 
@@ -145,36 +4119,58 @@ class AuthHandler(http.server.SimpleHTTPRequestHandler):
         target_path = path[4:] 
         target_url = GATEWAY_HOST + target_path
         is_stream = 'gateway-stream' in target_path
+        endpoint = endpoint_label(target_path)
         stream_start = time.time()
         
-        print(f"[Proxy] Forwarding to: {target_url}", flush=True)
+        LOG.info('Proxy', f"Forwarding to: {target_url}")
 
+        conn = None
+        body = None
+        headers_sent = False
+        chunked = False
+        admitted = False
+        handed_off = False  # a pump thread now owns conn, the admission slot and the stream count
+        klass = 'stream' if is_stream else 'chat'
         try:
-            # Read incoming body
-            content_length_header = self.headers.get('Content-Length')
-            content_length = int(content_length_header) if content_length_header else 0
-            body = self.rfile.read(content_length)
+            auth_val = self.headers.get('Authorization')
+            # Auto-inject key from .env if client didn't send one
+            if not auth_val and KAIXU_VIRTUAL_KEY:
+                auth_val = f'Bearer {KAIXU_VIRTUAL_KEY}'
+            identity = caller_identity(auth_val, self.client_address, client_session(self.headers.get('Cookie')))
+
+            # A reconnect carrying Last-Event-ID of a buffered stream resumes it instead of
+            # generating again; unknown or expired ids fall through to a fresh request.
+            if is_stream and REPLAY.enabled and self.headers.get('Last-Event-ID'):
+                stream, after = REPLAY.lookup(self.headers['Last-Event-ID'], identity)
+                if stream is not None:
+                    body = self.request_body()
+                    if body is None:
+                        return
+                    for _ in body:  # the re-sent prompt isn't needed, but must be consumed
+                        pass
+                    LOG.info('Proxy', f"Resuming stream {stream.id} after event {after}")
+                    self.relay_stream(stream, after, resumed=True)
+                    return
+
+            # Read the whole upload before waiting for a slot, so a slow uploader never
+            # holds one; big bodies wait in a temp file, not in memory
+            body = self.request_body()
+            if body is None:
+                return
+            body = SpooledBody(body)
+
+            # May raise AdmissionRejected
+            ADMISSION.acquire(identity, klass)
+            admitted = True
+            if is_stream:
+                ACTIVE_STREAMS.inc()
 
             # Parse the gateway host
             from urllib.parse import urlparse
             parsed = urlparse(GATEWAY_HOST)
-            is_https = parsed.scheme == 'https'
-
-            # Use http.client for TRUE streaming (urllib buffers everything)
-            if is_https:
-                ctx = ssl.create_default_context()
-                conn = http.client.HTTPSConnection(parsed.hostname, parsed.port or 443,
-                                                    context=ctx, timeout=120)
-            else:
-                conn = http.client.HTTPConnection(parsed.hostname, parsed.port or 80,
-                                                   timeout=120)
 
             # Build outgoing headers
             out_headers = {'Content-Type': 'application/json'}
-            auth_val = self.headers.get('Authorization')
-            # Auto-inject key from .env if client didn't send one
-            if not auth_val and KAIXU_VIRTUAL_KEY:
-                auth_val = f'Bearer {KAIXU_VIRTUAL_KEY}'
             if auth_val:
                 out_headers['Authorization'] = auth_val
             # Only set SSE accept header for streaming endpoints
@@ -182,90 +4178,587 @@ class AuthHandler(http.server.SimpleHTTPRequestHandler):
                 out_headers['Accept'] = 'text/event-stream'
             else:
                 out_headers['Accept'] = 'application/json'
-            out_headers['Content-Length'] = str(len(body))
+            if body.length is not None:
+                out_headers['Content-Length'] = str(body.length)
+            else:
+                out_headers['Transfer-Encoding'] = 'chunked'
+            # Responses are relayed byte-for-byte, so never let the gateway compress them
+            out_headers['Accept-Encoding'] = 'identity'
 
-            conn.request('POST', target_path, body=body, headers=out_headers)
-            resp = conn.getresponse()
+            if (not is_stream and CHAT_CACHE.enabled and target_path.rsplit('/', 1)[-1] in CHAT_CACHE_ENDPOINTS
+                    and body.length is not None and body.length <= CHAT_CACHE_MAX_BODY):
+                self.proxy_cached(parsed, target_path, body.read_all(), out_headers, identity)
+                return
 
-            print(f"[Proxy] Gateway responded: {resp.status} {resp.reason}", flush=True)
-            if is_stream:
-                print(f"[Proxy][DIAG] SSE stream started | payload={len(body)} bytes | t=0.0s", flush=True)
+            # Hedging needs a body it can send twice, so small chat prompts are buffered
+            hedge = (UPSTREAM_POOL.hedge and endpoint in UPSTREAM_HEDGE_ENDPOINTS
+                     and body.length is not None and body.length <= CHAT_CACHE_MAX_BODY)
+            payload = body.read_all() if hedge else body
 
-            # Send status + headers to the browser
+            # Use http.client for TRUE streaming (urllib buffers everything), over a
+            # pooled keep-alive connection so repeat turns skip DNS/TCP/TLS setup
+            conn, resp, reused = UPSTREAM_POOL.request(parsed, 'POST', target_path,
+                                                       body=payload, headers=out_headers,
+                                                       encode_chunked=body.length is None,
+                                                       hedge=hedge)
+
+            LOG.info('Proxy', f"Gateway responded: {resp.status} {resp.reason} | "
+                              f"{'reused' if reused else 'new'} connection",
+                     endpoint=endpoint, status=resp.status)
+            if is_stream and REPLAY.enabled and 200 <= resp.status < 300:
+                # Hand the upstream read to its own thread; this handler just follows the buffer
+                stream = REPLAY.open(identity, endpoint, resp.status,
+                                     [(k, v) for k, v in resp.getheaders()
+                                      if k.lower() not in PROXY_SKIP_HEADERS])
+                threading.Thread(target=pump_to_replay, name=f'stream-{stream.id[:8]}', daemon=True,
+                                 args=(stream, conn, resp, identity, klass, endpoint, body.received)).start()
+                handed_off = True
+                conn = None
+                self.relay_stream(stream)
+                return
+
+            # Send status + headers to the browser. Proxied bodies (SSE in particular)
+            # are relayed verbatim: never compressed, so every chunk flushes immediately.
             self.send_response(resp.status)
             # Forward response headers (skip hop-by-hop)
-            skip = {'transfer-encoding', 'connection', 'content-encoding', 'content-length'}
             for k, v in resp.getheaders():
-                if k.lower() not in skip:
+                if k.lower() not in PROXY_SKIP_HEADERS:
                     self.send_header(k, v)
+            # Frame the body so the connection outlives it: a known length passes
+            # through, anything else (SSE) is chunked. HTTP/1.0 clients get close-delimited.
+            if resp.status in (204, 304):
+                pass
+            elif resp.length is not None and not is_stream:
+                self.send_header('Content-Length', str(resp.length))
+            elif self.request_version != 'HTTP/1.0':
+                self.send_header('Transfer-Encoding', 'chunked')
+                chunked = True
+            else:
+                self.send_header('Connection', 'close')
             # Force no-buffering headers for SSE
             self.send_header('Cache-Control', 'no-cache')
             self.send_header('X-Accel-Buffering', 'no')
             self.end_headers()
+            headers_sent = True
 
-            # Stream response body — use read1() for true non-blocking SSE
-            # read(n) blocks until it collects n bytes; read1(n) returns immediately
-            # with whatever bytes the socket has available (critical for SSE)
-            total_bytes = 0
-            chunk_num = 0
-            stream_start = time.time()
-            last_chunk_time = stream_start
-            while True:
-                try:
-                    chunk = resp.read1(65536)  # returns immediately with available bytes
-                except Exception:
-                    chunk = resp.read(256)  # fallback for older Python
-                if not chunk:
-                    break
-                chunk_num += 1
-                now = time.time()
-                elapsed = now - stream_start
-                gap = now - last_chunk_time
-                last_chunk_time = now
-
-                if is_stream:
-                    # Parse SSE event types passing through for diagnostic visibility
-                    try:
-                        snippet = chunk[:512].decode('utf-8', errors='replace')
-                        events_in_chunk = []
-                        for line in snippet.split('\n'):
-                            if line.startswith('event:'):
-                                events_in_chunk.append(line.split(':', 1)[1].strip())
-                        evt_label = ','.join(events_in_chunk) if events_in_chunk else '(data)'
-                        print(f"[Proxy][DIAG] chunk#{chunk_num} | {len(chunk)}B | +{gap:.1f}s gap | {elapsed:.1f}s total | events=[{evt_label}]", flush=True)
-                    except Exception:
-                        print(f"[Proxy][DIAG] chunk#{chunk_num} | {len(chunk)}B | +{gap:.1f}s gap | {elapsed:.1f}s total", flush=True)
-
-                self.wfile.write(chunk)
-                self.wfile.flush()
-                total_bytes += len(chunk)
-
-            stream_elapsed = time.time() - stream_start
-            if is_stream:
-                print(f"[Proxy][DIAG] SSE stream CLOSED by upstream | {total_bytes}B total | {chunk_num} chunks | {stream_elapsed:.1f}s duration", flush=True)
-            print(f"[Proxy] Streamed {total_bytes} bytes to client", flush=True)
-            conn.close()
+            # From here pump_stream owns the upstream connection
+            upstream, conn = conn, None
+            total_bytes = pump_stream(upstream, resp, identity, endpoint, body.received,
+                                      lambda chunk: self.write_body(chunk, chunked), is_stream)
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+            LOG.info('Proxy', f"Streamed {total_bytes} bytes to client", endpoint=endpoint, bytes=total_bytes)
 
         except http.client.IncompleteRead as e:
-            # Write whatever partial data we got
-            if e.partial:
+            # Write whatever partial data we got; no terminating chunk, so the
+            # client sees a truncated body, and the connection can't be reused
+            self.close_connection = True
+            if not headers_sent:
                 try:
-                    self.wfile.write(e.partial)
-                    self.wfile.flush()
+                    self.send_json({"error": f"Proxy error: {e!r}"}, 502)
+                except OSError:
+                    pass
+            elif e.partial:
+                try:
+                    self.write_body(e.partial, chunked)
                 except: pass
-            print(f"[Proxy] IncompleteRead: got {len(e.partial)} bytes partial", flush=True)
+            LOG.warn('Proxy', f"IncompleteRead: got {len(e.partial)} bytes partial")
             if is_stream:
-                print(f"[Proxy][DIAG] IncompleteRead after {time.time() - stream_start:.1f}s — upstream may have timed out", flush=True)
+                LOG.debug('Proxy', f"IncompleteRead after {time.time() - stream_start:.1f}s — upstream may have timed out")
         except BrokenPipeError:
-            print("[Proxy] Client disconnected (BrokenPipe)", flush=True)
+            self.close_connection = True
+            LOG.info('Proxy', "Client disconnected (BrokenPipe)")
+        except RequestBodyTooLarge as e:
+            LOG.warn('Proxy', f"Rejected upload: {e}")
+            self.close_connection = True
+            try:
+                self.send_json({"error": str(e)}, 413)
+            except OSError:
+                pass
+        except AdmissionRejected as e:
+            LOG.warn('Proxy', f"Not admitted ({e.reason}): {identity} {klass}", reason=e.reason)
+            try:
+                self.send_json({"error": f"Too many concurrent AI requests ({e.reason})"}, e.status,
+                               headers={'Retry-After': str(e.retry_after)})
+            except OSError:
+                pass
+        except RequestBodyError as e:
+            LOG.warn('Proxy', f"Bad upload: {e}")
+            self.close_connection = True
+            try:
+                self.send_json({"error": str(e)}, 400)
+            except OSError:
+                pass
+        except UpstreamUnavailable as e:
+            LOG.warn('Proxy', f"Fast-fail: {e}")
+            try:
+                self.send_json({"error": str(e)}, 503,
+                               headers={'Retry-After': str(int(e.retry_after + 0.5))})
+            except OSError:
+                pass
+        except TimeoutError as e:
+            LOG.error('Proxy', f"Gateway timed out: {e}", endpoint=endpoint)
+            if headers_sent:
+                self.close_connection = True
+            else:
+                try:
+                    self.send_json({"error": "Gateway timed out"}, 504)
+                except OSError:
+                    pass
         except Exception as e:
-            print(f"[Proxy Error] {type(e).__name__}: {e}", flush=True)
+            LOG.error('Proxy', f"{type(e).__name__}: {e}", endpoint=endpoint)
+            if headers_sent:
+                # Too late for an error status; cut the response short instead
+                self.close_connection = True
+            else:
+                try:
+                    self.send_json({"error": f"Proxy error: {e}"}, 502)
+                except OSError:
+                    pass
+        finally:
+            if admitted and not handed_off:
+                if is_stream:
+                    ACTIVE_STREAMS.dec()
+                ADMISSION.release(identity, klass)
+            # Leftover request body bytes would be parsed as the next request
+            if body is not None and not body.complete:
+                self.close_connection = True
+            if isinstance(body, SpooledBody):
+                body.close()
+            # Anything not handed back to the pool above is in an unknown state
+            if conn is not None:
+                UPSTREAM_POOL.discard(conn)
+
+    def relay_stream(self, stream, after=0, resumed=False):
+        """Send a buffered gateway stream's events past seq `after`, live until it ends.
+
+        A client that goes away only detaches; the pump keeps filling the buffer so
+        a reconnect can pick up from its Last-Event-ID.
+        """
+        self.send_response(stream.status)
+        for k, v in stream.headers:
+            self.send_header(k, v)
+        chunked = self.request_version != 'HTTP/1.0'
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+        self.send_header('X-Stream-Id', stream.id)
+        if resumed:
+            self.send_header('X-Stream-Resumed', str(after))
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.end_headers()
+        REPLAY.attach(stream)
+        sent = 0
+        finished = False
+        try:
+            while True:
+                events, after, skipped, done = REPLAY.read(stream, after, REPLAY_PING)
+                if skipped:
+                    events.insert(0, b': %d event(s) evicted before delivery\n\n' % skipped)
+                if events:
+                    data = b''.join(events)
+                    self.write_body(data, chunked)
+                    sent += len(data)
+                elif not done:
+                    # Comments are ignored by SSE clients; this finds dead connections early
+                    self.write_body(b': ping\n\n', chunked)
+                if done:
+                    break
+            if stream.error is not None:
+                # Upstream was cut short: no terminating chunk, so the client sees a truncated body
+                self.close_connection = True
+            elif chunked:
+                self.wfile.write(b'0\r\n\r\n')
+            finished = True
+            LOG.info('Proxy', f"Streamed {sent} bytes to client", endpoint=stream.endpoint, bytes=sent,
+                     stream=stream.id)
+        except OSError as e:  # BrokenPipe, reset, or the client stopped reading
+            self.close_connection = True
+            LOG.info('Proxy', f"Client detached from stream {stream.id} at event {after} "
+                              f"({type(e).__name__}); {'upstream continues' if not stream.done else 'stream complete'}")
+        finally:
+            REPLAY.detach(stream, disconnected=not finished)
+
+    def relay_file_events(self, matches, last_event_id):
+        """Stream FILE_EVENTS to this client until it goes away or the server drains."""
+        after, resumed = FILE_EVENTS.resume(last_event_id)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        chunked = self.request_version != 'HTTP/1.0'
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Accel-Buffering', 'no')
+        self.close_connection = True  # the stream only ends when one side gives up
+        self.end_headers()
+        backend = {"backend": WORKSPACE_POLLER.backend}
+        first = FILE_EVENTS.encode('ready' if resumed else 'reset', backend, after)
+        try:
+            self.write_body(first, chunked)
+            idle_since = time.monotonic()
+            while not DRAINING.is_set():
+                # Short waits so a draining worker lets go of its subscribers promptly
+                events, after, gap = FILE_EVENTS.read(after, 1.0)
+                if gap:  # fell behind the backlog: the client has to resync anyway
+                    out = [FILE_EVENTS.encode('reset', backend, after)]
+                else:
+                    out = [data for _, rel, data in events if matches is None or matches(rel)]
+                if out:
+                    self.write_body(b''.join(out), chunked)
+                    idle_since = time.monotonic()
+                elif time.monotonic() - idle_since >= EVENTS_PING:
+                    self.write_body(b': ping\n\n', chunked)
+                    idle_since = time.monotonic()
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except OSError:  # the client went away
+            pass
+
+    def forward_to_index_worker(self, path):
+        """Relay a workspace index request to worker 0, streaming the response back
+        (an /api/fs/events stream included)."""
+        conn = http.client.HTTPConnection(*INDEX_ADDRESS, timeout=INDEX_FORWARD_TIMEOUT)
+        headers = {k: self.headers[k] for k in self.INDEX_FORWARD_HEADERS if k in self.headers}
+        try:
+            conn.request('GET', self.path, headers=headers)
+            resp = conn.getresponse()
+        except OSError as e:
+            conn.close()
+            LOG.warn('Server', f"Index worker unavailable: {e}")
+            self.send_json({"error": "Workspace index unavailable"}, 503, headers={'Retry-After': '1'})
+            return
+        events = path == '/api/fs/events'
+        if events:
+            # serve() shuts these down on SIGTERM, so a draining worker lets go promptly
+            INDEX_FORWARDS.add(conn.sock)
+        try:
+            self.send_response(resp.status)
+            for k, v in resp.getheaders():
+                if k.lower() not in ('transfer-encoding', 'connection', 'keep-alive', 'server', 'date',
+                                     'set-cookie'):
+                    self.send_header(k, v)
+            chunked = resp.length is None and resp.status not in (204, 304)
+            if chunked:
+                if self.request_version == 'HTTP/1.0':
+                    chunked = False
+                    self.close_connection = True
+                else:
+                    self.send_header('Transfer-Encoding', 'chunked')
+            if events:
+                self.close_connection = True
+            self.end_headers()
             try:
-                self.send_response(502)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"error": f"Proxy error: {e}"}).encode())
-            except: pass
+                while True:
+                    data = resp.read1(BODY_CHUNK)
+                    if not data:
+                        break
+                    self.write_body(data, chunked)
+                if chunked:
+                    self.wfile.write(b'0\r\n\r\n')
+            except (OSError, http.client.HTTPException):
+                self.close_connection = True  # either side went away mid-body
+        finally:
+            INDEX_FORWARDS.discard(conn.sock)
+            conn.close()
+
+    def write_body(self, data, chunked):
+        if chunked:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
+        self.wfile.flush()
+
+    def send_head(self):
+        """Serve regular files from STATIC_CACHE with ETag/Last-Modified validators.
+
+        Files too large to cache are sent from disk with sendfile; both paths honour
+        Range/If-Range. Directory listings and redirects fall back to
+        SimpleHTTPRequestHandler. With OPTIMIZER enabled, HTML/CSS/JS are served
+        minified and fingerprinted `name.<hash>.ext` URLs resolve to their source.
+        """
+        path = self.translate_path(self.path)
+        cache_control = None
+        if OPTIMIZER.enabled and not os.path.exists(path):
+            source = OPTIMIZER.unfingerprint(path)
+            if source is not None:
+                path = source
+                cache_control = IMMUTABLE_CACHE_CONTROL
+        if os.path.isdir(path):
+            if not urllib.parse.urlsplit(self.path).path.endswith('/'):
+                return super().send_head()
+            for index in ("index.html", "index.htm"):
+                index = os.path.join(path, index)
+                if os.path.isfile(index):
+                    path = index
+                    break
+            else:
+                return super().send_head()
+        if path.endswith('/'):
+            return super().send_head()
+        # do_GET gates by URL; this catches any other URL that resolves to a gated file
+        if os.path.realpath(path) in GATED_FILES and not self.check_auth():
+            self.send_response(303)
+            self.send_header('Location', '/skAIxuide/login.html')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        cache = STATIC_CACHE
+        entry = None
+        if OPTIMIZER.enabled and OPTIMIZER.handles(path):
+            entry = OPTIMIZER.get(path)
+            if entry is not None:
+                cache = OPTIMIZER
+                if cache_control is None and self.guess_type(path).startswith('text/html'):
+                    # Pages carry the fingerprints, so they must always be revalidated
+                    cache_control = 'no-cache'
+        if entry is None:
+            entry = STATIC_CACHE.get(path)
+        if entry is None:
+            return self.send_file(path, {'Cache-Control': cache_control} if cache_control else None)
+
+        ctype = self.guess_type(path)
+        compressible = is_compressible(ctype) and len(entry.body) >= COMPRESS_MIN_BYTES
+        encoding = None
+        # Ranges always address the identity representation
+        if compressible and 'Range' not in self.headers:
+            encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+        # Each representation needs its own strong validator
+        etag = entry.etag[:-1] + f'-{encoding}"' if encoding else entry.etag
+        headers = {'Vary': 'Accept-Encoding'} if compressible else {}
+        if cache_control:
+            headers['Cache-Control'] = cache_control
+
+        if self.not_modified(etag, entry.mtime):
+            self.send_not_modified(etag, entry.mtime, headers)
+            return None
+        if encoding:
+            headers['Content-Encoding'] = encoding
+            body = PRECOMPRESSED.variant(path, entry, encoding, cache)
+        else:
+            body = entry.body
+        return self.send_ranges(io.BytesIO(body), len(body), ctype, etag, entry.mtime, headers)
+
+    def send_file(self, path, headers=None):
+        """Serve a file too large for STATIC_CACHE straight from disk via sendfile, or
+        its precompressed sidecar once PRECOMPRESSED has built one."""
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        try:
+            st = os.fstat(f.fileno())
+            etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+            ctype = self.guess_type(path)
+            size = st.st_size
+            headers = dict(headers or {})
+            encoding = None
+            if is_compressible(ctype) and COMPRESS_MIN_BYTES <= size <= COMPRESS_MAX_FILE:
+                headers['Vary'] = 'Accept-Encoding'
+                # Ranges always address the identity representation
+                if 'Range' not in self.headers:
+                    encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+                packed = encoding and PRECOMPRESSED.open_file(path, st, encoding)
+                if packed:
+                    f.close()
+                    f = packed
+                    size = os.fstat(f.fileno()).st_size
+                    etag = etag[:-1] + f'-{encoding}"'
+                else:
+                    encoding = None  # sent as is until the background build is done
+            if self.not_modified(etag, st.st_mtime):
+                self.send_not_modified(etag, st.st_mtime, headers)
+                f.close()
+                return None
+            if encoding:
+                headers['Content-Encoding'] = encoding
+            return self.send_ranges(f, size, ctype, etag, st.st_mtime, headers)
+        except:
+            f.close()
+            raise
+
+    def send_not_modified(self, etag, mtime, headers=None):
+        self.send_response(304)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(mtime))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+
+    def send_ranges(self, f, size, ctype, etag, mtime, headers=None):
+        """Send 200/206/416 headers for `f` honouring Range/If-Range; returns the body."""
+        ranges = None
+        range_header = self.headers.get('Range')
+        if range_header and self.if_range_matches(etag, mtime):
+            ranges = parse_range(range_header, size)
+            STATIC_RANGE_REQUESTS.inc('ignored' if ranges is None else
+                                      'unsatisfiable' if not ranges else
+                                      'single' if len(ranges) == 1 else 'multi')
+        if ranges == []:
+            f.close()
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+
+        if not ranges:
+            self.send_response(200)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(size))
+            body = FileSlices(f, [(b'', 0, size)])
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.send_response(206)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.send_header('Content-Length', str(end - start + 1))
+            body = FileSlices(f, [(b'', start, end - start + 1)])
+        else:
+            boundary = uuid.uuid4().hex
+            parts = [(f'\r\n--{boundary}\r\nContent-Type: {ctype}\r\n'
+                      f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'.encode(),
+                      start, end - start + 1) for start, end in ranges]
+            trailer = f'\r\n--{boundary}--\r\n'.encode()
+            length = sum(len(pre) + count for pre, _, count in parts) + len(trailer)
+            self.send_response(206)
+            self.send_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+            self.send_header('Content-Length', str(length))
+            body = FileSlices(f, parts, trailer)
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', self.date_time_string(mtime))
+        self.send_header('ETag', etag)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        return body
+
+    def if_range_matches(self, etag, mtime):
+        """RFC 9110 13.1.5: a Range only applies if If-Range (when sent) still matches."""
+        if_range = self.headers.get('If-Range')
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith(('"', 'W/')):
+            return if_range == etag and not etag.startswith('W/')
+        try:
+            since = email.utils.parsedate_to_datetime(if_range)
+        except (TypeError, ValueError, IndexError, OverflowError):
+            return False
+        return since is not None and int(mtime) == int(since.timestamp())
+
+    def copyfile(self, source, outputfile):
+        if not isinstance(source, FileSlices):
+            return super().copyfile(source, outputfile)
+        for preamble, offset, count in source.parts:
+            if preamble:
+                outputfile.write(preamble)
+            if count:
+                sent = self.connection.sendfile(source.f, offset, count)
+                if not isinstance(source.f, io.BytesIO):
+                    STATIC_SENDFILE_BYTES.inc(amount=sent)
+        if source.trailer:
+            outputfile.write(source.trailer)
+
+    def send_json(self, obj, status=200, headers=None, variants=None):
+        """Send a JSON API response, compressed when the client accepts it.
+
+        `obj` may be pre-serialized bytes; `variants` is an optional dict in which
+        compressed forms of such a reusable payload are kept between requests.
+        """
+        body = obj if isinstance(obj, bytes) else json.dumps(obj).encode()
+        self.send_bytes(body, 'application/json', status, headers, variants)
+
+    def send_bytes(self, body, ctype, status=200, headers=None, variants=None):
+        encoding = None
+        if len(body) >= COMPRESS_MIN_BYTES:
+            encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+        if encoding:
+            packed = variants.get(encoding) if variants is not None else None
+            if packed is None:
+                # API payloads change often, so use a fast level instead of the store
+                packed = (brotli.compress(body, quality=4) if encoding == 'br'
+                          else gzip.compress(body, compresslevel=5, mtime=0))
+                if variants is not None:
+                    variants[encoding] = packed
+            body = packed
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_modified(self, etag, mtime):
+        """True if the request's conditional headers match the current representation."""
+        inm = self.headers.get('If-None-Match')
+        if inm is not None:
+            # Weak comparison (RFC 9110 13.1.2): ignore W/ prefixes
+            tags = [t.strip().removeprefix('W/') for t in inm.split(',')]
+            return '*' in tags or etag.removeprefix('W/') in tags
+        ims = self.headers.get('If-Modified-Since')
+        if ims is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(ims)
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            if since is None:
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def request_body(self):
+        """RequestBody for the current request, or None after answering 400/411/413."""
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            return RequestBody(self.rfile, limit=MAX_BODY_BYTES)
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            self.close_connection = True
+            self.send_json({"error": "Invalid Content-Length"}, 400)
+            return None
+        if length > MAX_BODY_BYTES:
+            self.close_connection = True
+            self.send_json({"error": f"Request body exceeds {MAX_BODY_BYTES} bytes"}, 413)
+            return None
+        return RequestBody(self.rfile, length, limit=MAX_BODY_BYTES)
+
+    def proxy_cached(self, parsed, target_path, body, out_headers, identity):
+        """Answer a non-stream gateway call through CHAT_CACHE (cached or coalesced)."""
+        def load():
+            conn, resp, reused = UPSTREAM_POOL.request(
+                parsed, 'POST', target_path, body=body, headers=out_headers,
+                hedge=UPSTREAM_POOL.hedge and target_path.rsplit('/', 1)[-1] in UPSTREAM_HEDGE_ENDPOINTS)
+            try:
+                data = resp.read()
+            except Exception:
+                UPSTREAM_POOL.discard(conn)
+                raise
+            UPSTREAM_POOL.release(conn, reusable=not resp.will_close)
+            LOG.info('Proxy', f"Gateway responded: {resp.status} {resp.reason} | "
+                              f"{'reused' if reused else 'new'} connection", status=resp.status)
+            return CachedResponse(resp.status, resp.reason, resp.getheaders(), data)
+
+        key = CHAT_CACHE.key(target_path, out_headers.get('Authorization'), body)
+        result, state = CHAT_CACHE.fetch(key, load)
+        USAGE.record_json(identity, result.body, cached=state != 'MISS')
+        self.send_response(result.status)
+        for k, v in result.headers:
+            if k.lower() not in PROXY_SKIP_HEADERS:
+                self.send_header(k, v)
+        self.send_header('Content-Length', str(len(result.body)))
+        self.send_header('X-Proxy-Cache', state)
+        self.end_headers()
+        self.wfile.write(result.body)
+        LOG.info('Proxy', f"{state}: sent {len(result.body)} bytes to client")
 
     def check_auth(self):
         cookie_header = self.headers.get('Cookie')
@@ -277,16 +4770,423 @@ class AuthHandler(http.server.SimpleHTTPRequestHandler):
             return True
         return False
 
-if __name__ == "__main__":
-    # Ensure stdout is flushed for logs
-    sys.stdout.reconfigure(line_buffering=True)
-    
-    # Serve from workspace root to allow access to all projects
-    root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
-    os.chdir(root_dir)
-    print(f"Serving workspace from: {root_dir}")
+class ClassicServer(socketserver.TCPServer):
+    # One connection at a time: an idle keep-alive client would hold up everyone
+    # else for up to KEEPALIVE_TIMEOUT, so every response closes its connection
+    keep_alive = False
+
+class ThreadedServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    request_queue_size = LISTEN_BACKLOG
+
+class AsyncioServer(socketserver.TCPServer):
+    """Accepts connections on an asyncio loop and runs AuthHandler on a bounded pool.
+
+    The handler itself stays blocking (rfile/wfile, http.client streaming), so every
+    existing route works unchanged; the loop only owns accepting and the connection
+    limit. A keep-alive connection waiting for its next request still holds a slot,
+    so when a client is accepted with every slot taken, the longest-idle one is
+    closed, and until a slot frees up connections that go idle close instead of
+    waiting. Stopping closes idle connections too, so the drain isn't held up by them.
+    """
+    request_queue_size = LISTEN_BACKLOG
+
+    def __init__(self, server_address, RequestHandlerClass, bind_and_activate=True,
+                 max_connections=MAX_CONNECTIONS):
+        super().__init__(server_address, RequestHandlerClass, bind_and_activate)
+        self.max_connections = max_connections
+        self._loop = None
+        self._stop = None
+        self._idle_lock = threading.Lock()
+        self._idle = {}         # socket -> monotonic time it started waiting for a request
+        self._starved = False   # an accepted client is waiting for a slot
+        self._closing = False
+
+    def connection_idle(self, sock, kept_alive=True):
+        """Called by a handler about to wait for a request on `sock`; False means close
+        the connection instead. A new connection is never turned away, only reclaimed."""
+        with self._idle_lock:
+            if kept_alive and (self._starved or self._closing):
+                IDLE_RECLAIMED.inc()
+                return False
+            self._idle[sock] = time.monotonic()
+            return True
+
+    def connection_busy(self, sock):
+        """Called once a request arrives (or the connection ends); False if the slot was
+        reclaimed in the meantime."""
+        with self._idle_lock:
+            return self._idle.pop(sock, None) is not None
+
+    def _reclaim(self, count=1):
+        """Close up to `count` (None: all) of the longest-idle connections; their
+        handlers then exit."""
+        with self._idle_lock:
+            victims = sorted(self._idle, key=self._idle.get)[:count]
+            for sock in victims:
+                del self._idle[sock]
+        for sock in victims:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            IDLE_RECLAIMED.inc()
+
+    def serve_forever(self, poll_interval=0.5):
+        asyncio.run(self._serve())
+
+    def shutdown(self):
+        if self._loop and self._stop:
+            self._loop.call_soon_threadsafe(self._stop.set)
+        with self._idle_lock:
+            self._closing = True
+        self._reclaim(None)
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        slots = asyncio.Semaphore(self.max_connections)
+        pool = ThreadPoolExecutor(max_workers=self.max_connections, thread_name_prefix='conn')
+        self.socket.setblocking(False)
+        stop_wait = asyncio.ensure_future(self._stop.wait())
+        try:
+            while not self._stop.is_set():
+                accept = asyncio.ensure_future(self._loop.sock_accept(self.socket))
+                await asyncio.wait({accept, stop_wait}, return_when=asyncio.FIRST_COMPLETED)
+                if not accept.done():
+                    accept.cancel()
+                    break
+                try:
+                    conn, addr = accept.result()
+                except OSError as e:
+                    LOG.error('Server', f"accept failed: {e}")
+                    continue
+                if slots.locked():
+                    # At most this one client waits here; the rest stay in the backlog
+                    with self._idle_lock:
+                        self._starved = True
+                    self._reclaim()
+                acquire = asyncio.ensure_future(slots.acquire())
+                await asyncio.wait({acquire, stop_wait}, return_when=asyncio.FIRST_COMPLETED)
+                with self._idle_lock:
+                    self._starved = False
+                if not acquire.done():
+                    acquire.cancel()
+                    conn.close()
+                    break
+                conn.setblocking(True)
+                job = self._loop.run_in_executor(pool, self._handle_connection, conn, addr)
+                job.add_done_callback(lambda _job: slots.release())
+        finally:
+            stop_wait.cancel()
+            pool.shutdown(wait=False)
+
+    def _handle_connection(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+INDEX_FORWARDS = set()  # worker sockets of relayed /api/fs/events streams
+
+def make_server(engine, address, max_connections=MAX_CONNECTIONS, reuse_port=False, sock=None):
+    """Build the server for `engine`, binding `address` or adopting an already listening `sock`."""
+    if engine == 'asyncio':
+        httpd = AsyncioServer(address, AuthHandler, False, max_connections=max_connections)
+    elif engine == 'threaded':
+        httpd = ThreadedServer(address, AuthHandler, False)
+    else:
+        httpd = ClassicServer(address, AuthHandler, False)
+    if sock is not None:
+        httpd.socket.close()
+        httpd.socket = sock
+        httpd.server_address = sock.getsockname()
+        return httpd
+    try:
+        if reuse_port:
+            # Set here rather than through allow_reuse_port, which needs Python 3.11
+            httpd.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        httpd.server_bind()
+        httpd.server_activate()
+    except BaseException:
+        httpd.server_close()
+        raise
+    return httpd
+
+def drain(timeout=WORKER_DRAIN_TIMEOUT):
+    """Wait for in-flight SSE streams and open connections to finish, up to `timeout` s."""
+    deadline = time.monotonic() + timeout
+    while ACTIVE_STREAMS.value() > 0 or ACTIVE_CONNECTIONS.value() > 0:
+        if time.monotonic() >= deadline:
+            LOG.warn('Server', f"Drain timed out with {ACTIVE_STREAMS.value()} stream(s) "
+                              f"and {ACTIVE_CONNECTIONS.value()} connection(s) open")
+            return False
+        time.sleep(0.1)
+    return True
+
+def serve(args, reuse_port=False, sock=None, index_sock=None):
+    """Run one serving process until SIGTERM/SIGINT, then drain in-flight work.
+
+    Pre-forked workers get `index_sock`, a loopback listener shared by all of them:
+    worker 0 builds the workspace indexes and answers it, the others close it and
+    relay index routes there.
+    """
+    global INDEX_ADDRESS
+    indexer = None
+    if index_sock is not None and WORKER_INDEX != 0:
+        INDEX_ADDRESS = index_sock.getsockname()
+        index_sock.close()
+    else:
+        # Build the project catalog once, then keep it current in the background
+        WORKSPACE_POLLER.interval = args.poll_interval
+        WORKSPACE_POLLER.watch = args.watch
+        WORKSPACE_POLLER.poll()
+        WORKSPACE_POLLER.start()
+        if index_sock is not None:
+            indexer = make_server('threaded', None, sock=index_sock)
+            threading.Thread(target=indexer.serve_forever, name='index-server', daemon=True).start()
+
+    httpd = make_server(args.engine, ("", args.port), args.max_connections, reuse_port, sock)
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        if stopping.is_set():
+            return
+        stopping.set()
+        DRAINING.set()
+        LOG.info('Server', f"{signal.Signals(signum).name}: no longer accepting, draining "
+                          f"{ACTIVE_STREAMS.value()} stream(s)")
+        # shutdown() blocks until serve_forever() returns, so never call it on this thread
+        threading.Thread(target=httpd.shutdown, name='shutdown', daemon=True).start()
+        if indexer is not None:
+            threading.Thread(target=indexer.shutdown, name='index-shutdown', daemon=True).start()
+        for forward in list(INDEX_FORWARDS):
+            try:
+                forward.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
-    with socketserver.TCPServer(("", PORT), AuthHandler) as httpd:
-        print(f"Serving at port {PORT}")
-        print(f"Admin Password: {ADMIN_PASSWORD}")
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    with httpd:
         httpd.serve_forever()
+    drain(args.drain_timeout)
+
+def supervise(args):
+    """Pre-fork `args.workers` serving processes and keep that many running.
+
+    With SO_REUSEPORT every worker binds its own socket and the kernel spreads new
+    connections across them; otherwise the supervisor binds once and the workers
+    inherit the listening socket. Worker 0 alone watches the workspace and holds the
+    search, precache and project indexes; the others relay those routes to it over a
+    loopback socket bound here. SIGTERM/SIGINT is forwarded to every worker, which
+    stops accepting and drains before exiting; stragglers are killed once the drain
+    timeout has passed.
+    """
+    reuse_port = hasattr(socket, 'SO_REUSEPORT')
+    sock = None
+    if not reuse_port:
+        sock = socket.create_server(("", args.port), backlog=LISTEN_BACKLOG)
+    # Bound here so it outlives worker 0: while it restarts, relayed requests wait in
+    # the backlog instead of failing
+    index_sock = socket.create_server(('127.0.0.1', 0), backlog=LISTEN_BACKLOG)
+    METRICS_SPOOL.clear()
+    workers = {}  # pid -> (index, started)
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            global WORKER_INDEX
+            WORKER_INDEX = index
+            if LOG.path:
+                # One file per worker: rotation renames files, which can't be shared safely
+                root, ext = os.path.splitext(LOG.path)
+                LOG.path = f'{root}.w{index}{ext}'
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            code = 0
+            try:
+                METRICS_SPOOL.start()
+                serve(args, reuse_port=reuse_port, sock=sock, index_sock=index_sock)
+            except BaseException:
+                LOG.error('Server', f"Worker {index} crashed:\n{traceback.format_exc().rstrip()}")
+                code = 1
+            finally:
+                METRICS_SPOOL.remove(os.getpid())
+                LOG.flush()
+                sys.stdout.flush()
+                os._exit(code)
+        workers[pid] = (index, time.monotonic())
+
+    def stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            LOG.info('Supervisor', f"{signal.Signals(signum).name}: stopping {len(workers)} worker(s)")
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for index in range(args.workers):
+        spawn(index)
+    # Only the supervisor handles these; workers install their own in serve()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    LOG.info('Supervisor', f"{args.workers} workers on port {args.port} "
+                          f"({'SO_REUSEPORT' if reuse_port else 'shared socket'}, engine={args.engine})")
+
+    kill_at = None
+    while workers:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            if stopping:
+                kill_at = kill_at or time.monotonic() + args.drain_timeout + 5
+                if time.monotonic() >= kill_at:
+                    for straggler in list(workers):
+                        LOG.warn('Supervisor', f"Killing worker pid {straggler} after drain timeout")
+                        os.kill(straggler, signal.SIGKILL)
+                    kill_at = float('inf')
+            time.sleep(0.2)
+            continue
+        index, started = workers.pop(pid, (None, 0.0))
+        METRICS_SPOOL.remove(pid)
+        if index is None or stopping:
+            continue
+        LOG.error('Supervisor', f"Worker {index} (pid {pid}) exited with status "
+                                f"{os.waitstatus_to_exitcode(status)}; restarting")
+        if time.monotonic() - started < WORKER_RESTART_DELAY:
+            time.sleep(WORKER_RESTART_DELAY)
+        spawn(index)
+    if sock is not None:
+        sock.close()
+    index_sock.close()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="skAIxuide workspace server + kAIxu gateway proxy")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--gateway', default=GATEWAY_HOST,
+                        help="kAIxu gateway base URL to proxy /api/* to (default: %(default)s)")
+    parser.add_argument('--engine', choices=ENGINES, default=DEFAULT_ENGINE,
+                        help="serving engine (default: %(default)s)")
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help="concurrent connections for the asyncio engine (default: %(default)s)")
+    parser.add_argument('--keepalive-timeout', type=float, default=KEEPALIVE_TIMEOUT,
+                        help="seconds an idle HTTP/1.1 client connection stays open (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="pre-fork this many serving processes sharing the port, "
+                             "restarted if they crash (default: %(default)s)")
+    parser.add_argument('--drain-timeout', type=float, default=WORKER_DRAIN_TIMEOUT,
+                        help="on SIGTERM, seconds to let in-flight streams finish (default: %(default)s)")
+    parser.add_argument('--upstream-timeout', type=float, default=UPSTREAM_TIMEOUT,
+                        help="longest wait for gateway response headers; shortened automatically "
+                             "once recent TTFB is known (default: %(default)s)")
+    parser.add_argument('--hedge', action='store_true',
+                        help="send a second copy of a slow gateway-chat request after its p95 "
+                             "latency and use whichever answers first (costs extra tokens)")
+    parser.add_argument('--max-ai-calls', type=int, default=ADMISSION_MAX_ACTIVE,
+                        help="concurrent proxied gateway calls; more wait in a fair queue (default: %(default)s)")
+    parser.add_argument('--max-ai-calls-per-client', type=int, default=ADMISSION_MAX_PER_CLIENT,
+                        help="concurrent gateway calls per key/IP (default: %(default)s)")
+    parser.add_argument('--queue-timeout', type=float, default=ADMISSION_QUEUE_TIMEOUT,
+                        help="seconds a gateway call may wait for a slot before a 503 (default: %(default)s)")
+    parser.add_argument('--replay-mb', type=float, default=REPLAY_MAX_BYTES / 2**20,
+                        help="memory for resumable gateway streams; a client that reconnects with "
+                             "Last-Event-ID gets only what it missed. 0 disables (default: %(default)s)")
+    parser.add_argument('--replay-ttl', type=float, default=REPLAY_TTL,
+                        help="seconds a finished stream stays resumable (default: %(default)s)")
+    parser.add_argument('--static-cache-mb', type=float, default=STATIC_CACHE_MAX_BYTES / 2**20,
+                        help="memory ceiling for the static file cache, 0 disables (default: %(default)s)")
+    parser.add_argument('--max-body-mb', type=float, default=MAX_BODY_BYTES / 2**20,
+                        help="largest request body the proxy forwards (default: %(default)s)")
+    parser.add_argument('--chat-cache-ttl', type=float, default=CHAT_CACHE_TTL,
+                        help="cache identical gateway-chat responses for this many seconds "
+                             "and coalesce concurrent duplicates; 0 disables (default: %(default)s)")
+    parser.add_argument('--proxy-diag', choices=('off', 'sample', 'full'), default=PROXY_DIAG,
+                        help="per-chunk SSE diagnostics: sample logs the first and every "
+                             f"{PROXY_DIAG_SAMPLE_EVERY}th chunk (default: %(default)s)")
+    parser.add_argument('--log-file', default=LOG_FILE,
+                        help="also append JSON-lines log records to this file, rotated by size "
+                             "(one file per worker with --workers)")
+    parser.add_argument('--log-max-mb', type=float, default=LOG_MAX_BYTES / 2**20,
+                        help="rotate the log file past this size (default: %(default)s)")
+    parser.add_argument('--log-backups', type=int, default=LOG_BACKUPS,
+                        help="rotated log files to keep (default: %(default)s)")
+    parser.add_argument('--watch', choices=('auto', 'poll'), default=WORKSPACE_WATCH,
+                        help="how workspace changes are noticed: auto uses inotify where available "
+                             "and falls back to polling (default: %(default)s)")
+    parser.add_argument('--poll-interval', type=float, default=WORKSPACE_POLL_INTERVAL,
+                        help="seconds between workspace change polls when not using inotify "
+                             "(default: %(default)s)")
+    parser.add_argument('--optimize', action='store_true',
+                        help="serve HTML/CSS/JS minified, with local asset URLs fingerprinted "
+                             "and cached as immutable; outputs are kept under .cache/")
+    parser.add_argument('--prewarm', action='store_true',
+                        help="build precompressed gzip/brotli variants for the workspace in the background")
+    parser.add_argument('--prewarm-only', action='store_true',
+                        help="build precompressed variants, then exit without serving")
+    args = parser.parse_args(argv)
+    if args.workers > 1:
+        # Checked here so a bad setup fails once, not as a crash-looping worker
+        if not hasattr(os, 'fork'):
+            parser.error("--workers needs os.fork(), which this platform does not have")
+        if sys.version_info < WORKERS_MIN_PYTHON:
+            parser.error("--workers needs Python %d.%d or newer (running %d.%d)"
+                         % (WORKERS_MIN_PYTHON + sys.version_info[:2]))
+    return args
+
+def main(argv=None):
+    global GATEWAY_HOST, MAX_BODY_BYTES, PROXY_DIAG
+    args = parse_args(argv)
+    STATIC_CACHE.max_bytes = int(args.static_cache_mb * 2**20)
+    GATEWAY_HOST = args.gateway.rstrip('/')
+    CHAT_CACHE.ttl = args.chat_cache_ttl
+    UPSTREAM_POOL.timeout = args.upstream_timeout
+    AuthHandler.timeout = args.keepalive_timeout
+    ADMISSION.max_active = args.max_ai_calls
+    ADMISSION.max_per_client = args.max_ai_calls_per_client
+    ADMISSION.chat_reserve = min(ADMISSION_CHAT_RESERVE, max(args.max_ai_calls - 1, 0))
+    ADMISSION.queue_timeout = args.queue_timeout
+    UPSTREAM_POOL.hedge = args.hedge
+    REPLAY.max_bytes = int(args.replay_mb * 2**20)
+    REPLAY.ttl = args.replay_ttl
+    OPTIMIZER.enabled = args.optimize
+    MAX_BODY_BYTES = int(args.max_body_mb * 2**20)
+    PROXY_DIAG = args.proxy_diag
+    LOG.configure(args.log_file and os.path.abspath(args.log_file),
+                  int(args.log_max_mb * 2**20), args.log_backups)
+    atexit.register(LOG.flush)
+
+    # Serve from workspace root to allow access to all projects
+    os.chdir(WORKSPACE_ROOT)
+    LOG.info('', f"Serving workspace from: {WORKSPACE_ROOT}")
+
+    def prewarm():
+        started = time.time()
+        files, built = PRECOMPRESSED.prewarm()
+        LOG.info('Compress', f"Pre-warm done: {files} files, {built} variants built "
+                            f"in {time.time() - started:.1f}s ({', '.join(available_encodings())})")
+
+    if args.prewarm_only:
+        prewarm()
+        return
+    # Straight to the console: the secret must not reach the log file or /api/logs
+    LOG.flush()
+    print(f"Admin Password: {ADMIN_PASSWORD}", flush=True)
+    if args.workers > 1:
+        if args.prewarm:
+            # Sidecars are shared on disk, so build them once before forking
+            prewarm()
+        supervise(args)
+        return
+    if args.prewarm:
+        threading.Thread(target=prewarm, name='prewarm', daemon=True).start()
+    LOG.info('', f"Serving at port {args.port} (engine={args.engine})")
+    serve(args)
+
+if __name__ == "__main__":
+    main()
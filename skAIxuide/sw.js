@@ -1,10 +1,38 @@
 
 const CACHE_NAME = 'pwa-cache-1771570976539';
 const URLS_TO_CACHE = ["./","./index.html","./manifest.json","./icon-192.png","./icon-512.png","https://cdn.tailwindcss.com","https://cdnjs.cloudflare.com/ajax/libs/three.js/r128/three.min.js","https://unpkg.com/lucide@latest","https://fonts.googleapis.com/css2?family=Inter:wght@300;400;600;900&family=JetBrains+Mono:wght@100..800&display=swap","https://cdn1.sharemyimage.com/2026/02/15/ChatGPT-Image-Feb-15-2026-05_15_46-AM-1.png","https://cdn1.sharemyimage.com/2026/02/15/Screenshot-2026-02-14-1.45.11-PM-3.png"];
-self.addEventListener('install', event => { event.waitUntil(caches.open(CACHE_NAME).then(cache => cache.addAll(URLS_TO_CACHE).catch(e => console.error(e)))); self.skipWaiting(); });
-self.addEventListener('fetch', event => { 
+// Local assets are precached from server.py's content-hash manifest: only entries whose
+// hash changed are re-downloaded. Without the manifest (static hosting) URLS_TO_CACHE is used.
+const PRECACHE_NAME = 'skaixuide-precache';
+const PRECACHE_MANIFEST_URL = '/api/fs/precache?project=skAIxuide';
+const PRECACHE_MANIFEST_KEY = './__precache-manifest.json';
+const PRECACHE_SYNC_EVERY = 60 * 1000;
+let lastPrecacheSync = 0;
+async function syncPrecache() {
+    lastPrecacheSync = Date.now();
+    const res = await fetch(PRECACHE_MANIFEST_URL, { cache: 'no-cache' });
+    if (!res.ok) throw new Error(`precache manifest: HTTP ${res.status}`);
+    const next = await res.json();
+    const cache = await caches.open(PRECACHE_NAME);
+    const stored = await cache.match(PRECACHE_MANIFEST_KEY);
+    const prev = stored ? await stored.json() : { version: null, assets: {} };
+    if (prev.version === next.version) return;
+    const changed = Object.keys(next.assets).filter(url => prev.assets[url] !== next.assets[url]);
+    await Promise.all(changed.map(url => cache.add(new Request(url, { cache: 'reload' })).catch(e => {
+        // Remember the old hash (or none) so the next sync retries this entry
+        console.error('precache', url, e);
+        if (url in prev.assets) next.assets[url] = prev.assets[url]; else delete next.assets[url];
+        next.version = null;
+    })));
+    await Promise.all(Object.keys(prev.assets).filter(url => !(url in next.assets)).map(url => cache.delete(url)));
+    await cache.put(PRECACHE_MANIFEST_KEY, new Response(JSON.stringify(next), { headers: { 'Content-Type': 'application/json' } }));
+}
+self.addEventListener('install', event => { event.waitUntil(syncPrecache().then(() => URLS_TO_CACHE.filter(u => /^https?:/.test(u)), e => { console.warn(e); return URLS_TO_CACHE; }).then(urls => caches.open(CACHE_NAME).then(cache => cache.addAll(urls).catch(e => console.error(e))))); self.skipWaiting(); });
+self.addEventListener('fetch', event => {
     // Network First strategy for HTML navigation requests
     if (event.request.mode === 'navigate') {
+        // Navigations double as the trigger to pick up changed assets
+        if (Date.now() - lastPrecacheSync > PRECACHE_SYNC_EVERY) event.waitUntil(syncPrecache().catch(() => null));
         event.respondWith(
             fetch(event.request)
                 .then(res => {
@@ -16,8 +44,9 @@ self.addEventListener('fetch', event => {
         );
         return;
     }
-    
+
     // Cache First for everything else
-    event.respondWith(caches.match(event.request).then(response => response || fetch(event.request).then(res => { if(!res || res.status !== 200 || res.type !== 'basic') return res; const rc = res.clone(); caches.open(CACHE_NAME).then(c => c.put(event.request, rc)); return res; }).catch(() => null))); 
+    // (precached copies first: they are the ones kept in step with the manifest)
+    event.respondWith(caches.open(PRECACHE_NAME).then(c => c.match(event.request)).then(hit => hit || caches.match(event.request)).then(response => response || fetch(event.request).then(res => { if(!res || res.status !== 200 || res.type !== 'basic') return res; const rc = res.clone(); caches.open(CACHE_NAME).then(c => c.put(event.request, rc)); return res; }).catch(() => null)));
 });
-self.addEventListener('activate', event => { const whitelist = [CACHE_NAME]; event.waitUntil(caches.keys().then(names => Promise.all(names.map(n => whitelist.indexOf(n) === -1 ? caches.delete(n) : null)))); self.clients.claim(); });
\ No newline at end of file
+self.addEventListener('activate', event => { const whitelist = [CACHE_NAME, PRECACHE_NAME]; event.waitUntil(caches.keys().then(names => Promise.all(names.map(n => whitelist.indexOf(n) === -1 ? caches.delete(n) : null)))); self.clients.claim(); });
@@ -0,0 +1,1302 @@
+"""Unit tests for server.py internals that need no network or gateway.
+
+    python -m pytest -q skAIxuide
+"""
+import gzip
+import hashlib
+import http.client
+import http.server
+import io
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import server  # noqa: E402
+
+def event(n, size=100):
+    return b'event: delta\ndata: ' + str(n).encode().rjust(size, b'x') + b'\n\n'
+
+class ReplayBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.replay = server.ReplayBuffer(max_bytes=2000, stream_max_bytes=1500, ttl=60)
+
+    def open(self):
+        return self.replay.open('id', 'gateway-stream', 200, [])
+
+    def drain(self, stream, after=0, max_reads=100):
+        """Read like relay_stream does until done; returns (events, skipped, reads)."""
+        got, skipped = [], 0
+        for reads in range(1, max_reads + 1):
+            events, after, missed, done = self.replay.read(stream, after, 0)
+            got += events
+            skipped += missed
+            if done:
+                return got, skipped, reads
+        self.fail(f"reader never finished after {max_reads} reads (after={after})")
+
+    def test_reader_behind_a_trimmed_running_stream_finishes(self):
+        behind = self.open()
+        self.replay.attach(behind)
+        self.replay.feed(behind, event(0, size=1000))
+        # Over the global cap, the biggest running stream loses its events, all of them
+        other = self.open()
+        for n in range(8):
+            self.replay.feed(other, event(n))
+        self.assertEqual(len(behind.events), 0)
+        self.replay.finish(behind)
+        got, skipped, _ = self.drain(behind)
+        self.assertEqual((got, skipped), ([], 1))
+
+    def test_reader_of_an_evicted_stream_finishes(self):
+        behind = self.open()
+        for n in range(5):
+            self.replay.feed(behind, event(n))
+        self.replay.finish(behind)
+        # Nobody is attached, so the next stream's growth evicts it entirely
+        other = self.open()
+        for n in range(30):
+            self.replay.feed(other, event(n))
+        self.assertEqual(self.replay.counters['evicted'], 1)
+        got, skipped, _ = self.drain(behind)
+        self.assertEqual((got, skipped), ([], 5))
+
+    def test_subscribed_stream_is_not_evicted(self):
+        reading = self.open()
+        self.replay.attach(reading)
+        for n in range(5):
+            self.replay.feed(reading, event(n))
+        self.replay.finish(reading)
+        other = self.open()
+        for n in range(30):
+            self.replay.feed(other, event(n))
+        self.assertEqual(self.replay.counters['evicted'], 0)
+        got, skipped, reads = self.drain(reading)
+        self.assertEqual((len(got), skipped, reads), (5, 0, 1))
+
+class LogPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        patcher = mock.patch('sys.stdout', io.StringIO())
+        self.stdout = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_records_are_printed_and_written_as_json_lines(self):
+        log = server.LogPipeline()
+        log.configure(os.path.join(self.tmp.name, 'server.log'))
+        log.info('Proxy', 'hello', status=200)
+        log.debug('Proxy', 'detail')
+        log.info('', 'plain')
+        self.assertTrue(log.flush())
+        self.assertEqual(self.stdout.getvalue(), '[Proxy] hello\n[Proxy][DIAG] detail\nplain\n')
+        with open(log.path) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([(r['seq'], r['level'], r['msg']) for r in records],
+                         [(1, 'info', 'hello'), (2, 'debug', 'detail'), (3, 'info', 'plain')])
+        self.assertEqual(records[0]['status'], 200)
+
+    def test_file_is_rotated_by_size(self):
+        log = server.LogPipeline()
+        log.configure(os.path.join(self.tmp.name, 'server.log'), max_bytes=300, backups=2)
+        for i in range(40):
+            log.info('Test', f'record {i:03d} ' + 'x' * 40)
+            log.flush()  # one record per write, so every file ends just past the limit
+        names = sorted(os.listdir(self.tmp.name))
+        self.assertEqual(names, ['server.log', 'server.log.1', 'server.log.2'])
+        self.assertGreater(log.counters['rotations'], 2)
+        for name in names[1:]:
+            self.assertGreaterEqual(os.path.getsize(os.path.join(self.tmp.name, name)), 300)
+        with open(os.path.join(self.tmp.name, 'server.log')) as f:
+            last = [json.loads(line)['msg'] for line in f]
+        self.assertTrue(last[-1].startswith('record 039'))
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        log = server.LogPipeline(queue_size=8)
+        writing, release = threading.Event(), threading.Event()
+        write = log._write
+
+        def blocked_write(batch):
+            writing.set()
+            release.wait(5)
+            write(batch)
+
+        log._write = blocked_write
+        log.info('Test', 'first')
+        self.assertTrue(writing.wait(5))  # the writer holds 'first'; the queue is empty
+        started = time.monotonic()
+        for i in range(10):
+            log.info('Test', f'info {i}')   # 6 fit under LOG_PRESSURE (0.75 * 8)
+        for i in range(4):
+            log.error('Test', f'error {i}')  # errors fill the queue to the brim
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(log.counters['dropped'], 4 + 2)
+        self.assertEqual(len(log.recent(limit=100)), 15)  # the ring keeps everything
+        release.set()
+        self.assertTrue(log.flush())
+        self.assertEqual(log.snapshot()['written'], 1 + 6 + 2)
+
+    def test_recent_filters(self):
+        log = server.LogPipeline()
+        log.info('Proxy', 'Gateway ok')
+        log.warn('Proxy', 'slow gateway')
+        log.error('Search', 'index failed')
+        log.flush()
+        msgs = lambda **kw: [r['msg'] for r in log.recent(**kw)]
+        self.assertEqual(msgs(level='warn'), ['slow gateway', 'index failed'])
+        self.assertEqual(msgs(component='Proxy', search='GATEWAY'), ['Gateway ok', 'slow gateway'])
+        self.assertEqual(msgs(since=2), ['index failed'])
+        self.assertEqual(msgs(limit=1), ['index failed'])
+
+class MetricsRenderTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = server.MetricsRegistry(prefix='t')
+        self.requests = self.registry.counter('requests_total', 'Requests', ('route', 'status'))
+        self.open = self.registry.gauge('open', 'Open connections')
+        self.latency = self.registry.histogram('latency_seconds', 'Latency', (0.1, 1))
+        self.registry.collect('cache', lambda: {'hits': 3, 'hit_ratio': 0.5, 'enabled': True, 'name': 'x'})
+
+    def lines(self, peers=()):
+        return self.registry.render(peers).splitlines()
+
+    def test_render_exposition_text(self):
+        self.requests.inc('/api', 200)
+        self.requests.inc('/api', 200, amount=2)
+        self.open.inc()
+        self.open.inc()
+        self.open.dec()
+        for value in (0.05, 0.5, 5):
+            self.latency.observe(value)
+        lines = self.lines()
+        self.assertIn('# HELP t_requests_total Requests', lines)
+        self.assertIn('# TYPE t_requests_total counter', lines)
+        self.assertIn('t_requests_total{route="/api",status="200"} 3', lines)
+        self.assertIn('t_open 1', lines)
+        self.assertIn('# TYPE t_latency_seconds histogram', lines)
+        # Buckets are cumulative and +Inf equals the count
+        self.assertIn('t_latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('t_latency_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('t_latency_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('t_latency_seconds_sum 5.55', lines)
+        self.assertIn('t_latency_seconds_count 3', lines)
+
+    def test_collectors_export_numeric_fields_only(self):
+        lines = self.lines()
+        self.assertIn('t_cache_hits 3', lines)
+        self.assertIn('t_cache_hit_ratio 0.5', lines)
+        self.assertFalse([l for l in lines if 'enabled' in l or 't_cache_name' in l])
+
+    def test_peer_snapshots_are_summed(self):
+        self.requests.inc('/api', 200)
+        self.latency.observe(0.05)
+        peer = server.MetricsRegistry(prefix='t')
+        peer.counter('requests_total', 'Requests', ('route', 'status')).inc('/api', 200, amount=4)
+        peer.histogram('latency_seconds', 'Latency', (0.1, 1)).observe(0.5)
+        peer.collect('cache', lambda: {'hits': 2, 'hit_ratio': 1.0})
+        snapshot = json.loads(json.dumps(peer.snapshot()))  # as read back from the spool
+        lines = self.lines([snapshot])
+        self.assertIn('t_requests_total{route="/api",status="200"} 5', lines)
+        self.assertIn('t_latency_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('t_latency_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('t_latency_seconds_count 2', lines)
+        self.assertIn('t_cache_hits 5', lines)
+        self.assertIn('t_cache_hit_ratio 0.75', lines)  # ratios are averaged
+
+class MetricsSpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def worker(self, requests):
+        registry = server.MetricsRegistry(prefix='t')
+        registry.counter('requests_total', 'Requests').inc(amount=requests)
+        return server.MetricsSpool(registry, self.tmp.name, interval=3600)
+
+    def test_render_sums_every_worker_once(self):
+        own = self.worker(1)
+        self.assertIn('t_requests_total 1', own.render().splitlines())  # not started: this process only
+        for pid, requests in ((101, 10), (102, 100)):
+            with open(own.path(pid), 'w') as f:
+                json.dump(self.worker(requests).registry.snapshot(), f)
+        with open(own.path(103), 'w') as f:
+            f.write('{"metrics": ')  # a worker caught mid-write is skipped
+        own.start()
+        lines = own.render().splitlines()
+        # Our own spool file is not counted twice against the live registry
+        self.assertTrue(os.path.exists(own.path(os.getpid())))
+        self.assertIn('t_requests_total 111', lines)
+
+    def test_exited_workers_are_removed(self):
+        spool = self.worker(1)
+        for pid in (201, 202):
+            with open(spool.path(pid), 'w') as f:
+                json.dump(self.worker(5).registry.snapshot(), f)
+        spool.enabled = True
+        spool.remove(201)
+        self.assertIn('t_requests_total 6', spool.render().splitlines())
+        spool.clear()
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+class GatewayResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = server.GatewayResponseCache(ttl=60, max_entries=2, max_response_bytes=100)
+
+    def response(self, status=200, body=b'{"ok": true}'):
+        return server.CachedResponse(status, 'OK', [('Content-Type', 'application/json')], body)
+
+    def test_key_normalizes_json_and_splits_callers(self):
+        key = server.GatewayResponseCache.key
+        self.assertEqual(key('/chat', 'k', b'{"a": 1, "b": 2}'), key('/chat', 'k', b'{"b":2,"a":1}'))
+        self.assertNotEqual(key('/chat', 'k', b'{"a":1}'), key('/chat', 'other', b'{"a":1}'))
+        self.assertNotEqual(key('/chat', 'k', b'{"a":1}'), key('/stream', 'k', b'{"a":1}'))
+        self.assertEqual(key('/chat', None, b'not json'), key('/chat', '', b'not json'))
+
+    def test_stored_response_is_a_hit_until_it_expires(self):
+        loader = mock.Mock(return_value=self.response())
+        self.assertEqual(self.cache.fetch('k', loader)[1], 'MISS')
+        self.assertEqual(self.cache.fetch('k', loader)[1], 'HIT')
+        self.assertEqual(loader.call_count, 1)
+        with mock.patch.object(server.time, 'monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(self.cache.fetch('k', loader)[1], 'MISS')
+        self.assertEqual(self.cache.counters['expired'], 1)
+
+    def test_errors_and_oversized_responses_are_not_stored(self):
+        self.cache.fetch('err', lambda: self.response(status=502))
+        self.cache.fetch('big', lambda: self.response(body=b'x' * 101))
+        self.assertEqual(self.cache.snapshot()['entries'], 0)
+        with self.assertRaises(OSError):
+            self.cache.fetch('boom', mock.Mock(side_effect=OSError('down')))
+        self.assertEqual(self.cache.fetch('boom', self.response)[1], 'MISS')
+
+    def test_least_recently_used_entry_is_evicted(self):
+        for key in ('a', 'b'):
+            self.cache.fetch(key, self.response)
+        self.cache.fetch('a', self.response)  # touch: b is now the oldest
+        self.cache.fetch('c', self.response)
+        self.assertEqual(self.cache.fetch('a', self.response)[1], 'HIT')
+        self.assertEqual(self.cache.fetch('b', self.response)[1], 'MISS')
+        self.assertEqual(self.cache.counters['evictions'], 2)
+
+    def test_concurrent_identical_requests_share_one_call(self):
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return self.response()
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(self.cache.fetch('k', loader)[1]))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(self.cache.fetch('k', loader)[1]))
+                     for _ in range(3)]
+        for t in followers:
+            t.start()
+        while self.cache.counters['coalesced'] < 3:
+            time.sleep(0.01)
+        release.set()
+        for t in [leader] + followers:
+            t.join(5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), ['COALESCED'] * 3 + ['MISS'])
+
+    def test_followers_see_the_leaders_error(self):
+        started, release = threading.Event(), threading.Event()
+
+        def loader():
+            started.set()
+            release.wait(5)
+            raise OSError('gateway down')
+
+        errors = []
+
+        def fetch():
+            try:
+                self.cache.fetch('k', loader)
+            except OSError as e:
+                errors.append(str(e))
+
+        threads = [threading.Thread(target=fetch)]
+        threads[0].start()
+        started.wait(5)
+        threads.append(threading.Thread(target=fetch))
+        threads[1].start()
+        while self.cache.counters['coalesced'] < 1:
+            time.sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual(errors, ['gateway down'] * 2)
+
+class SSEParserTest(unittest.TestCase):
+    STREAM = (b'id: 1\nevent: meta\ndata: {"month": "2026-10"}\n\n'
+              b'event: delta\ndata: {"text": "hel"}\n\n'
+              b'id: 2\r\nevent: delta\r\ndata: {"text": "lo"}\r\n\r\n'
+              b': keep-alive comment\n\n'
+              b'data: first\ndata: second\n\n'
+              b'event: done\ndata: {"usage": {"input_tokens": 3, "output_tokens": 5}}\n\n')
+    EXPECTED = [('meta', b'{"month": "2026-10"}'), ('delta', None), ('delta', None),
+                ('message', None), ('done', b'{"usage": {"input_tokens": 3, "output_tokens": 5}}')]
+
+    def parse(self, chunks, **kwargs):
+        parser = server.SSEParser(**kwargs)
+        events = []
+        for chunk in chunks:
+            events.extend(parser.feed(chunk))
+        return parser, events
+
+    def test_whole_stream(self):
+        parser, events = self.parse([self.STREAM])
+        self.assertEqual(events, self.EXPECTED)
+        self.assertEqual(parser.counts, {'meta': 1, 'delta': 2, 'message': 1, 'done': 1})
+        self.assertEqual(parser.last_id, '2')
+
+    def test_any_chunking_gives_the_same_events(self):
+        for size in (1, 2, 3, 7, 16):
+            chunks = [self.STREAM[i:i + size] for i in range(0, len(self.STREAM), size)]
+            self.assertEqual(self.parse(chunks)[1], self.EXPECTED, size)
+
+    def test_captured_multiline_data_is_joined(self):
+        _, events = self.parse([self.STREAM], capture=('message',))
+        self.assertIn(('message', b'first\nsecond'), events)
+
+    def test_captured_data_is_capped(self):
+        _, events = self.parse([b'event: meta\ndata: ' + b'x' * 50 + b'\ndata: yy\n\n'], max_data=52)
+        self.assertEqual(events, [('meta', b'x' * 50 + b'\nyy')])
+        _, events = self.parse([b'event: meta\ndata: ' + b'x' * 60 + b'\n\n'], max_data=52)
+        self.assertEqual(events, [('meta', b'')])
+
+    def test_usage_ledger_folds_stream_events(self):
+        ledger = server.UsageLedger()
+        ledger.record_events('ip:a', self.parse([self.STREAM])[1])
+        ledger.record_events('ip:a', [('error', b'{"error": "quota"}')])
+        row = ledger.snapshot()['callers'][0]
+        self.assertEqual((row['streams'], row['errors'], row['input_tokens'], row['output_tokens'], row['month']),
+                         (2, 1, 3, 5, '2026-10'))
+
+class AdmissionControllerTest(unittest.TestCase):
+    def controller(self, **kwargs):
+        kwargs = dict(dict(max_active=1, max_per_client=1, chat_reserve=0, max_queue=10,
+                           max_queued_per_client=5, queue_timeout=5), **kwargs)
+        self.admission = server.AdmissionController(**kwargs)
+        self.granted = []
+        return self.admission
+
+    def queue(self, identity, klass='chat'):
+        """Start a blocked acquire() and return once it is in the queue."""
+        waiting = self.admission.snapshot()['waiting']
+
+        def run():
+            self.admission.acquire(identity, klass)
+            self.granted.append((identity, klass))
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        deadline = time.monotonic() + 5
+        while self.admission.snapshot()['waiting'] == waiting and time.monotonic() < deadline:
+            time.sleep(0.005)
+        return thread
+
+    def release_in_turn(self, first, threads):
+        """Release the holder, then each grantee in turn; return the grant order."""
+        previous = first
+        for thread in threads:
+            count = len(self.granted)
+            self.admission.release(*previous)
+            deadline = time.monotonic() + 5
+            while len(self.granted) == count and time.monotonic() < deadline:
+                time.sleep(0.005)
+            previous = self.granted[-1]
+        for thread in threads:
+            thread.join(5)
+        return self.granted
+
+    def test_callers_take_turns(self):
+        admission = self.controller()
+        admission.acquire('hog', 'chat')
+        threads = [self.queue('a'), self.queue('a'), self.queue('a'), self.queue('b'), self.queue('c')]
+        order = [who for who, _ in self.release_in_turn(('hog', 'chat'), threads)]
+        self.assertEqual(order, ['a', 'b', 'c', 'a', 'a'])
+
+    def test_chat_goes_before_streams_and_keeps_a_reserved_slot(self):
+        admission = self.controller(max_active=2, max_per_client=5, chat_reserve=1)
+        admission.acquire('a', 'stream')
+        stream = self.queue('b', 'stream')  # the last slot is kept for chat
+        admission.acquire('c', 'chat')
+        chat = self.queue('d', 'chat')
+        self.release_in_turn(('c', 'chat'), [chat])
+        self.assertEqual(self.granted, [('d', 'chat')])
+        self.release_in_turn(('a', 'stream'), [stream])
+        self.assertEqual(self.granted[-1], ('b', 'stream'))
+
+    def test_per_client_limit_does_not_block_others(self):
+        admission = self.controller(max_active=3)
+        admission.acquire('a', 'chat')
+        thread = self.queue('a')
+        admission.acquire('b', 'chat')  # admitted at once
+        self.assertEqual(admission.snapshot()['running'], 2)
+        self.release_in_turn(('a', 'chat'), [thread])
+        self.assertEqual(self.granted, [('a', 'chat')])
+
+    def test_queue_timeout(self):
+        admission = self.controller(queue_timeout=0.05)
+        admission.acquire('a', 'chat')
+        with self.assertRaises(server.AdmissionRejected) as ctx:
+            admission.acquire('b', 'chat')
+        self.assertEqual((ctx.exception.reason, ctx.exception.status), ('queue_timeout', 503))
+        snapshot = admission.snapshot()
+        self.assertEqual((snapshot['timed_out'], snapshot['waiting']), (1, 0))
+        admission.release('a', 'chat')
+        admission.acquire('b', 'chat')  # the timed-out waiter left no trace in the queue
+
+    def test_full_queues_reject_at_once(self):
+        admission = self.controller(max_queue=2, max_queued_per_client=1)
+        admission.acquire('hog', 'chat')
+        threads = [self.queue('a')]
+        with self.assertRaises(server.AdmissionRejected) as ctx:
+            admission.acquire('a', 'chat')
+        self.assertEqual((ctx.exception.reason, ctx.exception.status), ('client_queue_full', 429))
+        threads.append(self.queue('b'))
+        with self.assertRaises(server.AdmissionRejected) as ctx:
+            admission.acquire('c', 'chat')
+        self.assertEqual((ctx.exception.reason, ctx.exception.status), ('queue_full', 503))
+        self.release_in_turn(('hog', 'chat'), threads)
+
+class CallerIdentityTest(unittest.TestCase):
+    def test_shared_server_key_is_split_by_client(self):
+        with mock.patch.object(server, 'KAIXU_VIRTUAL_KEY', 'team-key'):
+            a = server.caller_identity('Bearer team-key', ('10.0.0.1', 5000))
+            b = server.caller_identity('Bearer team-key', ('10.0.0.2', 5000))
+            self.assertNotEqual(a, b)
+            self.assertEqual(a, server.caller_identity('Bearer team-key', ('10.0.0.1', 6000)))
+
+    def test_own_key_is_one_client_everywhere(self):
+        with mock.patch.object(server, 'KAIXU_VIRTUAL_KEY', 'team-key'):
+            self.assertEqual(server.caller_identity('Bearer mine', ('10.0.0.1', 1)),
+                             server.caller_identity('Bearer mine', ('10.0.0.2', 1)))
+
+    def test_session_cookie_splits_callers_behind_one_address(self):
+        session, value = server.new_client_session()
+        self.assertEqual(server.client_session(f'a=1; {server.CLIENT_COOKIE}={value}'), session)
+        with mock.patch.object(server, 'KAIXU_VIRTUAL_KEY', 'team-key'):
+            for auth in ('Bearer team-key', None):
+                a = server.caller_identity(auth, ('10.0.0.1', 1), session)
+                b = server.caller_identity(auth, ('10.0.0.1', 1), server.new_client_session()[0])
+                self.assertNotEqual(a, b)
+                self.assertEqual(a, server.caller_identity(auth, ('10.0.0.9', 1), session))
+
+    def test_forged_session_cookie_is_ignored(self):
+        session, value = server.new_client_session()
+        self.assertIsNone(server.client_session(f'{server.CLIENT_COOKIE}={session}.0000000000000000'))
+        self.assertIsNone(server.client_session(f'{server.CLIENT_COOKIE}=other.{value.split(".")[1]}'))
+        self.assertIsNone(server.client_session(None))
+
+class UpstreamResilienceTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(server.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = server.CircuitBreaker('gw.test', threshold=3, cooldown=10)
+
+    def trip(self):
+        for _ in range(3):
+            self.breaker.check()
+            self.breaker.failure()
+
+    def test_retry_budget_is_a_fraction_of_traffic(self):
+        budget = server.RetryBudget(ratio=0.25, burst=2)
+        self.assertEqual([budget.withdraw() for _ in range(3)], [True, True, False])
+        for _ in range(3):
+            budget.deposit()
+        self.assertFalse(budget.withdraw())  # 0.75 tokens
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        for _ in range(100):
+            budget.deposit()
+        self.assertEqual(budget.tokens, 2)  # capped at the burst
+
+    def test_breaker_opens_after_consecutive_failures(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.breaker.success()  # a success resets the streak
+        self.breaker.failure()
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.breaker.failure()
+        self.assertEqual((self.breaker.state, self.breaker.trips), ('open', 1))
+        self.now += 4
+        with self.assertRaises(server.UpstreamUnavailable) as ctx:
+            self.breaker.check()
+        self.assertEqual(ctx.exception.retry_after, 6)
+
+    def test_half_open_lets_one_probe_through(self):
+        self.trip()
+        self.now += 10
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.breaker.check()
+        with self.assertRaises(server.UpstreamUnavailable):
+            self.breaker.check()
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.breaker.check()
+
+    def test_failed_probe_reopens_and_abandoned_probe_frees_the_slot(self):
+        self.trip()
+        self.now += 10
+        self.breaker.check()
+        self.breaker.abandon()
+        self.breaker.check()  # the slot is free again
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertEqual(self.breaker.trips, 1)  # still the same outage
+        self.now += 9
+        with self.assertRaises(server.UpstreamUnavailable):
+            self.breaker.check()
+
+    def test_adaptive_timeout_follows_recent_latency(self):
+        tracker = server.LatencyTracker(window=100, min_samples=20)
+        for _ in range(19):
+            tracker.observe('chat', 10.0)
+        self.assertEqual(tracker.timeout('chat', 120), 120)  # too few samples
+        tracker.observe('chat', 10.0)
+        self.assertEqual(tracker.timeout('chat', 120), 10.0 * server.UPSTREAM_TIMEOUT_FACTOR)
+        self.assertEqual(tracker.timeout('chat', 30), 30)  # never above the configured timeout
+        fast = server.LatencyTracker(window=100, min_samples=1)
+        fast.observe('chat', 0.01)
+        self.assertEqual(fast.timeout('chat', 120), server.UPSTREAM_TIMEOUT_MIN)
+
+class RequestBodyTest(unittest.TestCase):
+    def body(self, raw, length=None, **kwargs):
+        self.rfile = io.BufferedReader(io.BytesIO(raw))
+        return server.RequestBody(self.rfile, length, **kwargs)
+
+    def test_fixed_length_body_is_read_in_bounded_chunks(self):
+        body = self.body(b'0123456789NEXT', 10, chunk_size=4)
+        self.assertEqual(list(body), [b'0123', b'4567', b'89'])
+        self.assertTrue(body.complete)
+        self.assertEqual(self.rfile.read(), b'NEXT')  # the next request is left alone
+
+    def test_chunked_body_with_extensions_and_trailers(self):
+        raw = (b'5;ext=1\r\nhello\r\n'
+               b'6\r\n world\r\n'
+               b'0\r\nX-Checksum: abc\r\nX-Other: 1\r\n\r\n'
+               b'GET /next')
+        body = self.body(raw)
+        self.assertFalse(body.complete)
+        self.assertEqual(body.read_all(), b'hello world')
+        self.assertTrue(body.complete)
+        self.assertEqual(self.rfile.read(), b'GET /next')
+
+    def test_truncated_and_malformed_bodies(self):
+        with self.assertRaises(server.RequestBodyError):
+            self.body(b'short', 10).read_all()
+        with self.assertRaises(server.RequestBodyError):
+            self.body(b'a\r\nabc').read_all()
+        with self.assertRaises(server.RequestBodyError):
+            self.body(b'zz\r\n').read_all()
+
+    def test_limit(self):
+        with self.assertRaises(server.RequestBodyTooLarge):
+            self.body(b'x' * 11, 11, limit=10).read_all()
+        body = self.body(b'5\r\nhello\r\n10\r\n' + b'x' * 16 + b'\r\n0\r\n\r\n', limit=10)
+        pieces = iter(body)
+        self.assertEqual(next(pieces), b'hello')
+        # Refused on the declared chunk size, before its data is read
+        with self.assertRaises(server.RequestBodyTooLarge):
+            next(pieces)
+        self.assertEqual(self.rfile.read(1), b'x')
+        self.assertEqual(self.body(b'x' * 10, 10, limit=10).read_all(), b'x' * 10)
+
+class SpooledBodyTest(unittest.TestCase):
+    def test_upload_is_read_up_front_and_replayed(self):
+        data = bytes(range(256)) * 40
+        body = server.RequestBody(io.BytesIO(data), len(data), chunk_size=1000)
+        spooled = server.SpooledBody(body, max_memory=4096)
+        self.assertTrue(body.complete)
+        self.assertEqual((spooled.length, spooled.received), (len(data), len(data)))
+        # Past max_memory it lives in a temp file; either way it can be sent twice
+        self.assertTrue(spooled._file._rolled)
+        self.assertEqual(b''.join(spooled), data)
+        self.assertEqual(max(len(piece) for piece in spooled), 1000)
+        self.assertEqual(spooled.read_all(), data)
+        spooled.close()
+
+    def test_oversized_upload_fails_before_admission(self):
+        body = server.RequestBody(io.BytesIO(b'x' * 100), 100, limit=50)
+        with self.assertRaises(server.RequestBodyTooLarge):
+            server.SpooledBody(body)
+
+class UnfingerprintTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.realpath(self.tmp.name)
+        for name, body in (('app.js', b'let a = 1;\n'), ('page.html', b'<p>hi</p>')):
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write(body)
+        self.optimizer = server.AssetOptimizer(root=self.root, cache_dir=os.path.join(self.root, '.cache'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_only_the_current_hash_resolves(self):
+        source = os.path.join(self.root, 'app.js')
+        fp = self.optimizer.fingerprint(source)
+        self.assertEqual(self.optimizer.unfingerprint(os.path.join(self.root, f'app.{fp}.js')), source)
+        wrong = '0' * server.FINGERPRINT_LEN if fp != '0' * server.FINGERPRINT_LEN else '1' * server.FINGERPRINT_LEN
+        self.assertIsNone(self.optimizer.unfingerprint(os.path.join(self.root, f'app.{wrong}.js')))
+
+    def test_pages_are_never_fingerprinted(self):
+        fp = self.optimizer.fingerprint(os.path.join(self.root, 'page.html'))
+        self.assertIsNone(self.optimizer.unfingerprint(os.path.join(self.root, f'page.{fp}.html')))
+
+    def test_symlinked_root_still_fingerprints(self):
+        link = os.path.join(self.root, 'checkout')
+        os.symlink(self.root, link)
+        optimizer = server.AssetOptimizer(root=link, cache_dir=os.path.join(self.root, '.cache'))
+        # translate_path builds on os.getcwd(), which is the resolved directory
+        self.assertTrue(optimizer.fingerprintable(os.path.join(self.root, 'app.js')))
+        self.assertTrue(optimizer.fingerprintable(os.path.join(link, 'app.js')))
+
+class PrecompressedStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'app.js')
+        words = ['function', 'const', 'return', 'gateway', 'stream', 'let', 'if', 'else']
+        rng = random.Random(4)
+        self.body = '\n'.join(' '.join(rng.choice(words) for _ in range(10)) for _ in range(3000)).encode()
+        with open(self.path, 'wb') as f:
+            f.write(self.body)
+        self.store = server.PrecompressedStore(root=os.path.join(self.tmp.name, 'store'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def wait_for_background(self):
+        for _ in range(500):
+            with self.store._lock:
+                if not self.store._queued:
+                    return
+            time.sleep(0.01)
+        self.fail("background build never finished")
+
+    def test_first_request_gets_a_fast_variant_then_the_stored_one(self):
+        cache = server.StaticCache()
+        entry = cache.get(self.path)
+        fast = self.store.variant(self.path, entry, 'gzip', cache)
+        self.assertEqual(gzip.decompress(fast), self.body)
+        self.assertEqual(self.store.counters['fast_built'], 1)
+        self.wait_for_background()
+        best = server.compress(self.body, 'gzip')
+        self.assertLessEqual(len(best), len(fast))
+        self.assertEqual(entry.variants['gzip'], best)
+        self.assertEqual(cache._bytes, len(self.body) + len(best))
+        # A new process (or entry) finds the stored variant on disk
+        other = server.StaticCache()
+        self.assertEqual(self.store.variant(self.path, other.get(self.path), 'gzip', other), best)
+        self.assertEqual(self.store.counters['disk_hits'], 1)
+
+    def test_big_files_use_their_sidecar_once_built(self):
+        st = os.stat(self.path)
+        self.assertIsNone(self.store.open_file(self.path, st, 'gzip'))
+        self.wait_for_background()
+        with self.store.open_file(self.path, st, 'gzip') as f:
+            self.assertEqual(gzip.decompress(f.read()), self.body)
+
+    def test_sidecar_directory_is_capped(self):
+        self.store.max_bytes = 20000
+        for n in range(40):
+            data = self.body + str(n).encode()
+            self.store.build(hashlib.sha256(data).hexdigest()[:32], data, 'gzip')
+        on_disk = sum(os.path.getsize(os.path.join(d, name))
+                      for d, _, names in os.walk(self.store.root) for name in names)
+        self.assertLessEqual(on_disk, self.store.max_bytes)
+        self.assertGreater(self.store.counters['evicted'], 0)
+
+class StaticCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.cache = server.StaticCache(max_bytes=100, max_file_bytes=60)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_entry_is_dropped_when_the_file_changes(self):
+        path = self.write('a.css', b'body{}')
+        entry = self.cache.get(path)
+        self.assertIs(self.cache.get(path), entry)
+        self.assertEqual(entry.etag, '"%s"' % server.file_digest(path))
+        self.write('a.css', b'body{color:red}')
+        changed = self.cache.get(path)
+        self.assertEqual(changed.body, b'body{color:red}')
+        self.assertNotEqual(changed.etag, entry.etag)
+        self.assertEqual((self.cache.counters['hits'], self.cache.counters['invalidations']), (1, 1))
+
+    def test_size_limits(self):
+        self.assertIsNone(self.cache.get(self.write('big.js', b'x' * 61)))
+        self.assertIsNone(self.cache.get(os.path.join(self.tmp.name, 'missing.js')))
+        first, second, third = (self.write(f'{n}.js', b'x' * 40) for n in 'abc')
+        for path in (first, second, first, third):  # `second` is now the oldest
+            self.cache.get(path)
+        snapshot = self.cache.snapshot()
+        self.assertEqual((snapshot['entries'], snapshot['bytes'], snapshot['evictions']), (2, 80, 1))
+        self.cache.get(first)
+        self.assertEqual(self.cache.counters['hits'], 2)
+
+    def get(self, **headers):
+        cwd = os.getcwd()
+        os.chdir(server.WORKSPACE_ROOT)
+        httpd = server.make_server('threaded', ('127.0.0.1', 0))
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        try:
+            conn = http.client.HTTPConnection(*httpd.server_address, timeout=5)
+            conn.request('GET', '/skAIxuide/login.html', headers=headers)
+            resp = conn.getresponse()
+            body = resp.read()
+            conn.close()
+            return resp, body
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join(5)
+            os.chdir(cwd)
+
+    def test_conditional_requests_get_304(self):
+        resp, body = self.get()
+        etag, modified = resp.getheader('ETag'), resp.getheader('Last-Modified')
+        self.assertEqual(resp.status, 200)
+        for headers in ({'If-None-Match': etag}, {'If-None-Match': f'"other", W/{etag}'},
+                        {'If-None-Match': '*'}, {'If-Modified-Since': modified}):
+            resp, body = self.get(**headers)
+            self.assertEqual((resp.status, body), (304, b''), headers)
+            self.assertEqual(resp.getheader('ETag'), etag)
+        # If-None-Match wins over a matching If-Modified-Since
+        resp, body = self.get(**{'If-None-Match': '"other"', 'If-Modified-Since': modified})
+        self.assertEqual(resp.status, 200)
+        resp, _ = self.get(**{'If-Modified-Since': 'Thu, 01 Jan 1998 00:00:00 GMT'})
+        self.assertEqual(resp.status, 200)
+
+class RangeTest(unittest.TestCase):
+    def setUp(self):
+        cwd = os.getcwd()
+        os.chdir(server.WORKSPACE_ROOT)
+        self.addCleanup(os.chdir, cwd)
+        with open(os.path.join(server.WORKSPACE_ROOT, 'skAIxuide', 'login.html'), 'rb') as f:
+            self.data = f.read()
+
+    def get(self, **headers):
+        httpd = server.make_server('threaded', ('127.0.0.1', 0))
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        try:
+            conn = http.client.HTTPConnection(*httpd.server_address, timeout=5)
+            conn.request('GET', '/skAIxuide/login.html', headers=headers)
+            resp = conn.getresponse()
+            body = resp.read()
+            conn.close()
+            return resp, body
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join(5)
+
+    def test_parse_range(self):
+        parse = server.parse_range
+        self.assertEqual(parse('bytes=0-9', 100), [(0, 9)])
+        self.assertEqual(parse('bytes=90-', 100), [(90, 99)])
+        self.assertEqual(parse('bytes=-10', 100), [(90, 99)])
+        self.assertEqual(parse('bytes=-500', 100), [(0, 99)])   # suffix longer than the file
+        self.assertEqual(parse('bytes=50-500', 100), [(50, 99)])  # end clamped
+        self.assertEqual(parse('bytes=0-4, 20-29', 100), [(0, 4), (20, 29)])
+
+    def test_overlapping_and_adjacent_ranges_merge(self):
+        self.assertEqual(server.parse_range('bytes=20-29,0-9,5-14,15-16', 100), [(0, 16), (20, 29)])
+
+    def test_unsatisfiable_and_ignored_headers(self):
+        parse = server.parse_range
+        self.assertEqual(parse('bytes=100-', 100), [])
+        self.assertEqual(parse('bytes=100-200, 300-', 100), [])
+        self.assertEqual(parse('bytes=-0', 100), [])
+        for header in ('items=0-9', 'bytes=', 'bytes=5', 'bytes=9-3', 'bytes=a-b', 'bytes=-'):
+            self.assertIsNone(parse(header, 100), header)
+        many = 'bytes=' + ','.join(f'{i * 2}-{i * 2}' for i in range(server.MAX_RANGES + 1))
+        self.assertIsNone(parse(many, 100))
+
+    def test_single_range_response(self):
+        resp, body = self.get(Range='bytes=-10')
+        size = len(self.data)
+        self.assertEqual(resp.status, 206)
+        self.assertEqual(resp.getheader('Content-Range'), f'bytes {size - 10}-{size - 1}/{size}')
+        self.assertEqual(body, self.data[-10:])
+
+    def test_multipart_response(self):
+        resp, body = self.get(Range='bytes=0-4,10-14')
+        self.assertEqual(resp.status, 206)
+        ctype = resp.getheader('Content-Type')
+        self.assertTrue(ctype.startswith('multipart/byteranges; boundary='))
+        boundary = ctype.partition('boundary=')[2].encode()
+        parts = body.split(b'--' + boundary)
+        self.assertEqual(parts[-1], b'--\r\n')
+        self.assertEqual([p.partition(b'\r\n\r\n')[2].removesuffix(b'\r\n') for p in parts[1:-1]],
+                         [self.data[0:5], self.data[10:15]])
+        self.assertIn(b'Content-Range: bytes 10-14/%d' % len(self.data), parts[2])
+        self.assertEqual(len(body), int(resp.getheader('Content-Length')))
+
+    def test_unsatisfiable_range_is_a_416(self):
+        resp, body = self.get(Range=f'bytes={len(self.data)}-')
+        self.assertEqual((resp.status, body), (416, b''))
+        self.assertEqual(resp.getheader('Content-Range'), f'bytes */{len(self.data)}')
+
+    def test_stale_if_range_gets_the_whole_file(self):
+        resp, body = self.get(Range='bytes=0-4', **{'If-Range': '"stale"'})
+        self.assertEqual((resp.status, body), (200, self.data))
+        etag = resp.getheader('ETag')
+        resp, body = self.get(Range='bytes=0-4', **{'If-Range': etag})
+        self.assertEqual((resp.status, body), (206, self.data[:5]))
+
+class NegotiateEncodingTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(server, 'available_encodings', return_value=('br', 'gzip'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pick(self, header):
+        return server.negotiate_encoding(header)
+
+    def test_no_header_or_identity_only_is_uncompressed(self):
+        self.assertIsNone(self.pick(None))
+        self.assertIsNone(self.pick(''))
+        self.assertIsNone(self.pick('identity'))
+
+    def test_highest_q_wins_and_ties_prefer_brotli(self):
+        self.assertEqual(self.pick('gzip'), 'gzip')
+        self.assertEqual(self.pick('gzip, deflate, br'), 'br')
+        self.assertEqual(self.pick('br;q=0.5, gzip;q=0.8'), 'gzip')
+        self.assertEqual(self.pick('gzip; q=0.2, br; q=0.9'), 'br')
+
+    def test_q_zero_refuses_a_coding(self):
+        self.assertEqual(self.pick('br;q=0, gzip'), 'gzip')
+        self.assertIsNone(self.pick('br;q=0, gzip;q=0'))
+        self.assertIsNone(self.pick('gzip;q=bogus'))
+
+    def test_wildcard_covers_unlisted_codings(self):
+        self.assertEqual(self.pick('*'), 'br')
+        self.assertEqual(self.pick('br;q=0, *'), 'gzip')
+        self.assertEqual(self.pick('gzip;q=0.1, *;q=0.5'), 'br')
+        self.assertIsNone(self.pick('*;q=0'))
+
+    def test_only_available_codings_are_picked(self):
+        with mock.patch.object(server, 'available_encodings', return_value=('gzip',)):
+            self.assertIsNone(self.pick('br'))
+            self.assertEqual(self.pick('br, gzip;q=0.1'), 'gzip')
+
+class MinifyTest(unittest.TestCase):
+    def test_css_comments_and_whitespace(self):
+        src = '/* header */\na > b ,  .x  {\n  color: red ;\n  margin: calc(1px + 2px) ;\n}\n'
+        self.assertEqual(server.minify_css(src), 'a > b,.x{color:red;margin:calc(1px + 2px)}')
+        # A space before `:` is a descendant combinator in a selector
+        self.assertEqual(server.minify_css('a :hover { }'), 'a :hover{}')
+
+    def test_css_strings_are_verbatim(self):
+        src = """a::before { content: "  /* not a comment */  " ; font: 12px 'My  Font'; }"""
+        self.assertEqual(server.minify_css(src),
+                         """a::before{content:"  /* not a comment */  ";font:12px 'My  Font'}""")
+        self.assertEqual(server.minify_css(r'a { content: "\"}" }'), r'a{content:"\"}"}')
+
+    def test_css_that_cannot_be_tokenized_is_unchanged(self):
+        for src in ('a{x:"unterminated}', 'a{} /* open', 'a{x:"line\nbreak"}'):
+            self.assertEqual(server.minify_css(src), src)
+
+    def test_js_keeps_line_breaks_and_drops_comments(self):
+        src = '// lead\nfunction f(a, b) {\n    /* block */\n    return a / b / 2;   // div\n\n}\n'
+        self.assertEqual(server.minify_js(src), 'function f(a, b) {\nreturn a / b / 2;\n}')
+
+    def test_js_strings_and_regexes_are_verbatim(self):
+        src = ("const re = /\\/\\*not a comment*\\//g;  \n"
+               "  const s = \"// keep\"; const t = 'a/*b*/c';\n"
+               "if (x) y = /[/]}/.test(x)\nreturn /ab+c/i.exec(s)")
+        self.assertEqual(server.minify_js(src),
+                         "const re = /\\/\\*not a comment*\\//g;\n"
+                         "const s = \"// keep\"; const t = 'a/*b*/c';\n"
+                         "if (x) y = /[/]}/.test(x)\nreturn /ab+c/i.exec(s)")
+
+    def test_js_template_literals_are_verbatim(self):
+        src = 'let x = `line1\n    // not a comment\n    ${ {a: `inner ${ b }`}.a }  /* text */\n  end`;\n  x()'
+        self.assertEqual(server.minify_js(src),
+                         'let x = `line1\n    // not a comment\n    ${ {a: `inner ${ b }`}.a }  /* text */\n  end`;\nx()')
+
+    def test_js_that_cannot_be_tokenized_is_unchanged(self):
+        for src in ("const a = 'open", 'let t = `open ${', 'x = 1 /* open', 'x = /open\n'):
+            self.assertEqual(server.minify_js(src), src)
+
+class HtmlMinifyTest(unittest.TestCase):
+    def minify(self, html):
+        return server._html_pass(html, lambda ref: ref, minify=True)
+
+    def test_text_whitespace_is_kept(self):
+        html = '<div style="white-space: pre-wrap">a   b\n    c</div><p>x <code>f(  a )</code>  y</p>'
+        self.assertEqual(self.minify(html), html + '\n')
+
+    def test_indentation_between_tags_is_collapsed(self):
+        self.assertEqual(self.minify('<ul>\n    <li>a</li>\n    <li>b</li>\n</ul>\n'),
+                         '<ul>\n<li>a</li>\n<li>b</li>\n</ul>\n')
+
+class ProjectIndexTest(unittest.TestCase):
+    FILES = {  # path -> (size, mtime)
+        'alpha/index.html': (10, 3000),
+        'Beta/a.js': (100, 1000), 'Beta/b.js': (100, 1000), 'Beta/c.css': (100, 1000),
+        'gamma/manifest.json': (5000, 2000), 'gamma/sw.js': (1, 2000),
+    }
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.changes = []
+        for rel, (size, mtime) in self.FILES.items():
+            path = os.path.join(self.root, *rel.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(b'x' * size)
+            os.utime(path, (mtime, mtime))
+            self.changes.append((path, 'created'))
+        os.mkdir(os.path.join(self.root, '.hidden'))
+        self.index = server.ProjectIndex(mock.Mock(root=self.root))
+        self.index.apply(self.changes)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def names(self, **params):
+        page, total = self.index.query({k: [str(v)] for k, v in params.items()})
+        return [p['name'] for p in page], total
+
+    def test_listing_is_name_ordered_ignoring_case(self):
+        self.assertEqual(self.names(), (['alpha', 'Beta', 'gamma'], 3))
+        self.assertEqual(self.names(order='desc'), (['gamma', 'Beta', 'alpha'], 3))
+
+    def test_sort_keys(self):
+        self.assertEqual(self.names(sort='size')[0], ['alpha', 'Beta', 'gamma'])
+        self.assertEqual(self.names(sort='files', order='desc')[0], ['Beta', 'gamma', 'alpha'])
+        self.assertEqual(self.names(sort='modified')[0], ['Beta', 'gamma', 'alpha'])
+        self.assertEqual(self.names(sort='bogus')[0], ['alpha', 'Beta', 'gamma'])
+
+    def test_limit_and_offset_page_but_total_counts_all(self):
+        self.assertEqual(self.names(limit=2), (['alpha', 'Beta'], 3))
+        self.assertEqual(self.names(limit=2, offset=2), (['gamma'], 3))
+        self.assertEqual(self.names(limit=0), ([], 3))
+        self.assertEqual(self.names(offset=-5, limit=1), (['alpha'], 3))
+        self.assertEqual(self.names(limit='many'), (['alpha', 'Beta', 'gamma'], 3))
+
+    def test_filters(self):
+        self.assertEqual(self.names(q='ET'), (['Beta'], 1))
+        self.assertEqual(self.names(has_sw='true'), (['gamma'], 1))
+        self.assertEqual(self.names(has_index='0', sort='size', order='desc'), (['gamma', 'Beta'], 2))
+
+    def test_changes_update_the_catalog(self):
+        path = os.path.join(self.root, 'gamma', 'manifest.json')
+        os.remove(path)
+        self.index.apply([(path, 'deleted')])
+        page, _ = self.index.query({'q': ['gamma']})
+        self.assertEqual((page[0]['file_count'], page[0]['has_manifest']), (1, False))
+        self.assertEqual(len(json.loads(self.index.payload()[0])), 3)
+
+class PrecacheIndexTest(unittest.TestCase):
+    FILES = {
+        'app/index.html': b'<h1>app</h1>',
+        'app/css/site style.css': b'body{}',
+        'app/sw.js': b'self.addEventListener()',
+        'app/notes.md': b'not an asset',
+        'app/admin.html': b'private',
+        'app/.cache/old.js': b'hidden',
+        'app/node_modules/lib.js': b'dependency',
+    }
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.root = self.tmp.name
+        for rel, data in self.FILES.items():
+            self.write(rel, data)
+        patcher = mock.patch.object(server, 'PRIVATE_FILES', (self.path('app/admin.html'),))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.index = server.PrecacheIndex(mock.Mock(), root=self.root)
+
+    def path(self, rel):
+        return os.path.join(self.root, *rel.split('/'))
+
+    def write(self, rel, data):
+        path = self.path(rel)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def manifest(self, project='app'):
+        payload, _, etag, _ = self.index.get(project)
+        return json.loads(payload), etag
+
+    def test_manifest_lists_servable_assets_by_content_hash(self):
+        manifest, etag = self.manifest()
+        index_hash = server.file_digest(self.path('app/index.html'))
+        self.assertEqual(manifest['assets'], {
+            './': index_hash,
+            './index.html': index_hash,
+            './css/site%20style.css': server.file_digest(self.path('app/css/site style.css')),
+        })
+        self.assertEqual(manifest['bytes'], len(b'<h1>app</h1>') + len(b'body{}'))
+        self.assertEqual(etag, f'"{manifest["version"]}"')
+
+    def test_only_servable_directories_resolve(self):
+        self.assertIsNotNone(self.index.get('./app/'))
+        for project in ('', 'missing', '../app', 'app/.cache', 'app/node_modules'):
+            self.assertIsNone(self.index.get(project), project)
+
+    def test_etag_changes_only_with_content(self):
+        manifest, etag = self.manifest()
+        self.assertEqual(self.manifest(), (manifest, etag))
+        hashed = self.index.counters['hashed']
+        path = self.path('app/index.html')
+        os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns))
+        self.index.apply([(path, 'modified')])  # same mtime and size: nothing to rehash
+        self.assertEqual(self.index.counters['hashed'], hashed)
+        self.write('app/index.html', b'<h1>new</h1>')
+        self.index.apply([(path, 'modified')])
+        changed, new_etag = self.manifest()
+        self.assertNotEqual(new_etag, etag)
+        self.assertEqual(changed['assets']['./index.html'], server.file_digest(path))
+        self.assertEqual(self.index.counters['hashed'], hashed + 1)
+
+    def test_added_and_deleted_files(self):
+        _, etag = self.manifest()
+        added = self.write('app/app.js', b'main()')
+        os.remove(self.path('app/css/site style.css'))
+        self.index.apply([(added, 'created'), (self.path('app/css/site style.css'), 'deleted'),
+                          (self.write('app/notes2.md', b'x'), 'created')])
+        manifest, new_etag = self.manifest()
+        self.assertEqual(sorted(manifest['assets']), ['./', './app.js', './index.html'])
+        self.assertNotEqual(new_etag, etag)
+
+class SearchIndexTest(unittest.TestCase):
+    FILES = {
+        'app/index.html': '<h1>Gateway Client</h1>\n<p>the gateway client streams</p>\n',
+        'app/main.js': 'const gatewayClient = 1;\nlet client_gateway = 2;\n',
+        'app/admin.html': '<p>gateway client secret</p>\n',
+        'other/notes.md': 'Client of the gateway.\n',
+    }
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.realpath(self.tmp.name)
+        paths = []
+        for rel, text in self.FILES.items():
+            path = os.path.join(self.root, *rel.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(text)
+            paths.append((path, 'created'))
+        private = (os.path.join(self.root, 'app', 'admin.html'),)
+        with mock.patch.object(server, 'PRIVATE_FILES', private):
+            self.index = server.SearchIndex(mock.Mock(), root=self.root)
+            self.index._index(paths)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def paths(self, q, *paths, **kwargs):
+        return sorted(r['path'] for r in self.index.search(q, paths, **kwargs)['results'])
+
+    def test_every_term_must_appear(self):
+        self.assertEqual(self.paths('gateway client'), ['app/index.html', 'app/main.js', 'other/notes.md'])
+        self.assertEqual(self.paths('gateway streams'), ['app/index.html'])
+
+    def test_quoted_phrase_is_one_term(self):
+        self.assertEqual(self.paths('"gateway client"'), ['app/index.html'])
+
+    def test_word_only_matches_whole_words(self):
+        self.assertEqual(self.paths('client', word=True), ['app/index.html', 'other/notes.md'])
+
+    def test_case_sensitive(self):
+        self.assertEqual(self.paths('Client', case=True), ['app/index.html', 'app/main.js', 'other/notes.md'])
+        self.assertEqual(self.paths('Gateway', case=True), ['app/index.html'])
+
+    def test_private_files_are_not_indexed(self):
+        self.assertEqual(self.paths('secret'), [])
+        self.assertNotIn('app/admin.html', self.paths('gateway', 'app/admin.html'))
+
+    def test_path_filter_takes_files_dirs_and_globs(self):
+        self.assertEqual(self.paths('gateway', 'app/index.html'), ['app/index.html'])
+        self.assertEqual(self.paths('gateway', 'app'), ['app/index.html', 'app/main.js'])
+        self.assertEqual(self.paths('gateway', '*.md'), ['other/notes.md'])
+
+class FileEventsTest(unittest.TestCase):
+    def setUp(self):
+        self.poller = mock.Mock(root='/ws')
+        self.events = server.FileEvents(self.poller)
+        self.events.apply([])  # the priming poll
+        self.events._thread = object()  # queue only; nothing hashes in these tests
+
+    def queue(self, *changes):
+        self.events.apply([('/ws/' + path, kind) for path, kind in changes])
+        return {os.path.relpath(p, '/ws'): k for p, k in self.events._pending.items()}
+
+    def test_queued_changes_to_one_path_merge(self):
+        self.assertEqual(self.queue(('a', 'created'), ('b', 'modified')), {'a': 'created', 'b': 'modified'})
+        self.assertEqual(self.queue(('a', 'modified'), ('b', 'deleted')), {'a': 'created', 'b': 'deleted'})
+        self.assertEqual(self.queue(('a', 'deleted'), ('b', 'created')), {'b': 'modified'})
+
+class KeepAliveTest(unittest.TestCase):
+    def setUp(self):
+        cwd = os.getcwd()
+        os.chdir(server.WORKSPACE_ROOT)  # what main() serves from
+        self.addCleanup(os.chdir, cwd)
+
+    def get(self, engine):
+        httpd = server.make_server(engine, ('127.0.0.1', 0))
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        try:
+            conn = http.client.HTTPConnection(*httpd.server_address, timeout=5)
+            conn.request('GET', '/skAIxuide/login.html')
+            resp = conn.getresponse()
+            resp.read()
+            conn.close()
+            return resp.status, resp.getheader('Connection')
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join(5)
+
+    def test_asyncio_engine_reclaims_idle_connections_under_pressure(self):
+        httpd = server.make_server('asyncio', ('127.0.0.1', 0), max_connections=1)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        try:
+            idle = http.client.HTTPConnection(*httpd.server_address, timeout=5)
+            idle.request('GET', '/skAIxuide/login.html')
+            idle.getresponse().read()
+            # The only slot is held by `idle` waiting for its next request
+            started = time.monotonic()
+            other = http.client.HTTPConnection(*httpd.server_address, timeout=5)
+            other.request('GET', '/skAIxuide/login.html')
+            self.assertEqual(other.getresponse().status, 200)
+            self.assertLess(time.monotonic() - started, 2)
+            other.close()
+            idle.close()
+        finally:
+            httpd.shutdown()
+            thread.join(5)
+            httpd.server_close()
+        self.assertFalse(thread.is_alive())
+
+    def test_asyncio_engine_stops_with_every_slot_taken(self):
+        httpd = server.make_server('asyncio', ('127.0.0.1', 0), max_connections=1)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        socks = [socket.create_connection(httpd.server_address) for _ in range(2)]
+        time.sleep(0.2)
+        started = time.monotonic()
+        httpd.shutdown()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertLess(time.monotonic() - started, 2)
+        httpd.server_close()
+        for sock in socks:
+            sock.close()
+
+    def test_classic_engine_closes_every_connection(self):
+        self.assertEqual(self.get('classic'), (200, 'close'))
+
+    def test_threaded_engine_keeps_connections_open(self):
+        self.assertEqual(self.get('threaded'), (200, None))
+
+class IndexRelayTest(unittest.TestCase):
+    """Workers other than worker 0 relay the index routes to it."""
+
+    class IndexWorker(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('ETag', '"v1"')
+            self.send_header('X-Seen-Path', self.path)
+            self.send_header('Connection', 'close')  # length unknown: close-delimited
+            self.end_headers()
+            self.wfile.write(b'{"projects": []}')
+            self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    def setUp(self):
+        cwd = os.getcwd()
+        os.chdir(server.WORKSPACE_ROOT)
+        self.addCleanup(os.chdir, cwd)
+
+    def relay(self, index_address, path):
+        httpd = server.make_server('threaded', ('127.0.0.1', 0))
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        try:
+            with mock.patch.object(server, 'INDEX_ADDRESS', index_address):
+                conn = http.client.HTTPConnection(*httpd.server_address, timeout=5)
+                conn.request('GET', path)
+                resp = conn.getresponse()
+                body = resp.read()
+                conn.close()
+            return resp, body
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            thread.join(5)
+
+    def test_index_route_is_answered_by_the_index_worker(self):
+        index = http.server.ThreadingHTTPServer(('127.0.0.1', 0), self.IndexWorker)
+        threading.Thread(target=index.serve_forever, daemon=True).start()
+        self.addCleanup(index.server_close)
+        self.addCleanup(index.shutdown)
+        resp, body = self.relay(index.server_address, '/api/fs/projects?sort=name')
+        self.assertEqual((resp.status, body), (200, b'{"projects": []}'))
+        self.assertEqual(resp.getheader('X-Seen-Path'), '/api/fs/projects?sort=name')
+        self.assertEqual(resp.getheader('ETag'), '"v1"')
+        self.assertEqual(resp.getheader('Transfer-Encoding'), 'chunked')
+
+    def test_unreachable_index_worker_is_a_503(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            address = sock.getsockname()  # nothing listens here
+        resp, _ = self.relay(address, '/api/fs/projects')
+        self.assertEqual(resp.status, 503)
+        self.assertEqual(resp.getheader('Retry-After'), '1')
+
+    def test_other_routes_are_served_locally(self):
+        resp, _ = self.relay(('127.0.0.1', 9), '/skAIxuide/login.html')
+        self.assertEqual(resp.status, 200)
+
+    def test_workers_fail_up_front_on_an_old_python(self):
+        with mock.patch.object(server, 'WORKERS_MIN_PYTHON', (99, 0)), \
+                mock.patch('sys.stderr', io.StringIO()) as err:
+            with self.assertRaises(SystemExit):
+                server.parse_args(['--workers', '2'])
+        self.assertIn('Python 99.0', err.getvalue())
+        self.assertEqual(server.parse_args(['--workers', '1']).workers, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""Unit tests for _patch_engine.plan().
+
+    python -m pytest -q test_patch_engine.py
+"""
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import _patch_engine as engine  # noqa: E402
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def spec(self, *patches):
+        path = os.path.join(self.tmp.name, 'spec.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'patches': list(patches)}, f)
+        return engine.PatchSpec(path)
+
+    def plan(self, spec, content):
+        result = engine.FileResult('file')
+        return engine.plan(spec, content, result), result
+
+    def test_anchor_nested_in_a_longer_anchor_is_found(self):
+        spec = self.spec({'name': 'long', 'start': 'model: gemini-1.5', 'end': ';', 'replace': 'X'},
+                         {'name': 'short', 'start': 'gemini', 'end': '-1.5', 'replace': 'Y'})
+        new, result = self.plan(spec, 'a; model: gemini-1.5;')
+        # Both start at offsets the other's match covers, so they clash, but both are seen
+        self.assertEqual([name for name, _ in result.matched], ['long', 'short'])
+        self.assertIsNone(new)
+        self.assertIn('overlap', result.error)
+
+    def test_anchor_that_is_a_prefix_of_another_is_found(self):
+        spec = self.spec({'name': 'a', 'start': 'foo bar', 'replace': 'X'},
+                         {'name': 'b', 'start': 'foo', 'end': 'baz', 'replace': 'Y'})
+        new, result = self.plan(spec, 'foo bar\nbaz')
+        self.assertEqual(result.missing, [])
+        self.assertEqual(len(result.matched), 2)
+
+    def test_end_is_the_first_occurrence_at_or_after_start(self):
+        spec = self.spec({'name': 'p', 'start': '<b>', 'end': '</b>', 'replace': '<b>new'})
+        new, _ = self.plan(spec, '</b> <b>old</b> </b>')
+        self.assertEqual(new, '</b> <b>new</b> </b>')
+        spec = self.spec({'name': 'p', 'start': 'abc', 'end': 'abc', 'through_end': True, 'replace': 'Z'})
+        self.assertEqual(self.plan(spec, '-abc-')[0], '-Z-')
+
+    def test_partial_match_of_required_patches_leaves_the_file_alone(self):
+        spec = self.spec({'name': 'one', 'start': 'alpha', 'replace': 'A'},
+                         {'name': 'two', 'start': 'beta', 'replace': 'B'})
+        new, result = self.plan(spec, 'alpha only')
+        self.assertIsNone(new)
+        self.assertEqual(result.missing, ['two'])
+        self.assertIn('two', result.error)
+
+    def test_optional_patches_may_be_missing(self):
+        spec = self.spec({'name': 'one', 'start': 'alpha', 'replace': 'A'},
+                         {'name': 'two', 'start': 'beta', 'replace': 'B', 'required': False})
+        new, result = self.plan(spec, 'alpha only')
+        self.assertEqual(new, 'A only')
+        self.assertIsNone(result.error)
+
+    def test_file_matching_no_anchor_is_skipped(self):
+        spec = self.spec({'name': 'one', 'start': 'alpha', 'replace': 'A'})
+        new, result = self.plan(spec, 'nothing here')
+        self.assertIsNone(new)
+        self.assertIsNone(result.error)
+
+if __name__ == '__main__':
+    unittest.main()